@@ -0,0 +1,195 @@
+"""
+Concurrent execution of planned label changes, with a report instead of an abort.
+
+Batches from `action_planner.plan_actions` are sent by a pool of worker threads.
+Rate limited and 5xx responses are retried with backoff (`gmail_api.execute_with_retry`),
+and batches that still fail are recorded in an `ExecutionReport` while the
+other batches carry on.
+"""
+import logging
+import math
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from action_planner import modify_request
+from gmail_api import execute_with_retry, current_priority
+from utils import get_http_status
+
+
+DEFAULT_MAX_WORKERS = 4
+
+# A batch rejected with one of these may hold a single bad message (e.g. one deleted
+# since the last sync), so it is split in halves to apply the rest.
+SPLITTABLE_STATUSES = {400, 404}
+
+REPORTED_PERCENTILES = (0.5, 0.9, 0.99)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of `values` for 0 < `fraction` <= 1, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class ExecutionReport:
+    """
+    Outcome of applying a plan: per-rule counts, failed batches and call latencies.
+
+    Rule counts are (email, action) entries, keyed by the second item of the
+    entries in `entries_by_email` (the rule hash in `process_mail.apply_rules`).
+
+    Args:
+        plan (list[dict]): Batches from `plan_actions`.
+        entries_by_email (dict | None): {email ID: [(email ID, rule key, action), ...]}
+            attributing every planned email to the rules that matched it.
+        rule_names (dict | None): Display name of each rule key.
+        dry_run (bool): True if the plan was only printed.
+
+    Attributes:
+        rules (dict): {rule key: {"succeeded": n, "failed": n, "skipped": n}}.
+        failures (list[dict]): {"ids", "add", "remove", "error", "status"} of every
+            batch that failed for good.
+        latencies (list[float]): Seconds taken by each API call, retries included.
+        calls (int): API calls made.
+    """
+
+    def __init__(self, plan, entries_by_email=None, rule_names=None, dry_run=False):
+        self.plan = plan
+        self.entries_by_email = entries_by_email or {}
+        self.rule_names = rule_names or {}
+        self.dry_run = dry_run
+        self.rules = defaultdict(lambda: {"succeeded": 0, "failed": 0, "skipped": 0})
+        self.failures = []
+        self.failed_ids = set()
+        self.latencies = []
+        self.calls = 0
+        self.elapsed = 0.0
+
+    def record_entries(self, entries, outcome):
+        """Counts (email ID, rule key, action) entries as "succeeded", "failed" or "skipped"."""
+        for entry in entries:
+            self.rules[entry[1]][outcome] += 1
+
+    def record_batch(self, batch, error=None):
+        """Records the final outcome of a batch."""
+        outcome = "succeeded" if error is None else "failed"
+        for email_id in batch["ids"]:
+            self.record_entries(self.entries_by_email.get(email_id, ()), outcome)
+        if error is not None:
+            self.failed_ids.update(batch["ids"])
+            self.failures.append({"ids": batch["ids"], "add": batch["add"], "remove": batch["remove"],
+                                  "error": str(error), "status": get_http_status(error)})
+
+    @property
+    def ok(self):
+        return not self.failures
+
+    def latency_percentiles(self):
+        """Returns {"p50": s, "p90": s, "p99": s, "max": s} over the API call latencies."""
+        stats = {f"p{round(fraction * 100)}": percentile(self.latencies, fraction)
+                 for fraction in REPORTED_PERCENTILES}
+        stats["max"] = max(self.latencies) if self.latencies else None
+        return stats
+
+    def summary(self):
+        """Returns the report as a JSON-serializable dict."""
+        return {
+            "dry_run": self.dry_run,
+            "batches": len(self.plan),
+            "calls": self.calls,
+            "elapsed": self.elapsed,
+            "failed_emails": len(self.failed_ids),
+            "rules": {self.rule_names.get(key, key): dict(counts) for key, counts in self.rules.items()},
+            "latency": self.latency_percentiles(),
+            "failures": self.failures,
+        }
+
+
+def format_report(report):
+    """Returns a human readable summary of an `ExecutionReport`, one line per rule."""
+    if report.dry_run:
+        return f"Dry run: {len(report.plan)} batches planned, nothing applied."
+    lines = [f"{report.calls} API calls in {report.elapsed:.2f}s, "
+             f"{len(report.failures)} failed batches ({len(report.failed_ids)} emails)"]
+    latency = report.latency_percentiles()
+    if latency["max"] is not None:
+        lines.append("Latency: " + ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in latency.items()))
+    for key, counts in report.rules.items():
+        lines.append(f"{report.rule_names.get(key, key)}: {counts['succeeded']} applied, "
+                     f"{counts['failed']} failed, {counts['skipped']} skipped")
+    for failure in report.failures:
+        lines.append(f"Failed batch of {len(failure['ids'])} email(s) starting with {failure['ids'][0]}: "
+                     f"{failure['error']}")
+    return "\n".join(lines)
+
+
+def execute_plan_concurrently(service, plan, report=None, on_applied=None, max_workers=DEFAULT_MAX_WORKERS,
+                              rate_limiter=None, http_factory=None, max_retries=5, clock=time.perf_counter):
+    """
+    Sends the planned batches to Gmail with up to `max_workers` calls in flight.
+
+    A batch that still fails after its retries is recorded in the report and the
+    run goes on. Multi-message batches rejected with a 400 or 404 are split in
+    halves and resent, so one bad message does not fail the messages next to it.
+
+    Args:
+        service: Authenticated Gmail API service.
+        plan (list[dict]): Batches from `plan_actions`.
+        report (ExecutionReport | None): Report to fill; a new one is created if None.
+        on_applied (callable | None): Called with each batch once Gmail accepted it,
+            on the calling thread (so it may write to the database).
+        max_workers (int): Maximum number of concurrent API calls.
+        rate_limiter (TokenBucket | None): Extra quota bucket charged before every call, on top
+            of the process-wide `gmail_api.SCHEDULER`.
+        http_factory (callable | None): Returns the HTTP object for the calling thread.
+        max_retries (int): Retries for 429/5xx responses per call.
+        clock (callable): Time source for the latencies.
+
+    The calls are sent at the caller's scheduling priority (see `gmail_api.api_priority`).
+
+    Returns:
+        ExecutionReport: Counts, failures and latencies of the run.
+    """
+    report = report if report is not None else ExecutionReport(plan)
+    started = clock()
+    priority = current_priority()
+
+    def send(batch):
+        request, method = modify_request(service, batch)
+        http = http_factory() if http_factory else None
+        call_started = clock()
+        try:
+            execute_with_retry(request, method=method, rate_limiter=rate_limiter, http=http,
+                               max_retries=max_retries, priority=priority)
+        except Exception as e:
+            return clock() - call_started, e
+        return clock() - call_started, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(send, batch): batch for batch in plan}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                latency, error = future.result()
+                report.calls += 1
+                report.latencies.append(latency)
+                if error is None:
+                    report.record_batch(batch)
+                    if on_applied is not None:
+                        on_applied(batch)
+                elif len(batch["ids"]) > 1 and get_http_status(error) in SPLITTABLE_STATUSES:
+                    logging.warning(f"Batch of {len(batch['ids'])} emails rejected ({error}), resending in halves")
+                    middle = len(batch["ids"]) // 2
+                    for ids in (batch["ids"][:middle], batch["ids"][middle:]):
+                        half = {**batch, "ids": ids}
+                        pending[executor.submit(send, half)] = half
+                else:
+                    logging.error(f"Failed to modify {len(batch['ids'])} emails: {error}")
+                    report.record_batch(batch, error)
+
+    report.elapsed = clock() - started
+    return report
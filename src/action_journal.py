@@ -0,0 +1,77 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from db_utils import AppliedAction
+
+# Keeps `IN (...)` clauses and multi-row inserts well below SQLite's bound parameter limit.
+JOURNAL_CHUNK_SIZE = 500
+
+
+def filter_unapplied(entries):
+    """
+    Drops the (email ID, rule hash, action) entries that are already journaled.
+
+    The journal is read with one index range query per distinct (rule hash, action)
+    pair, restricted to the candidate emails, so the cost follows the number of
+    matches rather than the size of the journal.
+
+    Args:
+        entries (Iterable[tuple[str, str, str]]): (email ID, rule hash, action) entries.
+
+    Returns:
+        list[tuple[str, str, str]]: The entries that still have to be applied, in input order.
+    """
+    entries = list(entries)
+    candidates = defaultdict(set)
+    for email_id, rule_hash, action in entries:
+        candidates[(rule_hash, action)].add(email_id)
+
+    applied = set()
+    for (rule_hash, action), email_ids in candidates.items():
+        email_ids = sorted(email_ids)
+        for start in range(0, len(email_ids), JOURNAL_CHUNK_SIZE):
+            query = (AppliedAction.select(AppliedAction.email_id)
+                     .where((AppliedAction.rule_hash == rule_hash) & (AppliedAction.action == action)
+                            & AppliedAction.email_id.in_(email_ids[start:start + JOURNAL_CHUNK_SIZE])))
+            applied.update((email_id, rule_hash, action) for (email_id,) in query.tuples())
+
+    if applied:
+        logging.info(f"Skipping {len(applied)} actions that were already applied")
+    return [entry for entry in entries if entry not in applied]
+
+
+def record_applied(entries, applied_at=None):
+    """
+    Journals (email ID, rule hash, action) entries as applied. Entries that are
+    already journaled are left untouched.
+
+    Returns:
+        int: Number of new journal entries.
+    """
+    applied_at = applied_at or datetime.now()
+    rows = [(rule_hash, action, email_id, applied_at) for email_id, rule_hash, action in entries]
+    fields = [AppliedAction.rule_hash, AppliedAction.action, AppliedAction.email_id, AppliedAction.applied_at]
+    recorded = 0
+    with AppliedAction._meta.database.atomic():
+        for start in range(0, len(rows), JOURNAL_CHUNK_SIZE):
+            recorded += AppliedAction.insert_many(rows[start:start + JOURNAL_CHUNK_SIZE], fields=fields) \
+                .on_conflict_ignore().as_rowcount().execute()
+    return recorded
+
+
+def clear_journal(rule_hashes=None):
+    """
+    Forgets applied actions so the next run applies them again.
+
+    Args:
+        rule_hashes (Iterable[str] | None): Only forget the actions of these rules.
+            Defaults to the whole journal.
+
+    Returns:
+        int: Number of journal entries removed.
+    """
+    query = AppliedAction.delete()
+    if rule_hashes is not None:
+        query = query.where(AppliedAction.rule_hash.in_(list(rule_hashes)))
+    return query.execute()
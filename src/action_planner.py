@@ -0,0 +1,124 @@
+import logging
+from collections import defaultdict
+
+
+# `users.messages.batchModify` accepts at most 1000 message IDs per call.
+MAX_BATCH_MODIFY_IDS = 1000
+
+
+def action_label_delta(action, label_registry):
+    """
+    Translates a rule action into the label IDs it adds and removes.
+
+    Args:
+        action (str): mark_as_read, mark_as_unread, flag_message or move_to_<label>.
+        label_registry (LabelRegistry): Resolves `move_to_<label>` names to label IDs.
+
+    Returns:
+        tuple[set, set] | None: (label IDs to add, label IDs to remove), or None if
+        the action is unknown or its label does not exist.
+    """
+    if action == "mark_as_read":
+        return set(), {"UNREAD"}
+    if action == "mark_as_unread":
+        return {"UNREAD"}, set()
+    if action == "flag_message":
+        return {"STARRED"}, set()
+    if action.startswith("move_to_"):
+        label_name = action.replace("move_to_", "")
+        label_id = label_registry.get_id(label_name)
+        if label_id is None:
+            logging.warning(f"Label {label_name} does not exist, skipping action {action}")
+            return None
+        return {label_id}, set()
+
+    logging.warning(f"Unknown action: {action}")
+    return None
+
+
+def plan_actions(matches, label_registry, max_batch_size=MAX_BATCH_MODIFY_IDS, resolved_actions=None):
+    """
+    Works out the net label change of every message and groups identical changes.
+
+    Deltas from all actions and rules that matched a message are merged first.
+    A label that is both added and removed for the same message (for example
+    mark_as_read together with mark_as_unread) cancels out, and messages whose
+    net change is empty are dropped.
+
+    Args:
+        matches (Iterable[tuple[str, Iterable[str]]]): (email ID, actions) pairs; an
+            email may appear several times when several rules match it.
+        label_registry (LabelRegistry): Resolves `move_to_<label>` names to label IDs.
+        max_batch_size (int): Maximum message IDs per planned batch.
+        resolved_actions (dict | None): If given, filled with the label delta of every
+            action seen, None for actions that could not be resolved.
+
+    Returns:
+        list[dict]: Batches of {"add": [...], "remove": [...], "ids": [...]}.
+    """
+    deltas = {}
+    resolved = resolved_actions if resolved_actions is not None else {}
+    for email_id, actions in matches:
+        add, remove = deltas.setdefault(email_id, (set(), set()))
+        for action in actions:
+            if action not in resolved:
+                resolved[action] = action_label_delta(action, label_registry)
+            if resolved[action] is not None:
+                add |= resolved[action][0]
+                remove |= resolved[action][1]
+
+    groups = defaultdict(list)
+    for email_id, (add, remove) in deltas.items():
+        conflicting = add & remove
+        add, remove = add - conflicting, remove - conflicting
+        if add or remove:
+            groups[(tuple(sorted(add)), tuple(sorted(remove)))].append(email_id)
+
+    plan = []
+    for (add, remove), email_ids in groups.items():
+        for start in range(0, len(email_ids), max_batch_size):
+            plan.append({"add": list(add), "remove": list(remove),
+                         "ids": email_ids[start:start + max_batch_size]})
+    return plan
+
+
+def _label_body(batch):
+    body = {}
+    if batch["add"]:
+        body["addLabelIds"] = batch["add"]
+    if batch["remove"]:
+        body["removeLabelIds"] = batch["remove"]
+    return body
+
+
+def modify_request(service, batch):
+    """
+    Builds the API request applying a planned batch.
+
+    Batches with several messages use one `messages.batchModify` call. A batch with a
+    single message uses `messages.modify`, which costs a tenth of the quota units.
+
+    Returns:
+        tuple: (request, API method name).
+    """
+    body = _label_body(batch)
+    if len(batch["ids"]) == 1:
+        logging.debug("Modifying email %s: %s", batch["ids"][0], body)
+        return service.users().messages().modify(
+            userId="me", id=batch["ids"][0], body=body), "messages.modify"
+    logging.debug("Batch modifying %d emails: %s", len(batch["ids"]), body)
+    return service.users().messages().batchModify(
+        userId="me", body={"ids": batch["ids"], **body}), "messages.batchModify"
+
+
+def format_plan(plan, max_ids_shown=10):
+    """Returns a human readable description of the planned batches, one line per batch."""
+    lines = []
+    for number, batch in enumerate(plan, start=1):
+        shown = ", ".join(batch["ids"][:max_ids_shown])
+        if len(batch["ids"]) > max_ids_shown:
+            shown += f", ... ({len(batch['ids']) - max_ids_shown} more)"
+        lines.append(
+            f"Batch {number}: {len(batch['ids'])} email(s), add {batch['add'] or '-'}, "
+            f"remove {batch['remove'] or '-'}: {shown}")
+    return "\n".join(lines) if lines else "No label changes planned."
@@ -0,0 +1,42 @@
+"""
+Throughput of the concurrent fetch pipeline against a local stub with injected latency.
+
+Run from the `src` directory:
+
+    python -m benchmarks.bench_concurrent_fetch --messages 200 --latency 0.05
+"""
+import argparse
+import time
+
+from concurrent_fetch import fetch_messages_concurrently
+from gmail_api import configure_scheduler
+from tests.fake_gmail import FakeGmailService, make_message
+
+
+def run(num_messages, latency, concurrency_levels, quota_per_second):
+    message_ids = [f"msg{i}" for i in range(num_messages)]
+    print(f"{num_messages} messages, {latency * 1000:.0f} ms simulated latency per call")
+    print(f"{'workers':>8} {'seconds':>9} {'msgs/s':>9} {'max in flight':>14}")
+
+    for workers in concurrency_levels:
+        service = FakeGmailService((make_message(message_id) for message_id in message_ids), latency=latency)
+        configure_scheduler(rate=quota_per_second or None)
+
+        started = time.perf_counter()
+        fetched = sum(1 for _ in fetch_messages_concurrently(
+            service, message_ids, max_workers=workers))
+        elapsed = time.perf_counter() - started
+
+        assert fetched == num_messages
+        print(f"{workers:>8} {elapsed:>9.2f} {fetched / elapsed:>9.1f} {service.max_in_flight:>14}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--quota", type=int, default=0,
+                        help="Quota units per second for the token bucket (0 disables it).")
+    args = parser.parse_args()
+    run(args.messages, args.latency, args.workers, args.quota)
@@ -0,0 +1,94 @@
+"""
+Body extraction speed and coverage on the recorded payload fixtures and on
+synthetic very large multipart messages.
+
+Compares `mime_parser.extract_body` with the original extraction, which only
+looked at the top-level parts and decoded as UTF-8. Run from the `src` directory:
+
+    python -m benchmarks.bench_mime_parser --large-mib 20 --repeat 20
+"""
+import argparse
+import base64
+import glob
+import json
+import os
+import time
+
+from mime_parser import extract_body
+
+FIXTURES = os.path.join(os.path.dirname(__file__), os.pardir, "tests", "fixtures", "mime")
+
+
+def original_extract_body(payload):
+    """Body extraction as it was before `mime_parser`, kept as the baseline."""
+    body = ""
+    for part in payload.get("parts", []):
+        if part.get("mimeType") == "text/plain":
+            try:
+                body = base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8")
+                break
+            except Exception:
+                pass
+    return body
+
+
+def encoded(data):
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def large_multipart(size_mib):
+    """A mixed message with big attachments before the text, and a large HTML alternative."""
+    line = "The quarterly report is attached, totals are in the second sheet.\n"
+    text = line * (size_mib * 2 ** 20 // len(line) // 4)
+    return {
+        "mimeType": "multipart/mixed",
+        "parts": [
+            {"mimeType": "application/zip", "filename": "logs.zip",
+             "body": {"data": encoded(os.urandom(size_mib * 2 ** 20 // 2))}},
+            {"mimeType": "multipart/alternative", "parts": [
+                {"mimeType": "text/plain", "headers": [{"name": "Content-Type", "value": "text/plain; charset=utf-8"}],
+                 "body": {"data": encoded(text.encode("utf-8"))}},
+                {"mimeType": "text/html", "body": {"data": encoded(f"<p>{text}</p>".encode("utf-8"))}},
+            ]},
+        ],
+    }
+
+
+def html_only(size_mib):
+    paragraph = "<p>Deal of the day: <b>50% off</b> &amp; free shipping</p>\n"
+    return {"mimeType": "multipart/mixed", "parts": [
+        {"mimeType": "text/html",
+         "body": {"data": encoded((paragraph * (size_mib * 2 ** 20 // len(paragraph))).encode("utf-8"))}}]}
+
+
+def timed(extract, payload, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        body = extract(payload)
+    return (time.perf_counter() - started) / repeat * 1000, body
+
+
+def run(large_mib, repeat, max_bytes):
+    cases = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "*.json"))):
+        with open(path, encoding="utf-8") as fixture:
+            cases.append((os.path.basename(path), json.load(fixture)["message"]["payload"]))
+    cases.append((f"large multipart ({large_mib} MiB)", large_multipart(large_mib)))
+    cases.append((f"large html-only ({large_mib} MiB)", html_only(large_mib)))
+
+    print(f"{'payload':34} {'original':>12} {'parser':>12} {'capped':>12}   body chars (original / parser)")
+    for name, payload in cases:
+        original_ms, original_body = timed(original_extract_body, payload, repeat)
+        parser_ms, body = timed(extract_body, payload, repeat)
+        capped_ms, _ = timed(lambda p: extract_body(p, max_bytes=max_bytes), payload, repeat)
+        print(f"{name:34} {original_ms:9.3f} ms {parser_ms:9.3f} ms {capped_ms:9.3f} ms   "
+              f"{len(original_body)} / {len(body)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--large-mib", type=int, default=20, help="Size of the synthetic large messages.")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--max-bytes", type=int, default=1024 * 1024, help="Body cap for the capped run.")
+    args = parser.parse_args()
+    run(args.large_mib, args.repeat, args.max_bytes)
@@ -0,0 +1,74 @@
+"""
+Single-pass multi-rule evaluation against one SQL query per rule.
+
+Fills a temporary SQLite file with the benchmarks' synthetic mailbox (see
+`benchmarks.mailbox`), then times both ways of finding the matches of every
+rule. Run from the `src` directory:
+
+    python -m benchmarks.bench_rule_engine --rows 1000000 --rules 500
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from db_utils import initialize_db, Email
+from rule_compiler import compile_rules
+from rule_engine import evaluate_rules
+from benchmarks.mailbox import SyntheticMailbox, WORDS
+from benchmarks.harness import populate
+
+
+def make_rules(num_rules, mailbox, rng):
+    rules = []
+    for index in range(num_rules):
+        conditions = [{"field": "sender", "predicate": "contains",
+                       "value": f"@domain{rng.randrange(mailbox.domains)}.com"}]
+        if index % 2:
+            conditions.append({"field": "subject", "predicate": "contains",
+                               "value": f"{rng.choice(WORDS)} {rng.choice(WORDS)}"})
+        if index % 3 == 0:
+            conditions.append({"field": "received_at", "predicate": "less_than", "value": str(rng.randint(1, 90))})
+        rules.append({"predicate": "All" if index % 4 else "Any", "conditions": conditions,
+                      "actions": ["flag_message"]})
+    return compile_rules({"rules": rules})
+
+
+def run(num_rows, num_rules, skip_sql):
+    rng = random.Random(42)
+    mailbox = SyntheticMailbox(num_rows)
+    with tempfile.TemporaryDirectory() as directory:
+        db = initialize_db(os.path.join(directory, "bench.db"))
+
+        started = time.perf_counter()
+        populate(mailbox)
+        print(f"Inserted {num_rows} rows in {time.perf_counter() - started:.1f}s")
+
+        program = make_rules(num_rules, mailbox, rng)
+        now = mailbox.now
+
+        started = time.perf_counter()
+        single_pass = evaluate_rules(program, now=now)
+        single_pass_seconds = time.perf_counter() - started
+        print(f"single pass, {num_rules} rules: {single_pass_seconds:.2f}s "
+              f"({sum(len(ids) for ids in single_pass.values())} matches)")
+
+        if not skip_sql:
+            started = time.perf_counter()
+            per_rule = {rule.index: {email_id for (email_id,) in Email.select(Email.id).where(
+                rule.to_expression(now)).tuples()} for rule in program.rules}
+            per_rule_seconds = time.perf_counter() - started
+            print(f"one query per rule:      {per_rule_seconds:.2f}s "
+                  f"({per_rule_seconds / single_pass_seconds:.1f}x the single pass)")
+            assert per_rule == single_pass
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--rules", type=int, default=500)
+    parser.add_argument("--skip-sql", action="store_true", help="Only time the single pass.")
+    args = parser.parse_args()
+    run(args.rows, args.rules, args.skip_sql)
@@ -0,0 +1,98 @@
+"""
+Query plans, timings and file sizes of the original schema against the migrated, tuned one.
+
+Run from the `src` directory:
+
+    python -m benchmarks.bench_schema --rows 200000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from db_utils import initialize_db, PERFORMANCE_PROFILES
+
+ORIGINAL_SCHEMA = (
+    'CREATE TABLE "email" ("id" VARCHAR(255) NOT NULL PRIMARY KEY, "sender" VARCHAR(255) NOT NULL, '
+    '"subject" VARCHAR(255) NOT NULL, "body" TEXT NOT NULL, "received_at" DATETIME NOT NULL)'
+)
+
+QUERIES = [
+    ("sender domain (LIKE)", "SELECT id FROM email WHERE sender LIKE '%@github.com%'", False),
+    ("sender domain (column)", "SELECT id FROM email WHERE sender_domain = 'github.com'", True),
+    ("exact sender", "SELECT id FROM email WHERE sender = 'user7@github.com'", False),
+    ("last 7 days", "SELECT id FROM email WHERE received_at > ?", False),
+]
+
+
+def make_rows(num_rows, rng):
+    now = datetime.now()
+    domains = ["github.com"] + [f"sender{i}.com" for i in range(499)]
+    for i in range(num_rows):
+        yield (f"msg{i}", f"user{rng.randint(0, 99)}@{rng.choice(domains)}", f"Subject {i}",
+               "body " * rng.randint(10, 200),
+               (now - timedelta(minutes=rng.randint(0, 60 * 24 * 365))).strftime("%Y-%m-%d %H:%M:%S.%f"))
+
+
+def timed(connection, sql, params, repeat=5):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        count = len(connection.execute(sql, params).fetchall())
+    return (time.perf_counter() - started) / repeat * 1000, count
+
+
+def plan(connection, sql, params):
+    return "; ".join(row[3] for row in connection.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+
+
+def run(num_rows):
+    rng = random.Random(1)
+    rows = list(make_rows(num_rows, rng))
+    week_ago = ((datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S"),)
+
+    with tempfile.TemporaryDirectory() as directory:
+        before_path = os.path.join(directory, "before.db")
+        after_path = os.path.join(directory, "after.db")
+
+        for label, path in (("before", before_path), ("after", after_path)):
+            connection = sqlite3.connect(path)
+            connection.execute(ORIGINAL_SCHEMA)
+            if label == "after":
+                for pragma, value in PERFORMANCE_PROFILES["performance"].items():
+                    connection.execute(f"PRAGMA {pragma} = {value}")
+            started = time.perf_counter()
+            for start in range(0, num_rows, 1000):
+                connection.executemany("INSERT INTO email VALUES (?, ?, ?, ?, ?)", rows[start:start + 1000])
+                connection.commit()  # One transaction per chunk, as the fetcher writes
+            print(f"{label}: inserted {num_rows} rows in {time.perf_counter() - started:.2f}s")
+            connection.close()
+
+        # Upgrade the second copy in place through the regular migrations
+        initialize_db(after_path).close()
+
+        before = sqlite3.connect(before_path)
+        after = sqlite3.connect(after_path)
+        for label, path, connection in (("before", before_path, before), ("after", after_path, after)):
+            connection.execute("VACUUM")
+            print(f"{label}: database file is {os.path.getsize(path) / 2 ** 20:.1f} MiB")
+        after.execute("ANALYZE")
+        for name, sql, needs_migration in QUERIES:
+            params = week_ago if "?" in sql else ()
+            print(f"\n{name}")
+            if not needs_migration:
+                ms, count = timed(before, sql, params)
+                print(f"  before: {ms:8.2f} ms  {count:7} rows  plan: {plan(before, sql, params)}")
+            ms, count = timed(after, sql, params)
+            print(f"  after:  {ms:8.2f} ms  {count:7} rows  plan: {plan(after, sql, params)}")
+        before.close()
+        after.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    args = parser.parse_args()
+    run(args.rows)
@@ -0,0 +1,78 @@
+"""
+Startup cost of the entry points and of getting a Gmail API service.
+
+Measures, without network access:
+- the import time of the entry point modules, in fresh interpreter processes;
+- reading the token and building the service on every call, as every entry
+  point did before `gmail_client`, against the cached `GmailClient`.
+
+Run from the `src` directory:
+
+    python -m benchmarks.bench_startup --runs 7
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from google.oauth2.credentials import Credentials
+
+from gmail_client import GmailClient
+from utils import authenticate_gmail
+
+ENTRY_POINTS = ("gmail_mail_fetch", "process_mail", "daemon")
+
+
+def median_ms(function, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def write_token(path):
+    expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+    creds = Credentials(token="access", refresh_token="refresh", client_id="id", client_secret="secret",
+                        token_uri="https://oauth2.googleapis.com/token", expiry=expiry)
+    with open(path, "w") as token:
+        token.write(creds.to_json())
+
+
+def run(runs, calls):
+    print(f"{'entry point import (fresh process)':44} {'median':>10}")
+    for module in ENTRY_POINTS:
+        elapsed = median_ms(lambda: subprocess.run([sys.executable, "-c", f"import {module}"], check=True), runs)
+        print(f"{module:44} {elapsed:>7.0f} ms")
+
+    with tempfile.TemporaryDirectory() as directory:
+        token_path = os.path.join(directory, "token.json")
+        write_token(token_path)
+        from googleapiclient.discovery import build
+
+        def rebuild():
+            creds = authenticate_gmail(token_path, interactive=False)
+            return build("gmail", "v1", credentials=creds)
+
+        client = GmailClient(token_path, interactive=False)
+        client.service()
+
+        print(f"\n{'service acquisition':44} {'per call':>10}")
+        for name, function in (
+                ("token read + build on every call (before)", rebuild),
+                ("new GmailClient", lambda: GmailClient(token_path, interactive=False).service()),
+                ("cached GmailClient", client.service)):
+            print(f"{name:44} {median_ms(function, calls):>7.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=7, help="Repetitions per measurement (median reported).")
+    parser.add_argument("--calls", type=int, default=50, help="Repetitions of each service acquisition.")
+    args = parser.parse_args()
+    run(args.runs, args.calls)
@@ -0,0 +1,213 @@
+"""
+End-to-end benchmark scenarios over synthetic mailboxes, with machine-readable results.
+
+Scenarios, each run at every requested mailbox size (1k, 100k, 1M messages):
+- fetch: `sync_all_emails` mirrors the mailbox from the fake Gmail service
+  (paginated list, batched gets, parse, chunked inserts);
+- rules: `evaluate_rules` runs a generated rule set over the stored emails;
+- actions: `apply_rules` plans and applies the label changes through the
+  concurrent executor, against the fake `batchModify` endpoint.
+
+The fake service (`tests.fake_gmail.FakeGmailService`) can add latency per
+round trip and enforce a per-user quota. Results go to a JSON file; pass a
+previous file as `--baseline` to fail on regressions. Run from the `src` directory:
+
+    python -m benchmarks.harness --sizes 1k 100k --output results.json
+    python -m benchmarks.harness --sizes 1k 100k --baseline results.json --tolerance 0.25
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from db_utils import initialize_db, insert_emails, db_proxy
+from gmail_api import configure_scheduler
+from gmail_mail_fetch import sync_all_emails
+from rule_compiler import compile_rules
+from rule_engine import evaluate_rules
+from label_registry import LabelRegistry
+from process_mail import apply_rules
+from metrics import METRICS
+from benchmarks.mailbox import SyntheticMailbox, WORDS
+from tests.fake_gmail import FakeGmailService
+
+SIZES = {"1k": 1_000, "100k": 100_000, "1M": 1_000_000}
+SCENARIOS = ("fetch", "rules", "actions")
+POPULATE_CHUNK_SIZE = 5000
+
+
+def make_rules(mailbox, num_rules):
+    """
+    Returns a rule program mixing the condition types real rule files use: sender and
+    domain equality on frequent senders, subject and body substrings, relative dates.
+    """
+    senders = mailbox.top_senders(num_rules)
+    rules = []
+    for index in range(num_rules):
+        kind = index % 4
+        if kind == 0:
+            conditions = [{"field": "sender", "predicate": "equals", "value": senders[index % len(senders)]}]
+        elif kind == 1:
+            conditions = [{"field": "sender_domain", "predicate": "equals",
+                           "value": senders[index % len(senders)].split("@")[1]},
+                          {"field": "received_at", "predicate": "less_than", "value": str(30 + index % 60)}]
+        elif kind == 2:
+            conditions = [{"field": "subject", "predicate": "contains", "value": WORDS[index % len(WORDS)]},
+                          {"field": "subject", "predicate": "contains", "value": WORDS[(index * 7) % len(WORDS)]}]
+        else:
+            conditions = [{"field": "body", "predicate": "contains",
+                           "value": f"{WORDS[index % len(WORDS)]} {WORDS[(index * 3) % len(WORDS)]}"}]
+        actions = [["mark_as_read"], ["flag_message"], ["move_to_Benchmark"], ["mark_as_read", "flag_message"]][kind]
+        rules.append({"predicate": "All", "conditions": conditions, "actions": actions})
+    return compile_rules({"rules": rules})
+
+
+def populate(mailbox, chunk_size=POPULATE_CHUNK_SIZE):
+    """Writes the mailbox straight into the database, for scenarios that skip fetch."""
+    for start in range(0, mailbox.size, chunk_size):
+        with db_proxy.atomic():
+            insert_emails(list(mailbox.rows(start, start + chunk_size)))
+
+
+def metric_totals():
+    """Returns the API calls per method and seconds per stage recorded since the last reset."""
+    snapshot = METRICS.snapshot()
+    return {
+        "api_calls": {sample["labels"]["method"]: sample["value"]
+                      for sample in snapshot["counters"].get("api_calls", [])},
+        "stage_seconds": {sample["labels"]["stage"]: round(sample["sum"], 6)
+                          for sample in snapshot["timers"].get("stage_seconds", [])},
+    }
+
+
+def result(scenario, size, seconds, items, **details):
+    return {"scenario": scenario, "size": size, "seconds": round(seconds, 6),
+            "per_second": round(items / seconds, 1) if seconds else None, **details, **metric_totals()}
+
+
+def run_fetch(mailbox, db, options):
+    service = FakeGmailService(mailbox, latency=options.latency, quota_per_second=options.quota, record_calls=False)
+    configure_scheduler(rate=options.quota or None)
+    started = time.perf_counter()
+    stats = sync_all_emails(service, db, batch_size=options.batch_size, resume=False)
+    elapsed = time.perf_counter() - started
+    return result("fetch", mailbox.size, elapsed, stats["inserted"], inserted=stats["inserted"],
+                  round_trips=service.round_trips, throttled=service.throttled)
+
+
+def run_rules(mailbox, program):
+    started = time.perf_counter()
+    matches = evaluate_rules(program, now=mailbox.now)
+    elapsed = time.perf_counter() - started
+    return result("rules", mailbox.size, elapsed, mailbox.size, rules=len(program.rules),
+                  matched=len(set().union(*matches.values())))
+
+
+def run_actions(mailbox, program, options):
+    service = FakeGmailService(mailbox, latency=options.latency, quota_per_second=options.quota, record_calls=False)
+    label_registry = LabelRegistry(service, auto_create=True)
+    configure_scheduler(rate=options.quota or None)
+    started = time.perf_counter()
+    report = apply_rules(service, program, label_registry, now=mailbox.now, max_workers=options.workers)
+    elapsed = time.perf_counter() - started
+    changed = sum(len(batch["ids"]) for batch in report.plan)
+    return result("actions", mailbox.size, elapsed, changed, changed=changed, batches=len(report.plan),
+                  calls=report.calls, failed_emails=len(report.failed_ids), throttled=service.throttled)
+
+
+def run(options):
+    """Runs the selected scenarios at every size and returns the results document."""
+    results = []
+    for size_name in options.sizes:
+        mailbox = SyntheticMailbox(SIZES[size_name], senders=options.senders, sender_skew=options.sender_skew,
+                                   body_bytes=options.body_bytes, seed=options.seed)
+        program = make_rules(mailbox, options.rules)
+        with tempfile.TemporaryDirectory() as directory:
+            db = initialize_db(os.path.join(directory, "bench.db"))
+            try:
+                METRICS.reset()
+                if "fetch" in options.scenarios:
+                    results.append(run_fetch(mailbox, db, options))
+                else:
+                    populate(mailbox)
+                for scenario in ("rules", "actions"):
+                    if scenario in options.scenarios:
+                        METRICS.reset()
+                        results.append(run_rules(mailbox, program) if scenario == "rules"
+                                       else run_actions(mailbox, program, options))
+            finally:
+                db.close()
+        for entry in results[-len(options.scenarios):]:
+            print(f"{entry['scenario']:>8} {size_name:>5} {entry['seconds']:>10.3f} s {entry['per_second'] or 0:>12.1f}/s")
+
+    return {
+        "environment": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                        "platform": platform.platform(), "started_at": datetime.now().isoformat()},
+        "options": {key: value for key, value in vars(options).items() if key not in ("output", "baseline")},
+        "results": results,
+    }
+
+
+def find_regressions(document, baseline, tolerance):
+    """
+    Returns a message for every (scenario, size) more than `tolerance` (e.g. 0.25 for
+    25%) slower than in the baseline document.
+    """
+    before = {(entry["scenario"], entry["size"]): entry for entry in baseline["results"]}
+    regressions = []
+    for entry in document["results"]:
+        previous = before.get((entry["scenario"], entry["size"]))
+        if previous and previous["seconds"] and entry["seconds"] > previous["seconds"] * (1 + tolerance):
+            regressions.append(f"{entry['scenario']} at {entry['size']} messages: {entry['seconds']:.3f}s, "
+                               f"baseline {previous['seconds']:.3f}s "
+                               f"(+{entry['seconds'] / previous['seconds'] - 1:.0%})")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=["1k"], help="Mailbox sizes to run.")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--senders", type=int, default=5000, help="Distinct senders in the mailbox.")
+    parser.add_argument("--sender-skew", type=float, default=1.1, help="Zipf exponent of the sender distribution.")
+    parser.add_argument("--body-bytes", type=int, default=2000, help="Median body size.")
+    parser.add_argument("--rules", type=int, default=40, help="Rules in the generated rule set.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated seconds per API round trip.")
+    parser.add_argument("--quota", type=float, default=0,
+                        help="Simulated per-user quota units per second (0 disables it).")
+    parser.add_argument("--batch-size", type=int, default=50, help="messages.get calls per batch request.")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent modify calls.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="Results file of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown against the baseline before failing (0.25 = 25%%).")
+    parser.add_argument("--verbose", action="store_true", help="Keep the info logs of the code under test.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    if not options.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    document = run(options)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(document, output_file, indent=2)
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            regressions = find_regressions(document, json.load(baseline_file), options.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
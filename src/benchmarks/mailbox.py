@@ -0,0 +1,144 @@
+"""
+Reproducible synthetic mailboxes for the benchmarks.
+
+A `SyntheticMailbox` describes N messages without holding them: message `i` is
+generated on demand from `seed` and `i`, both as a Gmail `format=full` resource
+(for the fake service) and as an `Email` row (to fill a database directly), and
+both views agree. Senders follow a Zipf distribution, so a few senders send
+most of the mail as in a real inbox, and body sizes are log-normal.
+"""
+import base64
+import bisect
+import itertools
+import math
+import random
+from collections.abc import Mapping
+from datetime import datetime, timedelta
+
+WORDS = ["invoice", "build", "digest", "release", "meeting", "report", "offer", "alert", "update",
+         "weekly", "security", "payment", "travel", "order", "account", "welcome", "receipt", "team",
+         "project", "review", "deadline", "newsletter", "shipping", "password", "calendar", "survey"]
+CORPUS_BYTES = 1024 * 1024
+
+
+class SyntheticMailbox(Mapping):
+    """
+    Read-only mapping of message ID to Gmail message resource, generated on demand.
+
+    Args:
+        size (int): Number of messages.
+        senders (int): Number of distinct sender addresses.
+        domains (int): Number of sender domains the addresses are spread over.
+        sender_skew (float): Zipf exponent of the sender distribution; 0 is uniform.
+        body_bytes (int): Median body size in bytes.
+        body_sigma (float): Spread of the log-normal body size distribution.
+        max_body_bytes (int): Cap on a single body.
+        days (int): Messages are received over this many days before `now`.
+        unread_ratio (float): Share of messages carrying the UNREAD label.
+        seed (int): Seed of every random choice; the same arguments give the same mailbox.
+        now (datetime): Reference time, fixed so relative date rules stay reproducible.
+    """
+
+    def __init__(self, size, senders=5000, domains=500, sender_skew=1.1, body_bytes=2000, body_sigma=1.0,
+                 max_body_bytes=256 * 1024, days=365, unread_ratio=0.3, seed=42, now=datetime(2025, 1, 1)):
+        self.size = size
+        self.senders = senders
+        self.domains = domains
+        self.sender_skew = sender_skew
+        self.body_bytes = body_bytes
+        self.body_sigma = body_sigma
+        self.max_body_bytes = max_body_bytes
+        self.days = days
+        self.unread_ratio = unread_ratio
+        self.seed = seed
+        self.now = now
+        self.sender_cum_weights = list(itertools.accumulate(
+            1 / (rank + 1) ** sender_skew for rank in range(senders)))
+        # Bodies are slices of one shared text, much cheaper than drawing words per message
+        rng = random.Random(seed)
+        self.corpus = " ".join(rng.choice(WORDS) for _ in range(CORPUS_BYTES // 6))
+        self._ids = None
+
+    def message_id(self, index):
+        return f"msg{index:08d}"
+
+    def sender_address(self, rank):
+        return f"user{rank}@domain{rank % self.domains}.com"
+
+    def top_senders(self, count):
+        """Returns the `count` most frequent sender addresses."""
+        return [self.sender_address(rank) for rank in range(min(count, self.senders))]
+
+    def row(self, index):
+        """Returns message `index` as a row for the `Email` table (see `db_utils.insert_emails`)."""
+        rng = random.Random(self.seed * 1_000_003 + index)
+        rank = bisect.bisect_left(self.sender_cum_weights, rng.random() * self.sender_cum_weights[-1])
+        subject = " ".join(rng.choices(WORDS, k=rng.randint(2, 6)))
+        size = min(self.max_body_bytes, len(self.corpus),
+                   int(self.body_bytes * math.exp(rng.gauss(0, self.body_sigma))))
+        offset = rng.randrange(len(self.corpus) - size + 1)
+        body = self.corpus[offset:offset + size]
+        received_at = self.now - timedelta(seconds=rng.randrange(self.days * 86400))
+        labels = ["INBOX", "UNREAD"] if rng.random() < self.unread_ratio else ["INBOX"]
+        return {"id": self.message_id(index), "sender": self.sender_address(rank), "subject": subject,
+                "body": body, "received_at": received_at, "labels": ",".join(labels)}
+
+    def rows(self, start=0, stop=None):
+        """Yields the rows of messages `start` to `stop`."""
+        for index in range(start, self.size if stop is None else min(stop, self.size)):
+            yield self.row(index)
+
+    def message(self, index):
+        """Returns message `index` as a `format=full` Gmail message resource."""
+        row = self.row(index)
+        rank = int(row["sender"][4:row["sender"].index("@")])
+        data = base64.urlsafe_b64encode(row["body"].encode("utf-8")).decode("ascii")
+        return {
+            "id": row["id"],
+            "threadId": row["id"],
+            "internalDate": str(int(row["received_at"].timestamp() * 1000)),
+            "labelIds": row["labels"].split(","),
+            "payload": {
+                "mimeType": "multipart/alternative",
+                "headers": [
+                    {"name": "From", "value": f"User {rank} <{row['sender']}>"},
+                    {"name": "Subject", "value": row["subject"]},
+                    {"name": "To", "value": "me@example.com"},
+                ],
+                "parts": [
+                    {"mimeType": "text/plain", "body": {"data": data}},
+                    {"mimeType": "text/html", "body": {"data": base64.urlsafe_b64encode(
+                        f"<p>{row['body']}</p>".encode("utf-8")).decode("ascii")}},
+                ],
+            },
+        }
+
+    def _index(self, message_id):
+        if not isinstance(message_id, str) or not message_id.startswith("msg"):
+            raise KeyError(message_id)
+        try:
+            index = int(message_id[3:])
+        except ValueError:
+            raise KeyError(message_id) from None
+        if not 0 <= index < self.size or message_id != self.message_id(index):
+            raise KeyError(message_id)
+        return index
+
+    def __getitem__(self, message_id):
+        return self.message(self._index(message_id))
+
+    def __contains__(self, message_id):
+        try:
+            self._index(message_id)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        # A real list, so `islice` can skip to a page offset at C speed
+        if self._ids is None:
+            self._ids = [self.message_id(index) for index in range(self.size)]
+        return iter(self._ids)
+
+    def __len__(self):
+        return self.size
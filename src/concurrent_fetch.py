@@ -0,0 +1,159 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from gmail_client import get_gmail_client
+from db_utils import get_or_initialize_db, filter_new_email_ids
+from gmail_api import TokenBucket, execute_with_retry, api_priority, current_priority
+from metrics import stage
+from gmail_mail_fetch import (
+    parse_message, complete_partial_message, iter_message_id_pages, store_emails_in_chunks, new_fetch_stats,
+    log_fetch_stats, MESSAGE_FIELDS, MAX_LIST_PAGE_SIZE, DEFAULT_CHUNK_SIZE
+)
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+DEFAULT_MAX_WORKERS = 10
+
+
+def fetch_messages_concurrently(service, message_ids, max_workers=DEFAULT_MAX_WORKERS, rate_limiter=None,
+                                partial=True, http_factory=None, max_retries=5):
+    """
+    Fetches and parses messages with many `messages.get` calls in flight at once.
+
+    At most `max_workers` calls run concurrently and at most twice that many are
+    queued, so memory stays bounded. Parsing happens on the worker threads, and
+    rows are yielded as soon as they are ready, so the caller's database writes
+    overlap with the remaining network waits.
+
+    Args:
+        service: Authenticated Gmail API service.
+        message_ids (Iterable[str]): IDs of the messages to fetch.
+        max_workers (int): Maximum number of concurrent API calls.
+        rate_limiter (TokenBucket | None): Extra quota bucket charged before every call, on top
+            of the process-wide `gmail_api.SCHEDULER`.
+        partial (bool): Only request the stored fields from the API. Messages nested deeper
+            than the partial response reaches are downloaded again whole.
+        http_factory (callable | None): Returns the HTTP object for the calling thread.
+        max_retries (int): Retries for 429/5xx responses per message.
+
+    Yields:
+        dict: Rows for the `Email` table, in completion order. Messages that still
+        fail after retries are logged and skipped.
+    """
+    get_kwargs = {"fields": MESSAGE_FIELDS} if partial else {}
+    # The worker threads send their calls at the priority of the caller
+    priority = current_priority()
+
+    def fetch_and_parse(message_id):
+        request = service.users().messages().get(userId="me", id=message_id, **get_kwargs)
+        http = http_factory() if http_factory else None
+        with stage("get"):
+            msg = execute_with_retry(request, method="messages.get", rate_limiter=rate_limiter,
+                                     http=http, max_retries=max_retries, priority=priority)
+            if partial:
+                msg = complete_partial_message(service, msg, rate_limiter=rate_limiter, http=http,
+                                               max_retries=max_retries, priority=priority)
+        with stage("parse"):
+            return parse_message(msg)
+
+    ids = iter(message_ids)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+
+        def submit_next():
+            message_id = next(ids, None)
+            if message_id is None:
+                return False
+            pending[executor.submit(fetch_and_parse, message_id)] = message_id
+            return True
+
+        while len(pending) < max_workers * 2 and submit_next():
+            pass
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                message_id = pending.pop(future)
+                try:
+                    row = future.result()
+                except Exception as e:
+                    logging.error(f"Error processing message {message_id}: {e}")
+                else:
+                    yield row
+                submit_next()
+
+
+def fetch_emails_concurrently_and_store(testing=False, num_messages=None, max_workers=DEFAULT_MAX_WORKERS,
+                                        quota_per_second=None,
+                                        chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Concurrent alternative to `fetch_emails_and_store`.
+
+    Args:
+        testing (bool): If True, uses a test database.
+        num_messages (int | None): Number of latest messages to fetch. Prompts if None.
+        max_workers (int): Maximum number of concurrent `messages.get` calls.
+        quota_per_second (int | None): Extra cap in quota units per second below the
+            process-wide scheduler, e.g. to leave quota to other clients of the account.
+        chunk_size (int): Rows written per transaction.
+
+    What this function does:
+    - Initialize the database and authenticate with Gmail API.
+    - List the latest `num_messages` message IDs and skip the ones already stored.
+    - Fetch the rest concurrently behind a concurrency cap and the quota scheduler,
+      at "new_mail" priority, retrying 429/5xx responses with exponential backoff.
+    - Write parsed rows in chunks while the remaining fetches are still in flight.
+    - Handle errors gracefully and log them.
+
+    Returns:
+        dict | None: Fetch counters (see `new_fetch_stats`), or None if the run failed.
+    """
+    db = None
+    try:
+        if num_messages is None:
+            num_messages = int(
+                input("Enter the number of latest messages to fetch: "))
+
+        db = get_or_initialize_db(testing=testing)
+
+        client = get_gmail_client()
+        service = client.service()
+        http_factory = client.http
+        rate_limiter = TokenBucket(rate=quota_per_second) if quota_per_second else None
+
+        logging.info(
+            f"Fetching the latest {num_messages} messages with {max_workers} workers...")
+
+        stats = new_fetch_stats()
+        remaining = num_messages
+        page_size = min(num_messages, MAX_LIST_PAGE_SIZE)
+        with api_priority("new_mail"):
+            for message_ids, _ in iter_message_id_pages(service, page_size=page_size):
+                message_ids = message_ids[:remaining]
+                new_ids = filter_new_email_ids(message_ids)
+                stats["listed"] += len(message_ids)
+                stats["skipped"] += len(message_ids) - len(new_ids)
+
+                rows = fetch_messages_concurrently(
+                    service, new_ids, max_workers=max_workers, rate_limiter=rate_limiter,
+                    http_factory=http_factory)
+                store_emails_in_chunks(db, rows, chunk_size=chunk_size, stats=stats)
+
+                remaining -= len(message_ids)
+                if remaining <= 0:
+                    break
+
+        log_fetch_stats(stats)
+        return stats
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+    finally:
+        if db is not None:
+            db.close()
+
+
+if __name__ == "__main__":
+    fetch_emails_concurrently_and_store()
+    logging.info("Emails fetched from Gmail and stored locally.")
@@ -0,0 +1,393 @@
+import argparse
+import base64
+import json
+import logging
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from gmail_client import get_gmail_client
+from db_utils import get_or_initialize_db, get_sync_state
+from gmail_api import execute_with_retry, api_priority, backoff_delay
+from action_executor import format_report
+from history_sync import sync_mailbox, HISTORY_ID_KEY
+from rule_compiler import load_rule_program
+from label_registry import LabelRegistry
+from process_mail import apply_rules, LABEL_CACHE_PATH
+from message_cache import MessageCache, DEFAULT_CACHE_DIR
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Gmail stops publishing after 7 days without a new `users.watch` call; renew daily.
+WATCH_RENEW_SECONDS = 24 * 60 * 60
+# Without notifications (or as a safety net for lost ones) the mailbox is synced this often.
+DEFAULT_POLL_SECONDS = 300
+PUBSUB_SCOPES = ["https://www.googleapis.com/auth/pubsub"]
+
+
+def decode_notification(message):
+    """
+    Decodes the data of a Gmail Pub/Sub message.
+
+    Args:
+        message (dict): Pub/Sub `PubsubMessage`, with base64 encoded JSON in `data`.
+
+    Returns:
+        dict | None: {"emailAddress": ..., "historyId": ...}, or None if the data is not a
+            Gmail notification.
+    """
+    try:
+        data = json.loads(base64.b64decode(message.get("data", "")))
+    except (ValueError, TypeError) as e:
+        logging.warning(f"Ignoring undecodable notification {message.get('messageId')}: {e}")
+        return None
+    if not isinstance(data, dict) or "historyId" not in data:
+        logging.warning(f"Ignoring notification without historyId: {data!r}")
+        return None
+    return data
+
+
+class QueueNotificationSource:
+    """
+    In-process notification source. The push endpoint feeds it, and tests use it
+    as a local fake for Pub/Sub.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def put(self, notification):
+        """Queues a decoded notification ({"emailAddress", "historyId"})."""
+        self.queue.put(notification)
+
+    def wait(self, timeout):
+        """
+        Blocks up to `timeout` seconds for a notification, then returns it together
+        with every other notification already queued (an empty list on timeout).
+        """
+        try:
+            notifications = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                notifications.append(self.queue.get_nowait())
+            except queue.Empty:
+                return notifications
+
+
+class PubSubPullSource:
+    """
+    Pulls Gmail notifications from a Pub/Sub subscription.
+
+    Messages are acknowledged as soon as they are received: a notification only
+    says that the mailbox changed, and the sync that follows reads every change
+    since the stored historyId, so a lost notification loses nothing.
+
+    Args:
+        pubsub: Pub/Sub API service (`build("pubsub", "v1")`).
+        subscription (str): "projects/<project>/subscriptions/<name>".
+        max_messages (int): Messages requested per pull.
+        clock (callable): Monotonic time source, replaceable in tests.
+        sleep (callable): Sleep function, replaceable in tests.
+    """
+
+    def __init__(self, pubsub, subscription, max_messages=100, clock=time.monotonic, sleep=time.sleep):
+        self.pubsub = pubsub
+        self.subscription = subscription
+        self.max_messages = max_messages
+        self.clock = clock
+        self.sleep = sleep
+
+    def wait(self, timeout):
+        """
+        Pulls the pending notifications. Pub/Sub holds the request open until a
+        message arrives or its own deadline passes; a pull that comes back empty
+        before `timeout` sleeps off the rest of it, so the daemon does not pull in
+        a tight loop.
+        """
+        started = self.clock()
+        response = self.pubsub.projects().subscriptions().pull(
+            subscription=self.subscription, body={"maxMessages": self.max_messages}).execute()
+        received = response.get("receivedMessages", [])
+        if not received:
+            self.sleep(max(0.0, timeout - (self.clock() - started)))
+            return []
+        self.pubsub.projects().subscriptions().acknowledge(
+            subscription=self.subscription, body={"ackIds": [item["ackId"] for item in received]}).execute()
+        notifications = [decode_notification(item["message"]) for item in received]
+        return [notification for notification in notifications if notification]
+
+
+def start_push_server(source, host="0.0.0.0", port=8080, token=None):
+    """
+    Starts an HTTP endpoint for Pub/Sub push subscriptions in a background thread.
+
+    Every POST carrying a Gmail notification is decoded and put on `source`. When
+    `token` is set, requests must carry it as the `token` query parameter of the
+    push endpoint URL, e.g. https://example.com/gmail?token=secret.
+
+    Returns:
+        ThreadingHTTPServer: The running server; call `shutdown()` to stop it.
+    """
+
+    class PushHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if token is not None and parse_qs(urlparse(self.path).query).get("token") != [token]:
+                self.send_response(403)
+                self.end_headers()
+                return
+            try:
+                envelope = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                notification = decode_notification(envelope["message"])
+            except (ValueError, KeyError, TypeError) as e:
+                logging.warning(f"Rejecting malformed push request: {e}")
+                self.send_response(400)
+                self.end_headers()
+                return
+            if notification:
+                source.put(notification)
+            # Any 2xx acknowledges the message; anything else makes Pub/Sub redeliver it.
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logging.debug(f"Push endpoint: {format % args}")
+
+    server = ThreadingHTTPServer((host, port), PushHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Listening for Pub/Sub push notifications on {host}:{server.server_port}")
+    return server
+
+
+class MailDaemon:
+    """
+    Keeps the database in sync with Gmail and applies the rules to new messages as
+    they arrive.
+
+    One authenticated service, label registry and database connection are reused
+    for the daemon's lifetime. A cycle runs when a notification newer than the
+    stored historyId arrives, and at least every `poll_interval` seconds.
+
+    Args:
+        service: Authenticated Gmail API service.
+        db (SqliteDatabase): Initialized database connection.
+        rules_path (str): Path to rules.json. It is re-read every cycle, so edits
+            take effect without a restart.
+        label_registry (LabelRegistry): Label lookup shared by every cycle.
+        source: Notification source with a `wait(timeout)` method, or None to only poll.
+        topic (str | None): Pub/Sub topic passed to `users.watch`; no watch is
+            started when None (e.g. when the watch is managed elsewhere).
+        watch_label_ids (list[str]): Only changes to these labels are published.
+        poll_interval (float): Seconds between cycles when no notification arrives.
+        dry_run (bool): Print planned label changes instead of applying them.
+        full_text (bool): Answer word-style `contains` conditions through the FTS5 index.
+        message_format (str): "full", or "metadata" to sync headers only; bodies are
+            then loaded only when a rule reads them.
+        cache (MessageCache | None): Raw message cache for bodies loaded on demand.
+        rate_limiter (TokenBucket | None): Extra quota bucket charged before every modify call,
+            on top of the process-wide `gmail_api.SCHEDULER`.
+        http_factory (callable | None): Returns the HTTP object for the calling thread.
+        client (GmailClient | None): If given, every cycle takes the service from it, which
+            refreshes the access token ahead of its expiry.
+        clock (callable): Monotonic time source, replaceable in tests.
+    """
+
+    def __init__(self, service, db, rules_path, label_registry, source=None, topic=None,
+                 watch_label_ids=("INBOX",), poll_interval=DEFAULT_POLL_SECONDS, dry_run=False,
+                 full_text=False, message_format="full", cache=None, rate_limiter=None, http_factory=None,
+                 client=None, clock=time.monotonic):
+        self.service = service
+        self.db = db
+        self.rules_path = rules_path
+        self.label_registry = label_registry
+        self.source = source
+        self.topic = topic
+        self.watch_label_ids = list(watch_label_ids)
+        self.poll_interval = poll_interval
+        self.dry_run = dry_run
+        self.full_text = full_text
+        self.message_format = message_format
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.http_factory = http_factory
+        self.client = client
+        self.clock = clock
+        self.watch_renewed_at = None
+        self.cycles = 0
+
+    def renew_watch(self):
+        """Starts or renews the `users.watch` publishing mailbox changes to `topic`."""
+        response = execute_with_retry(self.service.users().watch(userId="me", body={
+            "topicName": self.topic, "labelIds": self.watch_label_ids, "labelFilterBehavior": "include",
+        }), method="users.watch")
+        self.watch_renewed_at = self.clock()
+        logging.info(f"Gmail watch on {self.topic} active until {response.get('expiration')}")
+        return response
+
+    def run_cycle(self):
+        """
+        Syncs the mailbox and applies the rules to the messages that were added.
+
+        After a full resync every stored message may be new, so the rules are
+        applied to all of them. Rule actions are sent at "new_mail" priority, ahead
+        of any backfill running in the same process.
+
+        Returns:
+            dict: The sync summary (see `history_sync.sync_mailbox`).
+        """
+        self.cycles += 1
+        if self.client is not None:
+            self.service = self.client.service()
+        summary = sync_mailbox(self.service, self.db, message_format=self.message_format)
+        program = load_rule_program(self.rules_path)
+        self.label_registry.start_run()
+        with api_priority("new_mail"):
+            report = apply_rules(self.service, program, self.label_registry, email_ids=summary["added_ids"],
+                                 dry_run=self.dry_run, full_text=self.full_text, cache=self.cache,
+                                 rate_limiter=self.rate_limiter, http_factory=self.http_factory)
+        if not report.ok:
+            logging.warning(format_report(report))
+        logging.info(
+            f"Cycle {self.cycles}: {summary['added']} added, {summary['deleted']} deleted, "
+            f"{summary['relabeled']} relabeled.")
+        return summary
+
+    def _is_news(self, notifications):
+        """True unless every notification is already covered by the stored historyId."""
+        if not notifications:
+            return False
+        stored = get_sync_state(HISTORY_ID_KEY)
+        if stored is None:
+            return True
+        return any(int(notification["historyId"]) > int(stored) for notification in notifications)
+
+    def _wait(self, timeout, stop_event):
+        if self.source is None:
+            stop_event.wait(timeout)
+            return []
+        return self.source.wait(timeout)
+
+    def run(self, stop_event=None, max_cycles=None):
+        """
+        Runs cycles until `stop_event` is set (or `max_cycles` cycles have run).
+
+        A cycle runs immediately to catch up with changes made while the daemon
+        was down. Errors in a cycle are logged and retried on the next one. Errors
+        while waiting for notifications (e.g. a failed Pub/Sub pull) are logged and
+        the wait is retried after a backoff, without waiting past the next poll.
+        """
+        stop_event = stop_event or threading.Event()
+        next_poll = self.clock()
+        notifications = []
+        wait_failures = 0
+
+        while not stop_event.is_set() and (max_cycles is None or self.cycles < max_cycles):
+            try:
+                if self.topic and (self.watch_renewed_at is None
+                                   or self.clock() - self.watch_renewed_at >= WATCH_RENEW_SECONDS):
+                    self.renew_watch()
+                if self.clock() >= next_poll or self._is_news(notifications):
+                    self.run_cycle()
+                    next_poll = self.clock() + self.poll_interval
+                elif notifications:
+                    logging.debug(f"Skipping {len(notifications)} notifications already synced")
+            except Exception as e:
+                logging.error(f"Daemon cycle failed: {e}")
+                next_poll = self.clock() + self.poll_interval
+
+            if stop_event.is_set() or (max_cycles is not None and self.cycles >= max_cycles):
+                break
+            try:
+                notifications = self._wait(max(0.0, next_poll - self.clock()), stop_event)
+                wait_failures = 0
+            except Exception as e:
+                logging.error(f"Waiting for notifications failed: {e}")
+                notifications = []
+                stop_event.wait(min(backoff_delay(wait_failures), max(0.0, next_poll - self.clock())))
+                wait_failures += 1
+
+
+def run_daemon(rules_path, testing=False, topic=None, subscription=None, push_port=None, push_token=None,
+               poll_interval=DEFAULT_POLL_SECONDS, dry_run=False, full_text=False, message_format="full",
+               cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Runs the mail daemon until interrupted.
+
+    Args:
+        rules_path (str): Path to rules.json.
+        testing (bool): If True, uses a test database.
+        topic (str | None): Pub/Sub topic Gmail publishes mailbox changes to.
+        subscription (str | None): Pull subscription to read notifications from.
+        push_port (int | None): Port of a local endpoint for a push subscription.
+        push_token (str | None): Token the push endpoint URL must carry.
+        poll_interval (float): Seconds between syncs without notifications.
+        dry_run (bool): Print planned label changes instead of applying them.
+        full_text (bool): Answer word-style `contains` conditions through the FTS5 index.
+        message_format (str): "full", or "metadata" to sync headers only.
+        cache_dir (str): Directory of the raw message cache.
+
+    What this function does:
+    - Initialize the database and authenticate with Gmail API once.
+    - Start the Gmail watch and the pull or push notification source, if configured.
+    - Sync and apply the rules to new messages on every notification and every poll interval.
+    - Close the database connection on exit.
+    """
+    db = get_or_initialize_db(testing=testing)
+    server = None
+    try:
+        client = get_gmail_client()
+        service = client.service()
+        label_registry = LabelRegistry(service, cache_path=LABEL_CACHE_PATH)
+
+        source = None
+        if subscription:
+            import google.auth
+            from googleapiclient.discovery import build
+
+            pubsub_creds, _ = google.auth.default(scopes=PUBSUB_SCOPES)
+            source = PubSubPullSource(build("pubsub", "v1", credentials=pubsub_creds), subscription)
+        elif push_port:
+            source = QueueNotificationSource()
+            server = start_push_server(source, port=push_port, token=push_token)
+
+        daemon = MailDaemon(service, db, rules_path, label_registry, source=source, topic=topic,
+                            poll_interval=poll_interval, dry_run=dry_run, full_text=full_text,
+                            message_format=message_format, cache=MessageCache(cache_dir),
+                            http_factory=client.http, client=client)
+        daemon.run()
+    except KeyboardInterrupt:
+        logging.info("Daemon stopped.")
+    finally:
+        if server is not None:
+            server.shutdown()
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync Gmail and apply rules.json continuously.")
+    parser.add_argument("--rules", default="rules.json", help="Path to the rules file.")
+    parser.add_argument("--topic", help="Pub/Sub topic for Gmail notifications, "
+                                        "e.g. projects/my-project/topics/gmail.")
+    source_group = parser.add_mutually_exclusive_group()
+    source_group.add_argument("--subscription", help="Pull notifications from this Pub/Sub subscription.")
+    source_group.add_argument("--push-port", type=int, help="Receive push notifications on this port.")
+    parser.add_argument("--push-token", help="Token required in the push endpoint URL.")
+    parser.add_argument("--interval", type=float, default=DEFAULT_POLL_SECONDS,
+                        help="Seconds between syncs when no notification arrives.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Print the planned label changes without applying them.")
+    parser.add_argument("--fts", action="store_true",
+                        help="Answer word-style contains conditions through the full-text index.")
+    parser.add_argument("--metadata", action="store_true",
+                        help="Sync headers only and download bodies when a rule needs them.")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Raw message cache directory.")
+    args = parser.parse_args()
+
+    run_daemon(args.rules, topic=args.topic, subscription=args.subscription, push_port=args.push_port,
+               push_token=args.push_token, poll_interval=args.interval, dry_run=args.dry_run,
+               full_text=args.fts, message_format="metadata" if args.metadata else "full",
+               cache_dir=args.cache_dir)
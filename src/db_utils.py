@@ -1,6 +1,20 @@
+import operator
+import sqlite3
+import zlib
+from datetime import datetime
+from functools import reduce
+
 from peewee import (
-    SqliteDatabase, Model, CharField, TextField, DateTimeField, DatabaseProxy
+    SqliteDatabase, Model, CharField, TextField, DateTimeField, BlobField, CompositeKey, DatabaseProxy,
+    Expression, JOIN, OP, SQL, fn
 )
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional; bodies fall back to zlib
+    zstandard = None
 
 db_proxy = DatabaseProxy()
 
@@ -10,15 +24,312 @@ class BaseModel(Model):
         database = db_proxy
 
 
+# Generated columns (`Email.sender_domain`) need SQLite 3.31.
+MIN_SQLITE_VERSION = (3, 31, 0)
+
+# Lowercase domain of the sender address, computed by SQLite so it can never drift.
+SENDER_DOMAIN_SQL = (
+    "GENERATED ALWAYS AS (CASE WHEN instr(sender, '@') > 0 "
+    "THEN lower(rtrim(substr(sender, instr(sender, '@') + 1), '> ')) ELSE '' END) VIRTUAL"
+)
+
+
+def sender_domain_of(sender):
+    """Python twin of the `sender_domain` generated column."""
+    if not sender or "@" not in sender:
+        return ""
+    return sender[sender.index("@") + 1:].rstrip("> ").lower()
+
+
+# Email bodies are stored compressed in their own table. Each blob starts with one
+# byte naming its codec, so databases written with and without zstd stay readable.
+BODY_RAW = b"\x00"
+BODY_ZLIB = b"\x01"
+BODY_ZSTD = b"\x02"
+BODY_CODEC = "zstd" if zstandard else "zlib"
+MIN_COMPRESSED_BODY_SIZE = 64  # Smaller bodies do not shrink enough to pay for the codec
+
+
+def encode_body(text, codec=None):
+    """
+    Encodes a body for the `EmailBody` table: UTF-8, compressed unless it is tiny
+    or does not compress.
+
+    Args:
+        text (str | None): Decoded plain-text body.
+        codec (str | None): "zlib" or "zstd". Defaults to `BODY_CODEC`.
+
+    Returns:
+        bytes: Codec tag byte followed by the payload.
+    """
+    data = (text or "").encode("utf-8")
+    if len(data) < MIN_COMPRESSED_BODY_SIZE:
+        return BODY_RAW + data
+    codec = codec or BODY_CODEC
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("The zstandard package is not installed")
+        packed = BODY_ZSTD + zstandard.ZstdCompressor().compress(data)
+    else:
+        packed = BODY_ZLIB + zlib.compress(data)
+    return packed if len(packed) <= len(data) else BODY_RAW + data
+
+
+def decode_body(data):
+    """Returns the text of a blob written by `encode_body`; None decodes to ""."""
+    if not data:
+        return ""
+    data = bytes(data)
+    tag, payload = data[:1], data[1:]
+    if tag == BODY_ZLIB:
+        payload = zlib.decompress(payload)
+    elif tag == BODY_ZSTD:
+        if zstandard is None:
+            raise ValueError("Body is zstd-compressed but the zstandard package is not installed")
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    elif tag != BODY_RAW:
+        raise ValueError(f"Unknown body codec tag {tag!r}")
+    return payload.decode("utf-8")
+
+
 class Email(BaseModel):
     id = CharField(primary_key=True)
-    sender = CharField()
+    sender = CharField(index=True)
     subject = CharField()
-    body = TextField()
-    received_at = DateTimeField()
+    received_at = DateTimeField(index=True)
+    labels = TextField(default="")  # Comma-separated Gmail label IDs
+    sender_domain = CharField(null=True, index=True, constraints=[SQL(SENDER_DOMAIN_SQL)])
+
+    class Meta:
+        # Never write the generated sender_domain column back on save()
+        only_save_dirty = True
+
+    @property
+    def label_ids(self):
+        return [label for label in self.labels.split(",") if label]
+
+    @property
+    def body(self):
+        """The plain-text body, loaded from `EmailBody` on first access."""
+        if "_body" not in self.__dict__:
+            stored = EmailBody.get_or_none(EmailBody.email_id == self.id)
+            self.__dict__["_body"] = decode_body(stored.data) if stored else ""
+            self.__dict__["_body_dirty"] = False
+        return self.__dict__["_body"]
 
+    @body.setter
+    def body(self, text):
+        self.__dict__["_body"] = text
+        self.__dict__["_body_dirty"] = True
 
-def get_or_initialize_db(testing=False):
+    def save(self, *args, **kwargs):
+        """Saves the row and, if it was assigned, the compressed body with it."""
+        with self._meta.database.atomic():
+            rows = super().save(*args, **kwargs)
+            if self.__dict__.get("_body_dirty"):
+                data = encode_body(self._body)
+                # An upsert, not REPLACE, so the FTS update trigger sees the change
+                EmailBody.insert(email_id=self.id, data=data).on_conflict(
+                    conflict_target=[EmailBody.email_id], update={EmailBody.data: data}).execute()
+                self.__dict__["_body_dirty"] = False
+        return rows
+
+
+class EmailBody(BaseModel):
+    """
+    Compressed plain-text body of an `Email`, kept out of the main table so rule
+    scans that never look at bodies do not read them. Use `decode_body`, or the
+    `body_text(data)` SQL function, to get the text back.
+    """
+    email_id = CharField(primary_key=True)
+    data = BlobField()
+
+
+class SyncState(BaseModel):
+    """Key/value checkpoints that let long-running syncs resume after a crash."""
+    key = CharField(primary_key=True)
+    value = TextField()
+
+
+class AppliedAction(BaseModel):
+    """
+    Journal of the rule actions already applied to an email, so later runs skip them.
+
+    Keyed by rule hash first, so the emails a rule has already handled are one index range.
+    """
+    rule_hash = CharField()
+    action = CharField()
+    email_id = CharField()
+    applied_at = DateTimeField()
+
+    class Meta:
+        primary_key = CompositeKey("rule_hash", "action", "email_id")
+        # Lets the delete trigger find the entries of an email without a scan
+        indexes = ((("email_id",), False),)
+
+
+class ActiveRule(BaseModel):
+    """
+    A rule whose matches are kept in `RuleMatch` (see `match_store`). Only the parts
+    needed to evaluate it are stored: conditions as JSON [[field, predicate, value], ...].
+    """
+    rule_hash = CharField(primary_key=True)
+    predicate = CharField()
+    conditions = TextField()
+    activated_at = DateTimeField()
+
+
+class RuleMatch(BaseModel):
+    """
+    Precomputed match of an email by an active rule, valid while valid_from < now < valid_until.
+
+    Rules without date conditions match forever (the bounds are `OPEN_START` and
+    `OPEN_END`). Keyed by rule hash and `valid_until`, so a read at time `now` never
+    touches the matches that have already expired.
+    """
+    rule_hash = CharField()
+    email_id = CharField()
+    valid_from = DateTimeField()
+    valid_until = DateTimeField()
+
+    class Meta:
+        primary_key = CompositeKey("rule_hash", "email_id", "valid_from")
+        indexes = ((("rule_hash", "valid_until"), False), (("email_id",), False))
+
+
+class PendingRuleMatch(BaseModel):
+    """Emails inserted or changed since the active rules were last evaluated on them."""
+    email_id = CharField(primary_key=True)
+
+
+# Bounds of match windows that are not limited by a date condition.
+OPEN_START = datetime(1, 1, 1)
+OPEN_END = datetime(9999, 12, 31)
+
+
+class EmailFTS(FTS5Model):
+    """
+    Optional FTS5 index over `Email.subject`.
+
+    It is an external-content table: the text lives only in the `email` table and
+    triggers keep the index in sync. Created by `enable_full_text_search`.
+    """
+    rowid = RowIDField()
+    subject = SearchField()
+
+    class Meta:
+        database = db_proxy
+        table_name = "email_fts"
+        options = {"content": Email, "content_rowid": "rowid"}
+
+
+class EmailBodyFTS(FTS5Model):
+    """
+    Optional FTS5 index over the email bodies, keyed by the `EmailBody` rowid.
+
+    Bodies are only stored compressed, so this is a contentless table fed by
+    triggers that decompress through `body_text`. Created by `enable_full_text_search`.
+    """
+    rowid = RowIDField()
+    body = SearchField()
+
+    class Meta:
+        database = db_proxy
+        table_name = "email_body_fts"
+        options = {"content": "''"}
+
+
+FULL_TEXT_FIELDS = ("subject", "body")
+
+FTS_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS email_fts_after_insert AFTER INSERT ON email BEGIN
+        INSERT INTO email_fts(rowid, subject) VALUES (new.rowid, new.subject);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS email_fts_after_delete AFTER DELETE ON email BEGIN
+        INSERT INTO email_fts(email_fts, rowid, subject) VALUES ('delete', old.rowid, old.subject);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS email_fts_after_update AFTER UPDATE OF subject ON email BEGIN
+        INSERT INTO email_fts(email_fts, rowid, subject) VALUES ('delete', old.rowid, old.subject);
+        INSERT INTO email_fts(rowid, subject) VALUES (new.rowid, new.subject);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS email_body_fts_after_insert AFTER INSERT ON emailbody BEGIN
+        INSERT INTO email_body_fts(rowid, body) VALUES (new.rowid, body_text(new.data));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS email_body_fts_after_delete AFTER DELETE ON emailbody BEGIN
+        INSERT INTO email_body_fts(email_body_fts, rowid, body) VALUES ('delete', old.rowid, body_text(old.data));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS email_body_fts_after_update AFTER UPDATE OF data ON emailbody BEGIN
+        INSERT INTO email_body_fts(email_body_fts, rowid, body) VALUES ('delete', old.rowid, body_text(old.data));
+        INSERT INTO email_body_fts(rowid, body) VALUES (new.rowid, body_text(new.data));
+    END""",
+)
+
+# Deleting an email (e.g. by the history sync) also deletes its body.
+BODY_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS email_delete_body AFTER DELETE ON email BEGIN
+        DELETE FROM emailbody WHERE email_id = old.id;
+    END""",
+)
+
+# ... and its journal entries.
+JOURNAL_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS email_delete_applied_actions AFTER DELETE ON email BEGIN
+        DELETE FROM appliedaction WHERE email_id = old.id;
+    END""",
+)
+
+
+# While rules are active, new and changed emails are queued for evaluation,
+# whichever code path wrote them, and deleted emails lose their matches. (Not
+# INSERT OR IGNORE: the conflict policy of the outer statement, e.g. an upsert,
+# would override it.)
+MATCH_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS email_insert_pending_match AFTER INSERT ON email
+    WHEN EXISTS (SELECT 1 FROM activerule) BEGIN
+        INSERT INTO pendingrulematch (email_id) SELECT new.id
+        WHERE NOT EXISTS (SELECT 1 FROM pendingrulematch WHERE email_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS email_update_pending_match AFTER UPDATE OF sender, subject, received_at ON email
+    WHEN EXISTS (SELECT 1 FROM activerule) BEGIN
+        INSERT INTO pendingrulematch (email_id) SELECT new.id
+        WHERE NOT EXISTS (SELECT 1 FROM pendingrulematch WHERE email_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS emailbody_insert_pending_match AFTER INSERT ON emailbody
+    WHEN EXISTS (SELECT 1 FROM activerule) BEGIN
+        INSERT INTO pendingrulematch (email_id) SELECT new.email_id
+        WHERE NOT EXISTS (SELECT 1 FROM pendingrulematch WHERE email_id = new.email_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS emailbody_update_pending_match AFTER UPDATE OF data ON emailbody
+    WHEN EXISTS (SELECT 1 FROM activerule) BEGIN
+        INSERT INTO pendingrulematch (email_id) SELECT new.email_id
+        WHERE NOT EXISTS (SELECT 1 FROM pendingrulematch WHERE email_id = new.email_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS email_delete_rule_matches AFTER DELETE ON email BEGIN
+        DELETE FROM rulematch WHERE email_id = old.id;
+        DELETE FROM pendingrulematch WHERE email_id = old.id;
+    END""",
+)
+
+
+# Named sets of SQLite pragmas applied when a connection is opened.
+PERFORMANCE_PROFILES = {
+    # SQLite defaults: rollback journal, full fsync on every commit.
+    "safe": {},
+    # WAL lets readers run while the fetcher writes, and only fsyncs at checkpoints.
+    # synchronous=normal is durable against application crashes; a power loss can
+    # roll back the last transactions but never corrupts the database.
+    "performance": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -64 * 1024,  # 64 MiB page cache (negative values are KiB)
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "memory",
+    },
+}
+DEFAULT_PROFILE = "performance"
+
+
+def get_or_initialize_db(testing=False, profile=DEFAULT_PROFILE, db_name=None):
     """
     Initialize and return a database connection. If connection already exists, reuse it.
 
@@ -27,22 +338,382 @@ def get_or_initialize_db(testing=False):
 
     Args:
         testing (bool): Whether to use a test database.
+        profile (str): Name of the pragma set from `PERFORMANCE_PROFILES`.
+        db_name (str | None): Database file to use instead, e.g. one per mailbox.
 
     Returns:
         SqliteDatabase: The initialized database connection.
     """
 
-    db_name = "test_database.db" if testing else "emails.db"
+    if db_name is None:
+        db_name = "test_database.db" if testing else "emails.db"
 
     if db_proxy.obj and isinstance(db_proxy.obj, SqliteDatabase):
         if db_proxy.obj.database == db_name:
             return db_proxy.obj  # Reuse existing DB instance
 
-    db = SqliteDatabase(db_name)
+    return initialize_db(db_name, profile=profile)
+
+
+def initialize_db(db_name, profile=DEFAULT_PROFILE):
+    """
+    Opens `db_name` with the given performance profile, binds the models to it,
+    and creates or upgrades the schema.
+
+    Returns:
+        SqliteDatabase: The initialized database connection.
+
+    Raises:
+        RuntimeError: If the SQLite library is older than `MIN_SQLITE_VERSION`.
+    """
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(f"SQLite {'.'.join(map(str, MIN_SQLITE_VERSION))} or newer is required, "
+                           f"this Python uses SQLite {sqlite3.sqlite_version}")
+    db = SqliteDatabase(db_name, pragmas=PERFORMANCE_PROFILES[profile])
+    # Lets SQL (rule queries, FTS triggers) read the compressed bodies
+    db.register_function(decode_body, "body_text", 1)
     db_proxy.initialize(db)
 
     if db.is_closed():
         db.connect(reuse_if_open=True)
-    db.create_tables([Email], safe=True)
+    migrate_schema(db)
 
     return db
+
+
+def _add_column_if_missing(db, model, field):
+    existing = {column.name for column in db.get_columns(model._meta.table_name)}
+    if field.column_name not in existing:
+        migrator = SqliteMigrator(db)
+        migrate(migrator.add_column(model._meta.table_name, field.column_name, field))
+
+
+def _migration_add_labels(db):
+    _add_column_if_missing(db, Email, Email.labels)
+
+
+def _migration_add_indexes(db):
+    _add_column_if_missing(db, Email, Email.sender_domain)
+    Email._schema.create_indexes(safe=True)
+
+
+def _create_body_table(db):
+    db.create_tables([EmailBody], safe=True)
+    for trigger in BODY_TRIGGERS:
+        db.execute_sql(trigger)
+
+
+def _drop_email_body_column(db):
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        db.execute_sql("ALTER TABLE email DROP COLUMN body")
+        return
+    # Older SQLite has no DROP COLUMN: copy the other columns into a new table
+    columns = ", ".join(f'"{field.column_name}"' for field in Email._meta.sorted_fields
+                        if field is not Email.sender_domain)
+    db.execute_sql("ALTER TABLE email RENAME TO email_with_body")
+    Email._schema.create_table(safe=False)
+    db.execute_sql(f"INSERT INTO email ({columns}) SELECT {columns} FROM email_with_body")
+    # Dropping the old table drops its indexes and triggers, which are then created on the new one
+    db.execute_sql("DROP TABLE email_with_body")
+    Email._schema.create_indexes(safe=True)
+    for trigger in BODY_TRIGGERS:
+        db.execute_sql(trigger)
+
+
+def _migration_compress_bodies(db, batch_size=1000):
+    # The old FTS index covered email.body, so it is dropped and rebuilt in the new layout.
+    had_full_text = full_text_search_enabled(db)
+    for event in ("insert", "delete", "update"):
+        db.execute_sql(f"DROP TRIGGER IF EXISTS email_fts_after_{event}")
+    db.execute_sql(f"DROP TABLE IF EXISTS {EmailFTS._meta.table_name}")
+
+    _create_body_table(db)
+    if "body" in {column.name for column in db.get_columns(Email._meta.table_name)}:
+        cursor = db.execute_sql("SELECT id, body FROM email")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            EmailBody.insert_many([(email_id, encode_body(body)) for email_id, body in rows],
+                                  fields=[EmailBody.email_id, EmailBody.data]).on_conflict_ignore().execute()
+        _drop_email_body_column(db)
+
+    if had_full_text:
+        enable_full_text_search(db)
+
+
+def _create_journal_table(db):
+    db.create_tables([AppliedAction], safe=True)
+    for trigger in JOURNAL_TRIGGERS:
+        db.execute_sql(trigger)
+
+
+def _create_match_tables(db):
+    db.create_tables([ActiveRule, RuleMatch, PendingRuleMatch], safe=True)
+    for trigger in MATCH_TRIGGERS:
+        db.execute_sql(trigger)
+
+
+# Ordered schema migrations. The applied version is stored in PRAGMA user_version.
+MIGRATIONS = [
+    (1, "Store Gmail label IDs", _migration_add_labels),
+    (2, "Index sender and received_at, add indexed sender_domain", _migration_add_indexes),
+    (3, "Move bodies to the compressed emailbody table", _migration_compress_bodies),
+    (4, "Journal of applied rule actions", _create_journal_table),
+    (5, "Precomputed rule matches", _create_match_tables),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(db):
+    return db.pragma("user_version")
+
+
+def migrate_schema(db):
+    """
+    Creates missing tables and upgrades an existing database in place.
+
+    A new database is created at the latest schema version. An existing one gets
+    every migration newer than its `user_version` applied, each in its own
+    transaction, so an interrupted upgrade resumes at the failed step.
+
+    Returns:
+        list[int]: Versions of the migrations that were applied.
+    """
+    if Email._meta.table_name not in db.get_tables():
+        db.create_tables([Email, SyncState], safe=True)
+        _create_body_table(db)
+        _create_journal_table(db)
+        _create_match_tables(db)
+        db.pragma("user_version", SCHEMA_VERSION)
+        return []
+
+    # The email table itself is only changed by migrations: creating its indexes
+    # before their columns exist would silently index a string literal instead.
+    db.create_tables([SyncState], safe=True)
+
+    applied = []
+    current = get_schema_version(db)
+    for version, description, apply in MIGRATIONS:
+        if version <= current:
+            continue
+        with db.atomic():
+            apply(db)
+            db.pragma("user_version", version)
+        applied.append(version)
+    return applied
+
+
+def full_text_search_enabled(db):
+    """Returns True if the FTS5 index has been created in this database."""
+    return EmailFTS._meta.table_name in db.get_tables()
+
+
+def enable_full_text_search(db):
+    """
+    Creates the FTS5 indexes and their sync triggers, then builds them from the stored emails.
+
+    Safe to run on existing databases and to run more than once. The indexes are keyed
+    by rowid, so run `rebuild_full_text_index` after a VACUUM.
+    """
+    with db.atomic():
+        EmailFTS.create_table(safe=True)
+        EmailBodyFTS.create_table(safe=True)
+        for trigger in FTS_TRIGGERS:
+            db.execute_sql(trigger)
+    rebuild_full_text_index()
+
+
+def rebuild_full_text_index():
+    """Rebuilds the FTS5 indexes from the `email` and `emailbody` tables."""
+    EmailFTS.rebuild()
+    # A contentless index cannot re-read its source, so it is cleared and refilled.
+    db = EmailBodyFTS._meta.database
+    with db.atomic():
+        db.execute_sql("INSERT INTO email_body_fts(email_body_fts) VALUES ('delete-all')")
+        db.execute_sql("INSERT INTO email_body_fts(rowid, body) SELECT rowid, body_text(data) FROM emailbody")
+
+
+def full_text_expression(field, query):
+    """
+    Returns a WHERE expression selecting emails whose `field` matches an FTS5 query.
+
+    Args:
+        field (str): "subject" or "body".
+        query (str): FTS5 query syntax, e.g. 'invoice AND NOT "payment received"'.
+    """
+    if field not in FULL_TEXT_FIELDS:
+        raise ValueError(f"Field {field!r} is not full-text indexed")
+    if field == "body":
+        matching = EmailBodyFTS.select(EmailBodyFTS.rowid).where(EmailBodyFTS.match(query))
+        owners = EmailBody.select(EmailBody.email_id).where(Expression(SQL("rowid"), OP.IN, matching))
+        return Email.id.in_(owners)
+    matching = EmailFTS.select(EmailFTS.rowid).where(EmailFTS.match(f"{field} : ({query})"))
+    return Expression(SQL("rowid"), OP.IN, matching)
+
+
+def body_expression(predicate, value):
+    """
+    Returns a WHERE expression on `Email` for a string predicate on the body.
+
+    The body is decompressed by SQLite through `body_text`, and only for this
+    condition: the main `email` rows never carry it.
+    """
+    text = fn.body_text(EmailBody.data)
+    positive = text.contains(value) if predicate in ("contains", "not_contains") else text == value
+    owners = EmailBody.select(EmailBody.email_id).where(positive)
+    if predicate in ("contains", "equals"):
+        return Email.id.in_(owners)
+    return Email.id.not_in(owners)
+
+
+# How `insert_emails` treats rows whose ID is already stored.
+CONFLICT_MODES = ("ignore", "upsert")
+
+# Columns an upsert refreshes; a row is only rewritten if one of them changed.
+UPSERT_FIELDS = (Email.sender, Email.subject, Email.received_at, Email.labels)
+
+
+def max_variables(db=None):
+    """
+    Returns how many bound parameters one SQLite statement may have.
+
+    Read from the connection where Python exposes it (3.11+), otherwise the
+    compiled-in default of the SQLite version: 32766 since 3.32, 999 before.
+    """
+    connection = (db or db_proxy).connection()
+    if hasattr(connection, "getlimit"):
+        return connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    return 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+
+
+def insert_emails(rows, on_conflict="ignore"):
+    """
+    Inserts parsed email rows and their compressed bodies, in one transaction.
+
+    Rows are written with as many rows per statement as SQLite's parameter
+    limit allows (see `max_variables`). Rows without a "body" key (metadata-only
+    fetches) get no `EmailBody` row, which marks their body as not downloaded yet
+    (see `emails_missing_bodies`).
+
+    Args:
+        rows (list[dict]): Rows as returned by `gmail_mail_fetch.parse_message`.
+        on_conflict (str): "ignore" keeps stored emails as they are; "upsert" updates
+            the sender, subject, date, labels and body of stored emails that changed.
+
+    Returns:
+        int: Number of `Email` rows actually inserted, or with "upsert", inserted or changed.
+    """
+    if on_conflict not in CONFLICT_MODES:
+        raise ValueError(f"on_conflict must be one of {CONFLICT_MODES}, got {on_conflict!r}")
+    if not rows:
+        return 0
+    emails = [{key: value for key, value in row.items() if key != "body"} for row in rows]
+    bodies = [(row["id"], encode_body(row["body"])) for row in rows if "body" in row]
+    limit = max_variables()
+    email_chunk = max(1, limit // len(emails[0]))
+    body_chunk = limit // 2
+
+    written = 0
+    with db_proxy.atomic():
+        for start in range(0, len(emails), email_chunk):
+            insert = Email.insert_many(emails[start:start + email_chunk])
+            if on_conflict == "upsert":
+                # Unchanged rows are left alone, so they do not fire the FTS and rule-match triggers
+                changed = reduce(operator.or_, (field != SQL(f"excluded.{field.column_name}")
+                                                for field in UPSERT_FIELDS))
+                insert = insert.on_conflict(conflict_target=[Email.id], preserve=list(UPSERT_FIELDS), where=changed)
+            else:
+                insert = insert.on_conflict_ignore()
+            written += insert.as_rowcount().execute()
+        for start in range(0, len(bodies), body_chunk):
+            insert = EmailBody.insert_many(bodies[start:start + body_chunk], fields=[EmailBody.email_id, EmailBody.data])
+            if on_conflict == "upsert":
+                insert = insert.on_conflict(conflict_target=[EmailBody.email_id], preserve=[EmailBody.data],
+                                            where=(EmailBody.data != SQL("excluded.data")))
+            else:
+                insert = insert.on_conflict_ignore()
+            insert.execute()
+    return written
+
+
+def store_bodies(bodies):
+    """
+    Stores or replaces the bodies of existing emails.
+
+    Args:
+        bodies (dict[str, str]): Plain-text body by email ID.
+    """
+    rows = [(email_id, encode_body(text)) for email_id, text in bodies.items()]
+    for start in range(0, len(rows), 500):
+        # An upsert, not REPLACE, so the FTS update trigger sees the change
+        EmailBody.insert_many(rows[start:start + 500], fields=[EmailBody.email_id, EmailBody.data]).on_conflict(
+            conflict_target=[EmailBody.email_id], update={EmailBody.data: SQL("excluded.data")}).execute()
+
+
+def emails_missing_bodies(email_ids=None):
+    """
+    Returns the IDs of stored emails whose body was not downloaded yet.
+
+    Args:
+        email_ids (Iterable[str] | None): Only consider these emails. Defaults to all.
+    """
+    query = (Email.select(Email.id).join(EmailBody, JOIN.LEFT_OUTER, on=(EmailBody.email_id == Email.id))
+             .where(EmailBody.email_id.is_null()))
+    if email_ids is None:
+        return [email_id for (email_id,) in query.tuples()]
+    email_ids = list(email_ids)
+    missing = []
+    for start in range(0, len(email_ids), 500):
+        chunk = query.where(Email.id.in_(email_ids[start:start + 500]))
+        missing += [email_id for (email_id,) in chunk.tuples()]
+    return missing
+
+
+def filter_new_email_ids(message_ids):
+    """
+    Returns the IDs from `message_ids` that are not stored in the `Email` table yet.
+
+    Uses one primary-key lookup per call, so callers should pass one listed page
+    (at most 500 IDs) at a time. The input order is preserved.
+    """
+    if not message_ids:
+        return []
+    query = Email.select(Email.id).where(Email.id.in_(list(message_ids)))
+    existing = {email_id for (email_id,) in query.tuples()}
+    return [message_id for message_id in message_ids if message_id not in existing]
+
+
+def get_sync_state(key, default=None):
+    """
+    Returns the stored checkpoint value for `key`, or `default` if none is stored.
+    """
+    state = SyncState.get_or_none(SyncState.key == key)
+    return state.value if state else default
+
+
+def set_sync_state(key, value):
+    """
+    Stores a checkpoint value for `key`. Passing None removes the checkpoint.
+    """
+    if value is None:
+        SyncState.delete().where(SyncState.key == key).execute()
+    else:
+        SyncState.replace(key=key, value=str(value)).execute()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Database maintenance commands.")
+    parser.add_argument("command", choices=["enable-fts", "rebuild-fts"],
+                        help="enable-fts creates and builds the full-text index, "
+                             "rebuild-fts rebuilds an existing one.")
+    args = parser.parse_args()
+
+    database = get_or_initialize_db()
+    if args.command == "enable-fts":
+        enable_full_text_search(database)
+    else:
+        rebuild_full_text_index()
+    database.close()
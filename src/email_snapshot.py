@@ -0,0 +1,406 @@
+"""
+Columnar snapshot of the email store for bulk analytics and what-if rule runs.
+
+A snapshot is a directory of flat little-endian arrays in the Arrow memory
+layout, which NumPy memory-maps as is (`numpy.memmap`), so a scan never builds
+one model object per row:
+
+- `received_at.i8`: microseconds since 1970-01-01, naive like the stored dates.
+- `id.offsets.i8` / `id.data`: UTF-8 message IDs, row i spanning
+  data[offsets[i]:offsets[i + 1]].
+- `<field>.codes.i4` with `<field>.dict.offsets.i8` / `<field>.dict.data` for
+  sender, sender_domain, subject and labels: dictionary encoded, every row
+  holding the position of its value in the dictionary of distinct values.
+- `body.offsets.i8` / `body.data`: plain-text bodies, only if exported with bodies.
+- `meta.json`: row count, byte size of every file and the watermark.
+
+An update appends the emails received since the watermark, the latest exported
+received_at. Emails changed or deleted after they were exported, and older mail
+stored later (e.g. by a backfill), are only picked up by a full export.
+
+`evaluate_snapshot` evaluates a rule program column by column. With NumPy every
+condition except body conditions is vectorized: date conditions compare the
+received_at array, and string conditions are evaluated once per distinct value
+and mapped to the rows through their codes. Without NumPy the same files are
+read with the `array` module and evaluated in plain Python.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from array import array
+from datetime import datetime, timedelta
+
+from peewee import JOIN, fn
+
+from db_utils import Email, EmailBody, get_or_initialize_db
+from rule_compiler import load_rule_program
+from metrics import increment, stage, add_arguments, instrumented
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional; snapshots are then read and evaluated in plain Python
+    numpy = None
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+SNAPSHOT_VERSION = 1
+DEFAULT_SNAPSHOT_DIR = "snapshot"
+META_FILE = "meta.json"
+DICTIONARY_FIELDS = ("sender", "sender_domain", "subject", "labels")
+EXPORT_CHUNK_SIZE = 10000
+EPOCH = datetime(1970, 1, 1)
+_INT_DTYPES = {"q": "<i8", "i": "<i4"}
+
+
+def to_micros(value):
+    """Converts a stored received_at to the microseconds of the `received_at.i8` column."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def read_meta(directory):
+    """Returns the parsed meta.json of a snapshot, or None if there is no snapshot in `directory`."""
+    try:
+        with open(os.path.join(directory, META_FILE)) as meta_file:
+            return json.load(meta_file)
+    except FileNotFoundError:
+        return None
+
+
+def _write_meta(directory, meta):
+    path = os.path.join(directory, META_FILE)
+    with open(path + ".tmp", "w") as meta_file:
+        json.dump(meta, meta_file, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def _int_bytes(typecode, values):
+    packed = array(typecode, values)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+class _Appender:
+    """
+    Appends rows to the files of a snapshot.
+
+    Every file is first cut back to the size recorded in meta.json, so the tail
+    of an interrupted update is overwritten instead of read as rows.
+    """
+
+    def __init__(self, directory, meta):
+        self.directory = directory
+        self.sizes = dict(meta["sizes"])
+        self.handles = {}
+        self.dictionaries = {field: {value: code for code, value in enumerate(
+            _read_strings(directory, f"{field}.dict", meta["dictionary_sizes"].get(field, 0)))}
+            for field in DICTIONARY_FIELDS}
+
+    def _write(self, name, data):
+        handle = self.handles.get(name)
+        if handle is None:
+            handle = open(os.path.join(self.directory, name), "ab")
+            handle.truncate(self.sizes.get(name, 0))
+            self.handles[name] = handle
+        handle.write(data)
+        self.sizes[name] = self.sizes.get(name, 0) + len(data)
+
+    def _write_strings(self, prefix, values):
+        offsets_name, data_name = f"{prefix}.offsets.i8", f"{prefix}.data"
+        offset = self.sizes.get(data_name, 0)
+        offsets = [] if self.sizes.get(offsets_name) else [0]
+        data = bytearray()
+        for value in values:
+            data += (value or "").encode("utf-8")
+            offsets.append(offset + len(data))
+        self._write(offsets_name, _int_bytes("q", offsets))
+        self._write(data_name, bytes(data))
+
+    def append(self, rows, bodies):
+        """Appends (id, received_at, sender, sender_domain, subject, labels[, body]) tuples."""
+        self._write("received_at.i8", _int_bytes("q", [to_micros(row[1]) for row in rows]))
+        self._write_strings("id", [row[0] for row in rows])
+        for position, field in enumerate(DICTIONARY_FIELDS, start=2):
+            dictionary = self.dictionaries[field]
+            codes, added = [], []
+            for row in rows:
+                value = row[position] or ""
+                code = dictionary.get(value)
+                if code is None:
+                    code = dictionary[value] = len(dictionary)
+                    added.append(value)
+                codes.append(code)
+            self._write(f"{field}.codes.i4", _int_bytes("i", codes))
+            self._write_strings(f"{field}.dict", added)
+        if bodies:
+            self._write_strings("body", [row[-1] for row in rows])
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+
+
+def export_snapshot(directory=DEFAULT_SNAPSHOT_DIR, full=False, bodies=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Writes the stored emails to a columnar snapshot, or appends the emails received
+    since the watermark of an existing one.
+
+    Args:
+        directory (str): Snapshot directory, created if missing.
+        full (bool): Rewrite the snapshot from scratch instead of updating it.
+        bodies (bool): Include the plain-text bodies (needed by body conditions).
+            A snapshot exported with a different setting is rewritten.
+        chunk_size (int): Rows read and appended at a time.
+
+    Returns:
+        int: Number of rows written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    meta = None if full else read_meta(directory)
+    if meta is not None and (meta["version"] != SNAPSHOT_VERSION or meta["bodies"] != bodies):
+        logging.info(f"Snapshot in {directory} was written with other settings, rewriting it")
+        meta = None
+    if meta is None:
+        # Without meta.json a half-written snapshot is never read
+        if os.path.exists(os.path.join(directory, META_FILE)):
+            os.remove(os.path.join(directory, META_FILE))
+        for name in ("body.offsets.i8", "body.data"):
+            if os.path.exists(os.path.join(directory, name)):
+                os.remove(os.path.join(directory, name))
+        meta = {"version": SNAPSHOT_VERSION, "bodies": bodies, "rows": 0, "sizes": {}, "dictionary_sizes": {},
+                "watermark": None, "watermark_ids": []}
+
+    columns = [Email.id, Email.received_at] + [getattr(Email, field) for field in DICTIONARY_FIELDS]
+    if bodies:
+        columns.append(fn.body_text(EmailBody.data))
+    select = Email.select(*columns)
+    if bodies:
+        select = select.join(EmailBody, JOIN.LEFT_OUTER, on=(EmailBody.email_id == Email.id))
+    watermark = datetime.fromisoformat(meta["watermark"]) if meta["watermark"] else None
+    watermark_ids = set(meta["watermark_ids"])
+    if watermark is not None:
+        select = select.where(Email.received_at >= watermark)
+
+    appender = _Appender(directory, meta)
+    written = 0
+    chunk = []
+    try:
+        with stage("export"):
+            for row in select.order_by(Email.received_at, Email.id).tuples().iterator():
+                received_at = row[1]
+                if received_at == watermark and row[0] in watermark_ids:
+                    continue  # Exported by the previous update
+                if received_at != watermark:
+                    watermark, watermark_ids = received_at, set()
+                watermark_ids.add(row[0])
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    appender.append(chunk, bodies)
+                    written += len(chunk)
+                    chunk = []
+            if chunk:
+                appender.append(chunk, bodies)
+                written += len(chunk)
+    finally:
+        appender.close()
+
+    meta.update(rows=meta["rows"] + written, sizes=appender.sizes,
+                dictionary_sizes={field: len(values) for field, values in appender.dictionaries.items()},
+                watermark=watermark.isoformat(sep=" ") if watermark else None,
+                watermark_ids=sorted(watermark_ids))
+    _write_meta(directory, meta)
+    increment("snapshot_rows", written)
+    logging.info(f"Wrote {written} rows to the snapshot in {directory} ({meta['rows']} rows in total)")
+    return written
+
+
+def _read_ints(path, typecode, count):
+    """Memory-maps an integer column with NumPy, or reads it into an `array` without."""
+    if numpy is not None:
+        if count == 0:
+            return numpy.zeros(0, dtype=_INT_DTYPES[typecode])
+        return numpy.memmap(path, dtype=_INT_DTYPES[typecode], mode="r", shape=(count,))
+    values = array(typecode)
+    if count:
+        with open(path, "rb") as column_file:
+            values.fromfile(column_file, count)
+        if sys.byteorder == "big":
+            values.byteswap()
+    return values
+
+
+def _read_strings(directory, prefix, count):
+    """Decodes the `count` strings of an offsets/data column pair."""
+    if not count:
+        return []
+    offsets = _read_ints(os.path.join(directory, f"{prefix}.offsets.i8"), "q", count + 1)
+    with open(os.path.join(directory, f"{prefix}.data"), "rb") as data_file:
+        data = data_file.read(int(offsets[count]))
+    return [data[offsets[row]:offsets[row + 1]].decode("utf-8") for row in range(count)]
+
+
+class Snapshot:
+    """
+    A snapshot opened for reading.
+
+    The integer columns are memory-mapped with NumPy and read into `array`s
+    without it. Dictionaries and text columns are decoded on first use.
+
+    Args:
+        directory (str): Directory written by `export_snapshot`.
+
+    Raises:
+        FileNotFoundError: If there is no snapshot in `directory`.
+    """
+
+    def __init__(self, directory=DEFAULT_SNAPSHOT_DIR):
+        meta = read_meta(directory)
+        if meta is None:
+            raise FileNotFoundError(f"No snapshot in {directory}; run email_snapshot.py first")
+        self.directory = directory
+        self.meta = meta
+        self.rows = meta["rows"]
+        self.has_bodies = meta["bodies"]
+        self.received_at = _read_ints(os.path.join(directory, "received_at.i8"), "q", self.rows)
+        self.codes = {field: _read_ints(os.path.join(directory, f"{field}.codes.i4"), "i", self.rows)
+                      for field in DICTIONARY_FIELDS}
+        self._dictionaries = {}
+        self._lookups = {}
+        self._texts = {}
+
+    def dictionary(self, field):
+        """Returns the distinct values of a dictionary encoded field, indexed by code."""
+        if field not in self._dictionaries:
+            self._dictionaries[field] = _read_strings(self.directory, f"{field}.dict",
+                                                      self.meta["dictionary_sizes"].get(field, 0))
+        return self._dictionaries[field]
+
+    def code_of(self, field, value):
+        """Returns the code of `value` in the dictionary of `field`, or None if no row has it."""
+        if field not in self._lookups:
+            self._lookups[field] = {text: code for code, text in enumerate(self.dictionary(field))}
+        return self._lookups[field].get(value)
+
+    def texts(self, field):
+        """Returns the values of the "id" or "body" column, one per row."""
+        if field == "body" and not self.has_bodies:
+            raise ValueError("The snapshot was exported without bodies; export it with bodies=True (--bodies)")
+        if field not in self._texts:
+            self._texts[field] = _read_strings(self.directory, field, self.rows)
+        return self._texts[field]
+
+    def ids(self, mask):
+        """Returns the IDs of the rows selected by a mask from `evaluate_snapshot`."""
+        ids = self.texts("id")
+        if numpy is not None:
+            return [ids[row] for row in numpy.flatnonzero(mask)]
+        return [email_id for email_id, selected in zip(ids, mask) if selected]
+
+
+def _take(table, codes):
+    """Maps per-value results to rows through their dictionary codes."""
+    if numpy is not None:
+        return numpy.asarray(table, dtype=bool)[codes]
+    return [table[code] for code in codes]
+
+
+def condition_mask(snapshot, condition, now):
+    """
+    Evaluates one condition over every row of a snapshot, with the semantics of
+    `Condition.matches`.
+
+    Returns:
+        numpy.ndarray | list[bool]: One flag per row.
+
+    Raises:
+        ValueError: For body conditions on a snapshot exported without bodies.
+    """
+    if condition.is_date:
+        cutoff = to_micros(condition.compare_date(now))
+        column = snapshot.received_at
+        if numpy is not None:
+            return column > cutoff if condition.predicate == "less_than" else column < cutoff
+        if condition.predicate == "less_than":
+            return [value > cutoff for value in column]
+        return [value < cutoff for value in column]
+
+    if condition.field in DICTIONARY_FIELDS:
+        values = snapshot.dictionary(condition.field)
+        if condition.predicate in ("equals", "not_equals"):
+            table = [condition.predicate == "not_equals"] * len(values)
+            code = snapshot.code_of(condition.field, condition.value)
+            if code is not None:
+                table[code] = not table[code]
+        else:
+            table = [condition.matches({condition.field: value}, now) for value in values]
+        return _take(table, snapshot.codes[condition.field])
+
+    flags = [condition.matches({condition.field: text}, now) for text in snapshot.texts(condition.field)]
+    return numpy.asarray(flags, dtype=bool) if numpy is not None else flags
+
+
+def evaluate_snapshot(program, snapshot, now=None):
+    """
+    Evaluates every rule of a compiled program over a snapshot.
+
+    Gives the same matches as `rule_engine.evaluate_rules` on the exported rows,
+    but column by column; a condition used by several rules is evaluated once.
+
+    Args:
+        program (RuleProgram): Compiled rules.
+        snapshot (Snapshot): Opened snapshot.
+        now (datetime | None): Reference time for relative date conditions.
+
+    Returns:
+        dict[int, numpy.ndarray | list[bool]]: Row mask per rule index, see `Snapshot.ids`.
+    """
+    now = now or datetime.now()
+    masks = {}
+    results = {}
+    with stage("simulate"):
+        for rule in program.rules:
+            for condition in rule.conditions:
+                if condition not in masks:
+                    masks[condition] = condition_mask(snapshot, condition, now)
+            flags = [masks[condition] for condition in rule.conditions]
+            if numpy is not None:
+                combine = numpy.logical_and if rule.predicate == "All" else numpy.logical_or
+                results[rule.index] = combine.reduce(flags) if len(flags) > 1 else numpy.asarray(flags[0])
+            else:
+                combine = all if rule.predicate == "All" else any
+                results[rule.index] = [combine(row) for row in zip(*flags)]
+    increment("rows_scanned", snapshot.rows)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the stored emails to a columnar snapshot, "
+                                                 "optionally simulating a rules file over it.")
+    parser.add_argument("--dir", default=DEFAULT_SNAPSHOT_DIR, help="Snapshot directory.")
+    parser.add_argument("--full", action="store_true",
+                        help="Rewrite the snapshot instead of appending the emails received since the last export.")
+    parser.add_argument("--bodies", action="store_true", help="Include the plain-text bodies.")
+    parser.add_argument("--simulate", metavar="RULES",
+                        help="Print how many emails each rule of this rules file matches, without applying anything.")
+    parser.add_argument("--now", type=datetime.fromisoformat,
+                        help="Reference time for relative date conditions in --simulate (default: now).")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumented(args):
+        database = get_or_initialize_db()
+        export_snapshot(args.dir, full=args.full, bodies=args.bodies)
+        database.close()
+        if args.simulate:
+            program = load_rule_program(args.simulate)
+            snapshot = Snapshot(args.dir)
+            for index, mask in evaluate_snapshot(program, snapshot, now=args.now).items():
+                rule = program.rules[index]
+                count = int(numpy.count_nonzero(mask)) if numpy is not None else sum(mask)
+                print(f"rules[{index}] ({rule.predicate}, {', '.join(rule.actions)}): {count} of {snapshot.rows} emails")
@@ -0,0 +1,133 @@
+"""
+Writes fetched email rows to the database on a dedicated thread.
+
+The fetch stage hands rows to an `EmailWriter` through a bounded queue and goes
+on downloading while the writer commits, so network and disk I/O overlap. The
+queue holds at most two commits worth of rows: a writer that falls behind
+blocks the fetch instead of letting rows pile up in memory.
+
+Every commit is one explicit transaction of `rows_per_commit` rows, written with
+as many rows per statement as SQLite's parameter limit allows (see
+`db_utils.insert_emails`). Larger commits mean fewer fsyncs and more throughput;
+smaller ones lose less work to a crash and keep write locks shorter.
+"""
+import logging
+import queue
+import threading
+
+from db_utils import insert_emails, CONFLICT_MODES
+from match_store import refresh_pending_matches
+from metrics import stage
+
+DEFAULT_ROWS_PER_COMMIT = 500
+
+_FLUSH = object()
+_STOP = object()
+
+
+class EmailWriter:
+    """
+    Background writer for `Email` rows.
+
+    Use it as a context manager; leaving the block commits the remaining rows
+    and stops the thread:
+
+        with EmailWriter(db, on_conflict="upsert") as writer:
+            for row in rows:
+                writer.put(row)
+
+    An error on the writer thread is raised again by the next `put`, `flush`
+    or `close` in the calling thread.
+
+    Args:
+        db (SqliteDatabase): Initialized database connection. The writer thread
+            opens its own connection to it and closes it when done.
+        on_conflict (str): "ignore" or "upsert", see `db_utils.insert_emails`.
+        rows_per_commit (int): Rows written per transaction.
+        stats (dict | None): Fetch counters to update with fetched and inserted
+            counts as rows are committed (see `gmail_mail_fetch.new_fetch_stats`).
+    """
+
+    def __init__(self, db, on_conflict="ignore", rows_per_commit=DEFAULT_ROWS_PER_COMMIT, stats=None):
+        if on_conflict not in CONFLICT_MODES:
+            raise ValueError(f"on_conflict must be one of {CONFLICT_MODES}, got {on_conflict!r}")
+        if rows_per_commit < 1:
+            raise ValueError(f"rows_per_commit must be at least 1, got {rows_per_commit}")
+        self.db = db
+        self.on_conflict = on_conflict
+        self.rows_per_commit = rows_per_commit
+        self.stats = stats
+        self.inserted = 0
+        self.commits = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=2 * rows_per_commit)
+        self.thread = threading.Thread(target=self._run, name="email-writer", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close(raise_error=exc_type is None)
+
+    def _commit(self, rows):
+        with stage("insert"), self.db.atomic():
+            count = insert_emails(rows, on_conflict=self.on_conflict)
+        # Active rules are evaluated on the new rows right away (see `match_store`)
+        refresh_pending_matches()
+        self.inserted += count
+        self.commits += 1
+        if self.stats is not None:
+            self.stats["fetched"] += len(rows)
+            self.stats["inserted"] += count
+
+    def _run(self):
+        rows = []
+        try:
+            while True:
+                item = self.queue.get()
+                try:
+                    if item is _FLUSH or item is _STOP:
+                        if rows and self.error is None:
+                            self._commit(rows)
+                        rows = []
+                        if item is _STOP:
+                            return
+                    elif self.error is None:
+                        rows.append(item)
+                        if len(rows) >= self.rows_per_commit:
+                            self._commit(rows)
+                            rows = []
+                except Exception as e:
+                    # Keep draining the queue so the fetch stage is never left blocked
+                    logging.error(f"Error writing emails to the database: {e}")
+                    self.error = e
+                    rows = []
+                finally:
+                    self.queue.task_done()
+        finally:
+            if not self.db.is_closed():
+                self.db.close()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, row):
+        """Queues a row for writing; blocks while the queue is full."""
+        self._raise_error()
+        self.queue.put(row)
+
+    def flush(self):
+        """Commits every queued row before returning, e.g. before checkpointing a sync."""
+        self.queue.put(_FLUSH)
+        self.queue.join()
+        self._raise_error()
+
+    def close(self, raise_error=True):
+        """Commits the remaining rows and stops the writer thread."""
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+        if raise_error:
+            self._raise_error()
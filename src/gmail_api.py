@@ -0,0 +1,371 @@
+"""
+Gmail API call helpers: quota accounting, scheduling and retries.
+
+Every Gmail call of the process goes through one `QuotaScheduler` (`SCHEDULER`),
+either with `execute_with_retry` or, for batch requests, `execute_batch`. Fetches,
+syncs and rule actions running at the same time therefore share one view of the
+per-user quota instead of each running into it on their own.
+"""
+import contextlib
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from utils import get_http_status
+from metrics import METRICS, increment
+
+
+# Gmail API quota units charged per method (per-user limit: 250 units per second).
+QUOTA_UNITS = {
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "labels.list": 1,
+    "labels.create": 5,
+    "history.list": 2,
+    "users.getProfile": 1,
+    "users.watch": 100,
+}
+USER_QUOTA_UNITS_PER_SECOND = 250
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Calls waiting for quota are served in this order; see `api_priority`.
+PRIORITIES = ("interactive", "new_mail", "backfill")
+DEFAULT_PRIORITY = "interactive"
+
+_local = threading.local()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket used to stay under the Gmail per-user quota.
+
+    Tokens are quota units: each call acquires the number of units its method costs.
+
+    Args:
+        rate (float): Units added per second.
+        capacity (float): Maximum burst size in units. Defaults to one second of `rate`.
+        clock (callable): Monotonic time source, replaceable in tests.
+        sleep (callable): Sleep function, replaceable in tests.
+    """
+
+    def __init__(self, rate=USER_QUOTA_UNITS_PER_SECOND, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, units=1):
+        """Blocks until `units` tokens are available and takes them."""
+        if units > self.capacity:
+            raise ValueError(f"Cannot acquire {units} units from a bucket of capacity {self.capacity}")
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= units:
+                    self.tokens -= units
+                    return
+                wait = (units - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+@contextlib.contextmanager
+def api_priority(priority):
+    """
+    Sends the Gmail calls this thread makes inside the block at `priority`.
+
+    Worker threads do not inherit it: code handing calls to a pool passes
+    `current_priority()` along explicitly.
+
+    Args:
+        priority (str): One of `PRIORITIES`.
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"priority must be one of {PRIORITIES}, got {priority!r}")
+    previous = getattr(_local, "priority", None)
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority():
+    """Returns the priority set by the innermost `api_priority` block of this thread."""
+    return getattr(_local, "priority", None) or DEFAULT_PRIORITY
+
+
+class QuotaScheduler:
+    """
+    Process-wide gate every Gmail API call passes before it is sent.
+
+    - Calls pay their cost in quota units (`QUOTA_UNITS`) from a token bucket
+      refilled at `rate` units per second. A call costing more than the burst
+      capacity, like a large batch request, waits for a full bucket and leaves
+      it in debt.
+    - Waiting calls are served by priority (`PRIORITIES`), then in arrival
+      order, so backfill traffic only gets the quota nothing else is waiting for.
+    - The rate adapts to Gmail's answers (AIMD): a rate limited response
+      multiplies it by `decrease`, at most once per `cooldown` seconds, and every
+      successful call adds `increase` units per second back, up to the starting rate.
+    - `stats()` reports the queue depth per priority, units and calls per method,
+      throughput and the current rate. The same values go to `metrics.METRICS`.
+
+    Args:
+        rate (float | None): Starting and maximum units per second. None never
+            waits and only keeps the accounting.
+        capacity (float | None): Burst size in units. Defaults to one second of `rate`.
+        min_rate (float | None): Lowest adaptive rate. Defaults to a tenth of `rate`.
+        increase (float): Units per second added back per successful call.
+        decrease (float): Factor applied to the rate on a rate limited response.
+        cooldown (float): Seconds after a decrease during which further rate
+            limited responses, from calls already in flight, are ignored.
+        clock (callable): Monotonic time source.
+    """
+
+    def __init__(self, rate=USER_QUOTA_UNITS_PER_SECOND, capacity=None, min_rate=None, increase=1.0,
+                 decrease=0.5, cooldown=1.0, clock=time.monotonic):
+        self.max_rate = float(rate) if rate is not None else None
+        self.rate = self.max_rate
+        self.capacity = float(capacity if capacity is not None else rate or 0)
+        self.min_rate = float(min_rate) if min_rate is not None else (self.max_rate or 0) / 10
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated_at = self.started_at = clock()
+        self.decreased_at = None
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.queue_depth = {priority: 0 for priority in PRIORITIES}
+        self.units = {}
+        self.calls = {}
+        self.throttled = 0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _wait_time(self, units):
+        """Seconds until `units` may be charged, 0 if they may be now."""
+        if self.rate is None:
+            return 0
+        self._refill()
+        needed = min(units, self.capacity)
+        return 0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def _set_depth(self, priority, change):
+        self.queue_depth[priority] += change
+        METRICS.set("scheduler_queue_depth", self.queue_depth[priority], priority=priority)
+
+    def acquire(self, units=1, method=None, priority=None):
+        """
+        Blocks until a call may be sent and charges its units.
+
+        Args:
+            units (float): Quota units the call costs.
+            method (str | None): API method, for the per-method accounting.
+            priority (str | None): One of `PRIORITIES`; defaults to `current_priority()`.
+
+        Returns:
+            float: Seconds the call waited.
+        """
+        priority = priority or current_priority()
+        ticket = (PRIORITIES.index(priority), next(self.sequence))
+        started = self.clock()
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            self._set_depth(priority, 1)
+            try:
+                while True:
+                    wait = self._wait_time(units) if self.waiting[0] == ticket else None
+                    if wait == 0:
+                        break
+                    self.condition.wait(wait)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self._set_depth(priority, -1)
+                self.condition.notify_all()
+            self.tokens -= units
+            method = method or "unknown"
+            self.units[method] = self.units.get(method, 0) + units
+            self.calls[method] = self.calls.get(method, 0) + 1
+        waited = self.clock() - started
+        increment("quota_units", units, method=method)
+        METRICS.observe("scheduler_wait_seconds", waited, priority=priority)
+        return waited
+
+    def record_response(self, error=None):
+        """
+        Adapts the rate to the outcome of a call: `error` is None for a success,
+        otherwise the exception it raised. Only rate limit errors lower the rate.
+        """
+        with self.condition:
+            if self.rate is None:
+                return
+            if error is None:
+                if self.rate < self.max_rate:
+                    self.rate = min(self.max_rate, self.rate + self.increase)
+                    METRICS.set("scheduler_rate", self.rate)
+                return
+            if not is_rate_limit_error(error):
+                return
+            self.throttled += 1
+            increment("api_throttled")
+            now = self.clock()
+            if self.decreased_at is not None and now - self.decreased_at < self.cooldown:
+                return
+            self._refill()
+            # Gmail says the quota is used up: drop the burst and slow down
+            self.tokens = min(self.tokens, 0)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.decreased_at = now
+            METRICS.set("scheduler_rate", self.rate)
+        logging.warning(f"Gmail rate limit hit, lowering the request rate to {self.rate:.0f} units/s")
+
+    def stats(self):
+        """
+        Returns the scheduler state: current rate, queue depth per priority, quota
+        units and calls per method, rate limited responses, and throughput in
+        units per second since the scheduler was created.
+        """
+        with self.condition:
+            elapsed = max(self.clock() - self.started_at, 1e-9)
+            return {
+                "rate": self.rate,
+                "queue_depth": dict(self.queue_depth),
+                "units": dict(self.units),
+                "calls": dict(self.calls),
+                "throttled": self.throttled,
+                "units_per_second": sum(self.units.values()) / elapsed,
+            }
+
+
+SCHEDULER = QuotaScheduler()
+
+
+def configure_scheduler(rate=USER_QUOTA_UNITS_PER_SECOND, **kwargs):
+    """
+    Replaces the process-wide scheduler, e.g. for an account with a different
+    quota or, with `rate=None`, to only keep the accounting.
+
+    Args:
+        rate (float | None): Units per second, see `QuotaScheduler`.
+        **kwargs: Other `QuotaScheduler` arguments.
+
+    Returns:
+        QuotaScheduler: The new scheduler.
+    """
+    global SCHEDULER
+    SCHEDULER = QuotaScheduler(rate=rate, **kwargs)
+    return SCHEDULER
+
+
+def record_response(error=None):
+    """Reports the outcome of a call sent in a batch request to the scheduler."""
+    SCHEDULER.record_response(error)
+
+
+def is_rate_limit_error(error):
+    """Returns True for rate limiting: 429, or 403 with a rate limit reason."""
+    status = get_http_status(error)
+    return status == 429 or (status == 403 and "ratelimitexceeded" in str(error).lower())
+
+
+def is_retryable_error(error):
+    """
+    Returns True for errors worth retrying: rate limiting (429, or 403 with a
+    rate limit reason) and transient server errors (5xx).
+    """
+    return get_http_status(error) in RETRYABLE_STATUSES or is_rate_limit_error(error)
+
+
+def backoff_delay(attempt, base_delay=0.5, max_delay=32.0):
+    """Exponential backoff with full jitter for the given zero-based retry attempt."""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def execute_with_retry(request, method=None, rate_limiter=None, http=None, max_retries=5,
+                       base_delay=0.5, max_delay=32.0, sleep=time.sleep, priority=None):
+    """
+    Executes a Gmail API request, retrying 429/5xx responses with exponential backoff and jitter.
+
+    Every attempt waits for its quota units in the process-wide `SCHEDULER` and
+    reports its outcome to it. Every attempt is counted in the `api_calls` metric
+    under its method, every retry in `api_retries`.
+
+    Args:
+        request: A `googleapiclient` HttpRequest (anything with `execute`).
+        method (str | None): API method name, used to charge its `QUOTA_UNITS`.
+        rate_limiter (TokenBucket | None): Extra bucket charged before every attempt,
+            on top of the scheduler.
+        http: Optional per-thread HTTP object passed to `execute`.
+        max_retries (int): Retries after the first attempt before giving up.
+        priority (str | None): Scheduling priority, defaults to `current_priority()`.
+
+    Returns:
+        dict: The API response.
+
+    Raises:
+        Exception: The last error if it is not retryable or retries are exhausted.
+    """
+    units = QUOTA_UNITS.get(method, 1)
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire(units)
+        SCHEDULER.acquire(units, method=method, priority=priority)
+        increment("api_calls", method=method or "unknown")
+        try:
+            response = request.execute(http=http) if http is not None else request.execute()
+        except Exception as e:
+            SCHEDULER.record_response(e)
+            if attempt >= max_retries or not is_retryable_error(e):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            increment("api_retries", method=method or "unknown")
+            logging.warning(
+                f"Retrying {method or 'request'} after error ({e}), attempt {attempt + 1} in {delay:.2f}s")
+            sleep(delay)
+            attempt += 1
+        else:
+            SCHEDULER.record_response()
+            return response
+
+
+def execute_batch(batch, calls, method, priority=None):
+    """
+    Sends a batch request of `calls` calls to `method` once the scheduler grants
+    their quota units.
+
+    The calls of a batch succeed or fail one by one, so their callback reports
+    each outcome with `record_response`. Errors of the batch request itself are
+    raised.
+
+    Args:
+        batch: A `googleapiclient` BatchHttpRequest.
+        calls (int): Number of calls added to the batch.
+        method (str): API method of the calls, e.g. "messages.get".
+        priority (str | None): Scheduling priority, defaults to `current_priority()`.
+    """
+    SCHEDULER.acquire(calls * QUOTA_UNITS.get(method, 1), method=method, priority=priority)
+    increment("api_calls", calls, method=method)
+    increment("batch_requests")
+    batch.execute()
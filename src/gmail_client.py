@@ -0,0 +1,116 @@
+"""
+Shared Gmail API client: credentials, service object and HTTP connections, built once per token.
+
+Entry points call `get_gmail_client()` (or `get_gmail_service()`) instead of
+authenticating and building a service themselves. The token file is read once,
+the service is built from the discovery document bundled with
+`google-api-python-client` (no discovery HTTP request), and the access token is
+refreshed under a lock shortly before it expires, so concurrent calls never
+race to refresh it.
+"""
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from utils import authenticate_gmail, save_token, TOKEN_PATH, CLIENT_SECRETS_PATH
+
+
+# Access tokens are refreshed this long before they expire.
+REFRESH_MARGIN = timedelta(minutes=5)
+HTTP_TIMEOUT_SECONDS = 60
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _utcnow():
+    # google-auth stores `expiry` as a naive UTC datetime
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class GmailClient:
+    """
+    Lazily authenticated Gmail API client for one token file. Safe to share between threads.
+
+    Args:
+        token_path (str): Token file of the mailbox.
+        client_secrets_path (str): OAuth client secrets for a new authorization.
+        interactive (bool): Allow the browser authorization flow if there is no usable token.
+        refresh_margin (timedelta): Refresh the access token this long before it expires.
+        clock (callable): Returns the current naive UTC datetime, replaceable in tests.
+    """
+
+    def __init__(self, token_path=TOKEN_PATH, client_secrets_path=CLIENT_SECRETS_PATH, interactive=True,
+                 refresh_margin=REFRESH_MARGIN, clock=_utcnow):
+        self.token_path = token_path
+        self.client_secrets_path = client_secrets_path
+        self.interactive = interactive
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.creds = None
+        self._service = None
+        self.refreshes = 0
+
+    def _expires_soon(self):
+        expiry = getattr(self.creds, "expiry", None)
+        return expiry is not None and expiry - self.refresh_margin <= self.clock()
+
+    def credentials(self):
+        """Returns the credentials, loading them on first use and refreshing them if they expire soon."""
+        with self.lock:
+            if self.creds is None:
+                self.creds = authenticate_gmail(self.token_path, self.client_secrets_path,
+                                                interactive=self.interactive)
+            if self._expires_soon() and self.creds.refresh_token:
+                from google.auth.transport.requests import Request
+
+                logging.info(f"Refreshing the access token of {self.token_path} before it expires")
+                self.creds.refresh(Request())
+                save_token(self.creds, self.token_path)
+                self.refreshes += 1
+            return self.creds
+
+    def service(self):
+        """Returns the Gmail API service, built once from the bundled discovery document."""
+        creds = self.credentials()
+        with self.lock:
+            if self._service is None:
+                from googleapiclient.discovery import build
+
+                self._service = build("gmail", "v1", credentials=creds, static_discovery=True,
+                                      cache_discovery=False)
+            return self._service
+
+    def http(self):
+        """
+        Returns the authorized HTTP object of the calling thread, to pass to `request.execute(http=...)`.
+
+        `httplib2.Http` instances must not be shared between threads. Each thread keeps
+        its own, and with it its open keep-alive connections, for the client's lifetime.
+        """
+        creds = self.credentials()
+        http = getattr(self.local, "http", None)
+        if http is None:
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+
+            http = self.local.http = AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS))
+        return http
+
+
+def get_gmail_client(token_path=TOKEN_PATH, client_secrets_path=CLIENT_SECRETS_PATH, interactive=True):
+    """Returns the process-wide `GmailClient` of a token file, creating it on first use."""
+    key = os.path.abspath(token_path)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = GmailClient(token_path, client_secrets_path, interactive=interactive)
+        return client
+
+
+def get_gmail_service(token_path=TOKEN_PATH):
+    """Returns the cached Gmail API service of a token file (see `GmailClient.service`)."""
+    return get_gmail_client(token_path).service()
@@ -1,33 +1,504 @@
+import argparse
 import base64
 import logging
 from datetime import datetime
 import re
-from googleapiclient.discovery import build
 
-from utils import authenticate_gmail
-from db_utils import get_or_initialize_db, Email
+from gmail_client import get_gmail_service
+from gmail_api import execute_with_retry, execute_batch, record_response, api_priority
+from mime_parser import extract_body, extract_body_from_raw, partial_fields, is_truncated
+from message_cache import MessageCache
+from metrics import increment, stage, add_arguments, instrumented
+from match_store import refresh_pending_matches
+from email_writer import EmailWriter
+from db_utils import (
+    get_or_initialize_db, get_sync_state, set_sync_state, filter_new_email_ids, store_bodies, emails_missing_bodies
+)
 
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Gmail accepts at most 100 calls per batch request, but recommends staying
+# at 50 or below to avoid per-user rate limiting.
+MAX_BATCH_SIZE = 100
+DEFAULT_BATCH_SIZE = 50
 
-def fetch_emails_and_store(testing=False):
+# `messages.list` returns at most 500 IDs per page.
+MAX_LIST_PAGE_SIZE = 500
+DEFAULT_CHUNK_SIZE = 500
+
+# SyncState key holding the `messages.list` page token of the next unprocessed page.
+PAGE_TOKEN_KEY = "full_sync_page_token"
+
+# Partial response selector covering only what `parse_message` reads. Messages
+# nested deeper than it reaches are downloaded again whole (see `complete_partial_message`).
+MESSAGE_FIELDS = f"id,labelIds,internalDate,{partial_fields()}"
+
+# `format=metadata` downloads headers only; bodies are then loaded on demand
+# by `load_missing_bodies`, from the message cache or as `format=raw`.
+MESSAGE_FORMATS = ("full", "metadata")
+METADATA_HEADERS = ["From", "Subject"]
+METADATA_FIELDS = "id,labelIds,internalDate,payload/headers"
+RAW_FIELDS = "id,raw"
+# `format=minimal` with these fields returns only the labels, to refresh stored messages.
+LABEL_FIELDS = "id,labelIds"
+
+# Stored bodies are cut at this many bytes of UTF-8; None stores them whole.
+MAX_BODY_BYTES = 1024 * 1024
+
+
+def parse_message(msg, max_body_bytes=MAX_BODY_BYTES, with_body=True):
+    """
+    Extracts the stored email details from a Gmail API message resource.
+
+    Args:
+        msg (dict): Message resource returned by `users.messages.get`.
+        max_body_bytes (int | None): Cap on the stored body size (see `mime_parser.extract_body`).
+        with_body (bool): False for `format=metadata` resources, which carry no body.
+
+    Returns:
+        dict: Row for the `Email` table (id, sender, subject, body, received_at, labels).
+            The "body" key is left out when `with_body` is False.
+    """
+    # Extract headers
+    headers = msg["payload"].get("headers", [])
+    subject, sender = "", ""
+    received_at = datetime.fromtimestamp(
+        int(msg["internalDate"]) / 1000)
+
+    for header in headers:
+        if header["name"] == "From":
+            sender_match = re.search(r"<(.+?)>", header["value"])
+            sender = sender_match.group(
+                1) if sender_match else header["value"]
+        elif header["name"] == "Subject":
+            subject = header["value"]
+
+    row = {
+        "id": msg["id"],
+        "sender": sender,
+        "subject": subject,
+        "received_at": received_at,
+        "labels": ",".join(msg.get("labelIds", []))
+    }
+    if with_body:
+        # Extract plain-text email body, from anywhere in the MIME tree
+        row["body"] = extract_body(msg["payload"], max_bytes=max_body_bytes)
+    return row
+
+
+def message_get_kwargs(partial=False, message_format="full"):
+    """
+    Returns the `messages.get` arguments for a fetch format (see `MESSAGE_FORMATS`),
+    or for "minimal", which only returns the labels of a message.
+    """
+    if message_format == "minimal":
+        return {"format": "minimal", "fields": LABEL_FIELDS}
+    if message_format == "metadata":
+        return {"format": "metadata", "metadataHeaders": METADATA_HEADERS, "fields": METADATA_FIELDS}
+    if message_format != "full":
+        raise ValueError(f"message_format must be one of {MESSAGE_FORMATS}, got {message_format!r}")
+    return {"fields": MESSAGE_FIELDS} if partial else {}
+
+
+def fetch_messages_batched(service, message_ids, batch_size=DEFAULT_BATCH_SIZE, partial=False,
+                           message_format="full"):
+    """
+    Fetches full messages using Gmail batch requests instead of one HTTP round trip per message.
+
+    Args:
+        service: Authenticated Gmail API service.
+        message_ids (list[str]): IDs of the messages to fetch.
+        batch_size (int): Number of `messages.get` calls grouped into one batch request (max 100).
+        partial (bool): If True, only request the fields that are stored in the database.
+            Messages whose MIME tree is deeper than the selector reaches are downloaded
+            again without it.
+        message_format (str): "full", or "metadata" to download headers only.
+
+    Returns:
+        list[dict]: Message resources that were fetched successfully, in request order.
+        Messages whose individual call failed are logged and skipped.
+    """
+    if not 1 <= batch_size <= MAX_BATCH_SIZE:
+        raise ValueError(
+            f"batch_size must be between 1 and {MAX_BATCH_SIZE}, got {batch_size}")
+
+    fetched = {}
+
+    def handle_response(request_id, response, exception):
+        record_response(exception)
+        if exception is not None:
+            logging.error(f"Error processing message {request_id}: {exception}")
+        else:
+            fetched[request_id] = response
+
+    def send(chunk, get_kwargs):
+        logging.debug("Fetching batch of %d messages", len(chunk))
+        batch = service.new_batch_http_request(callback=handle_response)
+        for message_id in chunk:
+            batch.add(service.users().messages().get(
+                userId="me", id=message_id, **get_kwargs), request_id=message_id)
+        try:
+            with stage("get"):
+                execute_batch(batch, len(chunk), "messages.get")
+        except Exception as e:
+            logging.error(f"Error executing batch request: {e}")
+
+    get_kwargs = message_get_kwargs(partial, message_format)
+    for start in range(0, len(message_ids), batch_size):
+        chunk = message_ids[start:start + batch_size]
+        send(chunk, get_kwargs)
+        if "fields" in get_kwargs and message_format == "full":
+            truncated = [message_id for message_id in chunk
+                         if message_id in fetched and is_truncated(fetched[message_id]["payload"])]
+            if truncated:
+                increment("partial_refetches", len(truncated))
+                send(truncated, message_get_kwargs(False, message_format))
+
+    return [fetched[message_id] for message_id in message_ids if message_id in fetched]
+
+
+def complete_partial_message(service, msg, **retry_kwargs):
+    """
+    Returns `msg`, or the whole message downloaded again if the partial response
+    cut its MIME tree short (see `mime_parser.is_truncated`).
+
+    Args:
+        service: Authenticated Gmail API service.
+        msg (dict): Message resource fetched with `MESSAGE_FIELDS`.
+        **retry_kwargs: Passed on to `execute_with_retry`.
+    """
+    if not is_truncated(msg["payload"]):
+        return msg
+    increment("partial_refetches")
+    return execute_with_retry(service.users().messages().get(userId="me", id=msg["id"]),
+                              method="messages.get", **retry_kwargs)
+
+
+def new_fetch_stats():
+    """
+    Returns the counters reported by the fetch paths.
+
+    - listed: message IDs returned by `messages.list`
+    - skipped: listed IDs already stored, never downloaded
+    - fetched: messages downloaded and parsed successfully
+    - inserted: rows actually added to the database
+    """
+    return {"listed": 0, "skipped": 0, "fetched": 0, "inserted": 0}
+
+
+def log_fetch_stats(stats):
+    for outcome, count in stats.items():
+        increment("messages", count, outcome=outcome)
+    logging.info(
+        f"Listed {stats['listed']} messages: skipped {stats['skipped']} already stored, "
+        f"fetched {stats['fetched']}, inserted {stats['inserted']}.")
+
+
+def iter_message_id_pages(service, page_token=None, page_size=MAX_LIST_PAGE_SIZE):
+    """
+    Walks `messages.list` by following `nextPageToken`.
+
+    Args:
+        service: Authenticated Gmail API service.
+        page_token (str | None): Token of the first page to read, None for the newest page.
+        page_size (int): Number of message IDs requested per page (max 500).
+
+    Yields:
+        tuple[list[str], str | None]: Message IDs of a page and the token of the following page.
+    """
+    while True:
+        request_kwargs = {"userId": "me", "maxResults": page_size}
+        if page_token:
+            request_kwargs["pageToken"] = page_token
+        with stage("list"):
+            results = execute_with_retry(service.users().messages().list(**request_kwargs), method="messages.list")
+        next_page_token = results.get("nextPageToken")
+        yield [message["id"] for message in results.get("messages", [])], next_page_token
+        if not next_page_token:
+            return
+        page_token = next_page_token
+
+
+def iter_parsed_messages(service, message_ids, batch_size=DEFAULT_BATCH_SIZE, partial=True, message_format="full"):
+    """
+    Lazily fetches and parses messages, one batch request at a time.
+
+    Yields:
+        dict: Rows for the `Email` table. Messages that fail to fetch or parse are logged and skipped.
+    """
+    with_body = message_format != "metadata"
+    for start in range(0, len(message_ids), batch_size):
+        chunk = message_ids[start:start + batch_size]
+        rows = []
+        messages = fetch_messages_batched(service, chunk, batch_size=batch_size, partial=partial,
+                                          message_format=message_format)
+        # Parsed a batch at a time, so the parse stage timer is not paid per message
+        with stage("parse"):
+            for msg in messages:
+                try:
+                    rows.append(parse_message(msg, with_body=with_body))
+                except Exception as e:
+                    logging.error(f"Error processing message {msg.get('id')}: {e}")
+        yield from rows
+
+
+def store_emails_in_chunks(db, rows, chunk_size=DEFAULT_CHUNK_SIZE, stats=None, on_conflict="ignore"):
+    """
+    Consumes an iterable of email rows and inserts them in chunks, one transaction per chunk.
+
+    The rows are written by an `EmailWriter` thread, so the next rows are fetched
+    while a chunk is committed. Everything is committed when this returns.
+
+    Args:
+        db (SqliteDatabase): Initialized database connection.
+        rows (Iterable[dict]): Rows for the `Email` table.
+        chunk_size (int): Rows written per transaction.
+        stats (dict | None): Fetch counters to update with fetched and inserted counts.
+        on_conflict (str): "ignore" skips stored emails, "upsert" updates the ones that changed.
+
+    Returns:
+        int: Number of rows actually inserted (or, with "upsert", inserted or changed).
+    """
+    with EmailWriter(db, on_conflict=on_conflict, rows_per_commit=chunk_size, stats=stats) as writer:
+        for row in rows:
+            writer.put(row)
+    return writer.inserted
+
+
+def sync_all_emails(service, db, page_size=MAX_LIST_PAGE_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                    chunk_size=DEFAULT_CHUNK_SIZE, partial=True, resume=True, message_format="full",
+                    on_conflict="ignore", failed_ids=None):
+    """
+    Mirrors the whole mailbox into the database, page by page, with bounded memory.
+
+    After every page is written the token of the next page is checkpointed in the
+    `SyncState` table, so an interrupted run resumes at the first unfinished page.
+    The checkpoint is cleared once the last page has been stored.
+
+    Args:
+        service: Authenticated Gmail API service.
+        db (SqliteDatabase): Initialized database connection.
+        page_size (int): Message IDs listed per `messages.list` page (max 500).
+        batch_size (int): `messages.get` calls per batch request.
+        chunk_size (int): Rows written per transaction.
+        partial (bool): Only request the stored fields from the API. Messages nested deeper
+            than the partial response reaches are downloaded again whole.
+        resume (bool): Continue from the checkpointed page token, if any.
+        message_format (str): "full", or "metadata" to store headers only and load
+            bodies later with `load_missing_bodies`.
+        on_conflict (str): "ignore", or "upsert" to download stored messages again and
+            update the ones whose subject, labels or body changed.
+        failed_ids (list | None): If given, extended with the IDs of listed messages
+            that are still not stored after their page was written, e.g. because their
+            call failed inside a batch request.
+
+    Unless upserting, listed IDs that are already stored are skipped before anything is downloaded.
+    The API calls are sent at "backfill" priority, behind new mail and rule actions
+    (see `gmail_api.api_priority`).
+
+    Returns:
+        dict: Fetch counters (see `new_fetch_stats`).
+    """
+    page_token = get_sync_state(PAGE_TOKEN_KEY) if resume else None
+    if page_token:
+        logging.info("Resuming full sync from the last checkpointed page")
+
+    stats = new_fetch_stats()
+    with api_priority("backfill"):
+        for message_ids, next_page_token in iter_message_id_pages(service, page_token, page_size):
+            new_ids = message_ids if on_conflict == "upsert" else filter_new_email_ids(message_ids)
+            stats["listed"] += len(message_ids)
+            stats["skipped"] += len(message_ids) - len(new_ids)
+
+            rows = iter_parsed_messages(service, new_ids, batch_size=batch_size, partial=partial,
+                                        message_format=message_format)
+            store_emails_in_chunks(db, rows, chunk_size=chunk_size, stats=stats, on_conflict=on_conflict)
+            if failed_ids is not None:
+                failed_ids += filter_new_email_ids(new_ids)
+            set_sync_state(PAGE_TOKEN_KEY, next_page_token)
+            logging.info(f"Stored {stats['inserted']} messages so far")
+
+    return stats
+
+
+def fetch_all_emails_and_store(testing=False, page_size=MAX_LIST_PAGE_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                               chunk_size=DEFAULT_CHUNK_SIZE, resume=True, message_format="full",
+                               on_conflict="ignore"):
+    """
+    Fetches every message in the mailbox and stores it in the local database.
+
+    Args:
+        testing (bool): If True, uses a test database.
+        page_size (int): Message IDs listed per page.
+        batch_size (int): `messages.get` calls per batch request.
+        chunk_size (int): Rows written per transaction.
+        resume (bool): Continue an interrupted run from its checkpoint.
+        message_format (str): "full", or "metadata" for header-only ingestion.
+        on_conflict (str): "ignore", or "upsert" to refresh messages that are already stored.
+
+    What this function does:
+    - Initialize the database and authenticate with Gmail API.
+    - Stream message IDs page by page, following `nextPageToken`.
+    - Fetch, parse and insert each page in bounded chunks, written by a separate thread.
+    - Checkpoint the next page token so a crashed run continues where it stopped.
+    - Handle errors gracefully and log them.
+    """
+    db = None
+    try:
+        db = get_or_initialize_db(testing=testing)
+
+        service = get_gmail_service()
+
+        stats = sync_all_emails(service, db, page_size=page_size, batch_size=batch_size,
+                                chunk_size=chunk_size, resume=resume, message_format=message_format,
+                                on_conflict=on_conflict)
+        log_fetch_stats(stats)
+        logging.info("Full sync finished.")
+        return stats
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+    finally:
+        if db is not None:
+            db.close()
+
+
+def fetch_raw_messages(service, message_ids, cache=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Returns the raw RFC 822 bytes of messages, from the cache when possible.
+
+    Cache misses are downloaded with `format=raw` through batch requests and
+    added to the cache.
+
+    Args:
+        service: Authenticated Gmail API service, or None to only read the cache;
+            misses are then logged and left out.
+        message_ids (list[str]): IDs of the messages.
+        cache (MessageCache | None): Local message cache; None always downloads.
+        batch_size (int): `messages.get` calls per batch request.
+
+    Returns:
+        dict[str, bytes]: Raw message by ID. Messages that failed to download are left out.
+    """
+    raw_messages = cache.get_many(message_ids) if cache is not None else {}
+    missing = [message_id for message_id in message_ids if message_id not in raw_messages]
+    if raw_messages:
+        increment("message_cache_hits", len(raw_messages))
+        logging.info(f"{len(raw_messages)} raw messages served from the cache")
+    if service is None:
+        if missing:
+            logging.warning(f"Skipping {len(missing)} messages missing from the cache")
+        return raw_messages
+
+    def handle_response(request_id, response, exception):
+        record_response(exception)
+        if exception is not None:
+            logging.error(f"Error fetching raw message {request_id}: {exception}")
+            return
+        raw = base64.urlsafe_b64decode(response["raw"])
+        raw_messages[request_id] = raw
+        if cache is not None:
+            cache.put(request_id, raw)
+
+    for start in range(0, len(missing), batch_size):
+        chunk = missing[start:start + batch_size]
+        batch = service.new_batch_http_request(callback=handle_response)
+        for message_id in chunk:
+            batch.add(service.users().messages().get(
+                userId="me", id=message_id, format="raw", fields=RAW_FIELDS), request_id=message_id)
+        try:
+            with stage("get"):
+                execute_batch(batch, len(chunk), "messages.get")
+        except Exception as e:
+            logging.error(f"Error executing batch request: {e}")
+    return raw_messages
+
+
+def load_missing_bodies(service, email_ids=None, cache=None, batch_size=DEFAULT_BATCH_SIZE,
+                        max_body_bytes=MAX_BODY_BYTES, refresh=False):
+    """
+    Downloads and stores the bodies of emails that were ingested without one.
+
+    Only raw messages downloaded here are cached. Emails ingested with
+    `format=full` got their bodies from the parsed payload and have no cached
+    message, so a refresh without `email_ids` does not cover them.
+
+    Args:
+        service: Authenticated Gmail API service, or None to only use the cache.
+        email_ids (Iterable[str] | None): Only consider these emails. Defaults to all stored emails.
+        cache (MessageCache | None): Raw messages are read from and added to this cache.
+        batch_size (int): `messages.get` calls per batch request.
+        max_body_bytes (int | None): Cap on the stored body size.
+        refresh (bool): Re-extract the bodies of `email_ids` even if they are stored, e.g.
+            after a parser change. Defaults to every stored email with a cached message,
+            so nothing has to be downloaded.
+
+    Returns:
+        int: Number of bodies stored.
+    """
+    if refresh:
+        if email_ids is None:
+            cached = cache.message_ids() if cache is not None else []
+            email_ids = []
+            for start in range(0, len(cached), DEFAULT_CHUNK_SIZE):
+                chunk = cached[start:start + DEFAULT_CHUNK_SIZE]
+                new_ids = set(filter_new_email_ids(chunk))
+                email_ids += [email_id for email_id in chunk if email_id not in new_ids]
+        email_ids = list(email_ids)
+    else:
+        email_ids = emails_missing_bodies(email_ids)
+    if not email_ids:
+        return 0
+
+    logging.info(f"Loading the bodies of {len(email_ids)} emails")
+    stored = 0
+    for start in range(0, len(email_ids), DEFAULT_CHUNK_SIZE):
+        raw_messages = fetch_raw_messages(service, email_ids[start:start + DEFAULT_CHUNK_SIZE], cache=cache,
+                                          batch_size=batch_size)
+        bodies = {}
+        with stage("parse"):
+            for email_id, raw in raw_messages.items():
+                try:
+                    bodies[email_id] = extract_body_from_raw(raw, max_bytes=max_body_bytes)
+                except Exception as e:
+                    logging.error(f"Error parsing raw message {email_id}: {e}")
+        with stage("insert"):
+            store_bodies(bodies)
+        refresh_pending_matches()
+        stored += len(bodies)
+    return stored
+
+
+def fetch_emails_and_store(testing=False, batch_size=None, partial=False, on_conflict="ignore",
+                           rows_per_commit=DEFAULT_CHUNK_SIZE):
     """
     Fetches the latest emails from Gmail and stores them in a local database efficiently.
 
     Args:
         testing (bool): If True, uses a test database.
+        batch_size (int | None): If set, message bodies are fetched through Gmail batch
+            requests of this size instead of one request per message.
+        partial (bool): If True, only the stored fields are requested from the API. Messages
+            nested deeper than the partial response reaches are downloaded again whole.
+        on_conflict (str): "ignore", or "upsert" to download stored messages again and
+            update the ones that changed.
+        rows_per_commit (int): Rows written per transaction.
 
     What this function does:
     - Initialize the database.
     - Prompt the user for the number of emails to fetch. Limit to 100.
     - Authenticate with Gmail API.
-    - Retrieve email metadata and full email content.
+    - Skip listed messages that are already stored (unless upserting).
+    - Retrieve full email content for the remaining messages.
     - Extract relevant details (sender, subject, received timestamp, and body).
-    - Store emails in the database using a bulk insert, ignoring duplicates.
+    - Hand the rows to a writer thread that inserts them in chunked transactions while
+      the next messages download, ignoring or updating duplicates.
     - Handle errors gracefully and log them.
     - Close the database connection.
+
+    Returns:
+        dict | None: Fetch counters (see `new_fetch_stats`), or None if the run failed.
     """
     try:
         num_messages = int(
@@ -42,75 +513,96 @@ def fetch_emails_and_store(testing=False):
         logging.info(
             f"Fetching the latest {num_messages} messages from Gmail...")
 
-        creds = authenticate_gmail()
-        service = build("gmail", "v1", credentials=creds)
+        service = get_gmail_service()
 
-        results = service.users().messages().list(
-            userId="me", maxResults=num_messages).execute()
+        with stage("list"):
+            results = execute_with_retry(service.users().messages().list(
+                userId="me", maxResults=num_messages), method="messages.list", priority="new_mail")
         messages = results.get("messages", [])
 
+        # Skip messages that are already stored before downloading anything
+        stats = new_fetch_stats()
+        listed_ids = [message["id"] for message in messages]
+        new_ids = listed_ids if on_conflict == "upsert" else filter_new_email_ids(listed_ids)
+        stats["listed"] = len(messages)
+        stats["skipped"] = len(messages) - len(new_ids)
+
         logging.info("Processing and storing messages...")
 
-        emails_to_insert = []
-
-        for message in messages:
-            try:
-                logging.info(f"Fetching message ID: {message['id']}")
-                msg = service.users().messages().get(
-                    userId="me", id=message["id"]).execute()
-
-                # Extract headers
-                headers = msg["payload"].get("headers", [])
-                subject, sender = "", ""
-                received_at = datetime.fromtimestamp(
-                    int(msg["internalDate"]) / 1000)
-
-                for header in headers:
-                    if header["name"] == "From":
-                        sender_match = re.search(r"<(.+?)>", header["value"])
-                        sender = sender_match.group(
-                            1) if sender_match else header["value"]
-                    elif header["name"] == "Subject":
-                        subject = header["value"]
-
-                # Extract plain-text email body
-                body = ""
-                if "parts" in msg["payload"]:
-                    for part in msg["payload"]["parts"]:
-                        if part.get("mimeType") == "text/plain":
-                            try:
-                                body = base64.urlsafe_b64decode(
-                                    part["body"]["data"]).decode("utf-8")
-                                break  # Stop after decoding the first plain-text part
-                            except Exception as e:
-                                logging.error(
-                                    f"Error decoding email body for message {message['id']}: {e}")
-
-                # Collect email data for bulk insert
-                emails_to_insert.append({
-                    "id": message["id"],
-                    "sender": sender,
-                    "subject": subject,
-                    "body": body,
-                    "received_at": received_at
-                })
-
-            except Exception as e:
-                logging.error(f"Error processing message {message['id']}: {e}")
-
-        # Perform bulk insert if emails were fetched
-        if emails_to_insert:
-            logging.info("Bulk inserting emails into the database")
-            Email.insert_many(emails_to_insert).on_conflict_ignore().execute()
-            logging.info(
-                f"Inserted {len(emails_to_insert)} emails into the database.")
+        with api_priority("new_mail"), \
+                EmailWriter(db, on_conflict=on_conflict, rows_per_commit=rows_per_commit, stats=stats) as writer:
+            if batch_size:
+                fetched = fetch_messages_batched(
+                    service, new_ids, batch_size=batch_size, partial=partial)
+                with stage("parse"):
+                    for msg in fetched:
+                        try:
+                            writer.put(parse_message(msg))
+                        except Exception as e:
+                            logging.error(f"Error processing message {msg.get('id')}: {e}")
+            else:
+                get_kwargs = {"fields": MESSAGE_FIELDS} if partial else {}
+                for message_id in new_ids:
+                    try:
+                        logging.debug("Fetching message ID: %s", message_id)
+                        with stage("get"):
+                            msg = execute_with_retry(service.users().messages().get(
+                                userId="me", id=message_id, **get_kwargs), method="messages.get")
+                            if partial:
+                                msg = complete_partial_message(service, msg)
+
+                        # Queued for the writer thread, which inserts while the next message downloads
+                        with stage("parse"):
+                            row = parse_message(msg)
+                        writer.put(row)
 
+                    except Exception as e:
+                        logging.error(f"Error processing message {message_id}: {e}")
+
+        logging.info(f"Inserted {stats['inserted']} emails into the database.")
+
+        log_fetch_stats(stats)
         db.close()
         logging.info("Emails processed successfully.")
+        return stats
     except Exception as e:
         logging.error(f"An error occurred: {e}")
 
 
 if __name__ == "__main__":
-    fetch_emails_and_store()
+    parser = argparse.ArgumentParser(description="Fetch emails from Gmail into the local database.")
+    parser.add_argument("--all", action="store_true",
+                        help="Mirror the whole mailbox with a resumable, paginated sync.")
+    parser.add_argument("--sync", action="store_true",
+                        help="Apply only the changes since the last run using Gmail history IDs.")
+    parser.add_argument("--metadata", action="store_true",
+                        help="With --all or --sync, store headers only; bodies are loaded when a rule needs them.")
+    parser.add_argument("--reparse-bodies", action="store_true",
+                        help="Re-extract stored bodies from the local message cache, without downloading. "
+                             "Only bodies loaded on demand after a --metadata sync are cached.")
+    parser.add_argument("--upsert", action="store_true",
+                        help="Download stored messages again and update the ones whose subject, labels or body "
+                             "changed, instead of skipping them.")
+    parser.add_argument("--rows-per-commit", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Rows written per transaction; larger values trade crash recovery for throughput.")
+    add_arguments(parser)
+    args = parser.parse_args()
+    message_format = "metadata" if args.metadata else "full"
+    on_conflict = "upsert" if args.upsert else "ignore"
+
+    with instrumented(args):
+        if args.reparse_bodies:
+            database = get_or_initialize_db()
+            count = load_missing_bodies(None, cache=MessageCache(), refresh=True)
+            logging.info(f"Re-extracted {count} bodies from the message cache.")
+            database.close()
+        elif args.sync:
+            from history_sync import sync_emails
+            sync_emails(message_format=message_format, chunk_size=args.rows_per_commit)
+        elif args.all:
+            fetch_all_emails_and_store(message_format=message_format, chunk_size=args.rows_per_commit,
+                                       on_conflict=on_conflict)
+        else:
+            fetch_emails_and_store(batch_size=DEFAULT_BATCH_SIZE, partial=True, on_conflict=on_conflict,
+                                   rows_per_commit=args.rows_per_commit)
     logging.info("Emails fetched from Gmail and stored locally.")
@@ -0,0 +1,320 @@
+import json
+import logging
+
+from utils import get_http_status
+from gmail_client import get_gmail_service
+from gmail_api import execute_with_retry, api_priority
+from metrics import stage
+from db_utils import (
+    get_or_initialize_db, get_sync_state, set_sync_state, filter_new_email_ids, Email
+)
+from gmail_mail_fetch import (
+    sync_all_emails, iter_parsed_messages, iter_message_id_pages, fetch_messages_batched, store_emails_in_chunks,
+    DEFAULT_BATCH_SIZE, DEFAULT_CHUNK_SIZE, PAGE_TOKEN_KEY
+)
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+# SyncState key holding the mailbox historyId the database is consistent with.
+HISTORY_ID_KEY = "history_id"
+# SyncState key holding the historyId captured when a full resync started.
+PENDING_HISTORY_ID_KEY = "full_sync_history_id"
+
+# SyncState key holding the IDs of added messages that could not be stored yet,
+# with the number of syncs that failed to store them.
+FAILED_IDS_KEY = "failed_message_ids"
+# Messages that fail this many syncs in a row are given up on.
+MAX_FETCH_ATTEMPTS = 5
+
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+
+# Keeps `IN (...)` clauses well below SQLite's bound parameter limit.
+ID_CHUNK_SIZE = 500
+
+
+class HistoryExpiredError(Exception):
+    """Raised when Gmail no longer has history records for the stored historyId."""
+
+
+def collect_history_changes(service, start_history_id):
+    """
+    Reads every `users.history.list` page since `start_history_id` and reduces the
+    records to the net changes that must be applied to the database.
+
+    Args:
+        service: Authenticated Gmail API service.
+        start_history_id (str): historyId the database is currently consistent with.
+
+    Returns:
+        dict: {
+            "added": set of message IDs to fetch,
+            "deleted": set of message IDs to remove,
+            "labels": {message_id: [label IDs]} with the latest labels of changed messages,
+            "history_id": mailbox historyId after these changes,
+        }
+
+    Raises:
+        HistoryExpiredError: If Gmail answers 404 because the historyId is too old.
+    """
+    added, deleted, labels = set(), set(), {}
+    history_id = start_history_id
+    page_token = None
+
+    while True:
+        request_kwargs = {"userId": "me", "startHistoryId": start_history_id,
+                          "historyTypes": HISTORY_TYPES}
+        if page_token:
+            request_kwargs["pageToken"] = page_token
+        try:
+            with stage("list"):
+                results = execute_with_retry(service.users().history().list(**request_kwargs),
+                                             method="history.list")
+        except Exception as e:
+            if get_http_status(e) == 404:
+                raise HistoryExpiredError(str(e)) from e
+            raise
+
+        # Records are returned in chronological order, so later records win.
+        for record in results.get("history", []):
+            for item in record.get("messagesAdded", []):
+                message = item["message"]
+                added.add(message["id"])
+                deleted.discard(message["id"])
+                labels[message["id"]] = message.get("labelIds", [])
+            for item in record.get("messagesDeleted", []):
+                message = item["message"]
+                deleted.add(message["id"])
+                added.discard(message["id"])
+                labels.pop(message["id"], None)
+            for item in record.get("labelsAdded", []) + record.get("labelsRemoved", []):
+                message = item["message"]
+                if message["id"] not in deleted:
+                    labels[message["id"]] = message.get("labelIds", [])
+
+        history_id = results.get("historyId", history_id)
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            break
+
+    return {"added": added, "deleted": deleted, "labels": labels, "history_id": history_id}
+
+
+def remember_failed_ids(failed_ids, previous):
+    """
+    Stores the IDs of messages that could not be stored, so the next sync fetches them again.
+
+    Args:
+        failed_ids (Iterable[str]): IDs still missing after this sync.
+        previous (dict[str, int]): Failed attempts per ID before this sync (see `FAILED_IDS_KEY`).
+
+    Returns:
+        dict[str, int]: Failed attempts per ID still to be retried. IDs that reached
+            `MAX_FETCH_ATTEMPTS` are logged and left out.
+    """
+    attempts = {message_id: previous.get(message_id, 0) + 1 for message_id in failed_ids}
+    given_up = sorted(message_id for message_id, count in attempts.items() if count >= MAX_FETCH_ATTEMPTS)
+    if given_up:
+        logging.error(f"Giving up on {len(given_up)} messages that failed {MAX_FETCH_ATTEMPTS} syncs: {given_up}")
+    retry = {message_id: count for message_id, count in attempts.items() if count < MAX_FETCH_ATTEMPTS}
+    if retry:
+        logging.warning(f"{len(retry)} messages could not be stored and will be fetched again on the next sync")
+    set_sync_state(FAILED_IDS_KEY, json.dumps(retry) if retry else None)
+    return retry
+
+
+def apply_history_changes(service, db, changes, batch_size=DEFAULT_BATCH_SIZE,
+                          chunk_size=DEFAULT_CHUNK_SIZE, message_format="full"):
+    """
+    Applies the net changes from `collect_history_changes` to the `Email` table.
+
+    Only newly added messages are downloaded; deletions and relabels are applied
+    from the history records themselves. Messages an earlier sync failed to store
+    are fetched again along with them.
+
+    Returns:
+        dict: Counts of added, deleted and relabeled messages, `added_ids`, the IDs
+            of the stored messages, and `failed`, the number of messages that could
+            not be stored and will be retried (see `remember_failed_ids`).
+    """
+    deleted = sorted(changes["deleted"])
+    with db.atomic():
+        for start in range(0, len(deleted), ID_CHUNK_SIZE):
+            Email.delete().where(Email.id.in_(deleted[start:start + ID_CHUNK_SIZE])).execute()
+
+    previous_failures = json.loads(get_sync_state(FAILED_IDS_KEY) or "{}")
+    added = sorted(changes["added"] | (set(previous_failures) - changes["deleted"]))
+    new_ids = []
+    for start in range(0, len(added), ID_CHUNK_SIZE):
+        new_ids += filter_new_email_ids(added[start:start + ID_CHUNK_SIZE])
+    rows = iter_parsed_messages(service, new_ids, batch_size=batch_size, message_format=message_format)
+    stored = store_emails_in_chunks(db, rows, chunk_size=chunk_size)
+    missing = set()
+    for start in range(0, len(new_ids), ID_CHUNK_SIZE):
+        missing.update(filter_new_email_ids(new_ids[start:start + ID_CHUNK_SIZE]))
+    retry = remember_failed_ids(missing, previous_failures)
+
+    relabeled = 0
+    with db.atomic():
+        for message_id, label_ids in changes["labels"].items():
+            if message_id in changes["added"]:
+                continue
+            relabeled += Email.update(labels=",".join(label_ids)).where(
+                Email.id == message_id).execute()
+
+    return {"added": stored, "deleted": len(deleted), "relabeled": relabeled,
+            "added_ids": [message_id for message_id in new_ids if message_id not in missing], "failed": len(retry)}
+
+
+def reconcile_stored_emails(service, db, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Brings the stored messages in line with the mailbox without downloading them
+    again: stored messages that are no longer listed are deleted, and the labels
+    of the others are refreshed with `format=minimal` calls.
+
+    The listed IDs are kept in memory until the whole mailbox has been listed.
+
+    Returns:
+        dict: Counts of deleted and relabeled messages.
+    """
+    listed = set()
+    relabeled = 0
+    for message_ids, _ in iter_message_id_pages(service):
+        listed.update(message_ids)
+        new_ids = set(filter_new_email_ids(message_ids))
+        stored_ids = [message_id for message_id in message_ids if message_id not in new_ids]
+        messages = fetch_messages_batched(service, stored_ids, batch_size=batch_size, message_format="minimal")
+        with db.atomic():
+            for message in messages:
+                labels = ",".join(message.get("labelIds", []))
+                relabeled += Email.update(labels=labels).where(
+                    (Email.id == message["id"]) & (Email.labels != labels)).execute()
+
+    unlisted = [email_id for (email_id,) in Email.select(Email.id).tuples().iterator() if email_id not in listed]
+    with db.atomic():
+        for start in range(0, len(unlisted), ID_CHUNK_SIZE):
+            Email.delete().where(Email.id.in_(unlisted[start:start + ID_CHUNK_SIZE])).execute()
+    return {"deleted": len(unlisted), "relabeled": relabeled}
+
+
+def full_resync(service, db, batch_size=DEFAULT_BATCH_SIZE, chunk_size=DEFAULT_CHUNK_SIZE, message_format="full"):
+    """
+    Mirrors the whole mailbox and records the historyId incremental syncs start from.
+
+    The historyId is captured before listing starts, so changes made while the
+    resync runs are picked up by the next incremental sync. An interrupted resync
+    keeps the originally captured historyId when it resumes. `added_ids` is None
+    in the returned summary because any stored message may be new.
+
+    Messages already stored, e.g. when the history window expired, are first
+    reconciled with the mailbox (see `reconcile_stored_emails`), so deletions and
+    label changes made during the gap are not lost. A resync resuming from a page
+    checkpoint has done that already.
+
+    Listed messages that could not be stored are remembered and fetched again by
+    the next incremental sync (see `remember_failed_ids`).
+    """
+    pending_history_id = get_sync_state(PENDING_HISTORY_ID_KEY)
+    if not pending_history_id:
+        pending_history_id = execute_with_retry(service.users().getProfile(userId="me"),
+                                                method="users.getProfile")["historyId"]
+        set_sync_state(PENDING_HISTORY_ID_KEY, pending_history_id)
+
+    reconciled = {"deleted": 0, "relabeled": 0}
+    if not get_sync_state(PAGE_TOKEN_KEY) and Email.select().exists():
+        with api_priority("backfill"):
+            reconciled = reconcile_stored_emails(service, db, batch_size=batch_size)
+
+    failed_ids = []
+    stats = sync_all_emails(service, db, batch_size=batch_size, chunk_size=chunk_size,
+                            message_format=message_format, failed_ids=failed_ids)
+    retry = remember_failed_ids(failed_ids, json.loads(get_sync_state(FAILED_IDS_KEY) or "{}"))
+
+    set_sync_state(HISTORY_ID_KEY, pending_history_id)
+    set_sync_state(PENDING_HISTORY_ID_KEY, None)
+    return {"added": stats["inserted"], "deleted": reconciled["deleted"], "relabeled": reconciled["relabeled"],
+            "added_ids": None, "failed": len(retry), "full_resync": True}
+
+
+def sync_mailbox(service, db, batch_size=DEFAULT_BATCH_SIZE, chunk_size=DEFAULT_CHUNK_SIZE, message_format="full"):
+    """
+    Brings the database up to date with the mailbox using the cheapest available path.
+
+    Uses `users.history.list` from the stored historyId, and falls back to a full
+    resync only when no historyId is stored, a resync is still in progress, or
+    Gmail reports the historyId as expired. With `message_format="metadata"` new
+    messages are stored without their bodies (see `gmail_mail_fetch.load_missing_bodies`).
+
+    An incremental sync only moves the stored historyId forward once every added
+    message is stored: after a failed download the next sync reads the same
+    history again and fetches the failed messages along with it.
+
+    Incremental syncs call the API at "new_mail" priority, full resyncs at "backfill"
+    (see `gmail_api.api_priority`).
+
+    Returns:
+        dict: Counts of added, deleted and relabeled messages, the added IDs (None
+            after a full resync), the number of messages to retry and whether a full
+            resync ran.
+    """
+    start_history_id = get_sync_state(HISTORY_ID_KEY)
+    if not start_history_id or get_sync_state(PENDING_HISTORY_ID_KEY):
+        logging.info("No usable history ID stored, running a full resync")
+        return full_resync(service, db, batch_size=batch_size, chunk_size=chunk_size,
+                           message_format=message_format)
+
+    try:
+        with api_priority("new_mail"):
+            changes = collect_history_changes(service, start_history_id)
+    except HistoryExpiredError:
+        logging.warning("Stored history ID has expired, running a full resync")
+        set_sync_state(HISTORY_ID_KEY, None)
+        set_sync_state(PAGE_TOKEN_KEY, None)
+        return full_resync(service, db, batch_size=batch_size, chunk_size=chunk_size,
+                           message_format=message_format)
+
+    with api_priority("new_mail"):
+        summary = apply_history_changes(service, db, changes, batch_size=batch_size,
+                                        chunk_size=chunk_size, message_format=message_format)
+    if not summary["failed"]:
+        set_sync_state(HISTORY_ID_KEY, changes["history_id"])
+    summary["full_resync"] = False
+    return summary
+
+
+def sync_emails(testing=False, message_format="full", chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Incrementally syncs the local database with Gmail.
+
+    Args:
+        testing (bool): If True, uses a test database.
+        message_format (str): "full", or "metadata" to store headers only.
+        chunk_size (int): Rows written per transaction.
+
+    What this function does:
+    - Initialize the database and authenticate with Gmail API.
+    - Apply messages added, deleted or relabeled since the last stored historyId.
+    - Fall back to a full resync when the historyId has expired.
+    - Handle errors gracefully and log them.
+    """
+    db = None
+    try:
+        db = get_or_initialize_db(testing=testing)
+
+        service = get_gmail_service()
+
+        summary = sync_mailbox(service, db, chunk_size=chunk_size, message_format=message_format)
+        logging.info(
+            f"Sync finished: {summary['added']} added, {summary['deleted']} deleted, "
+            f"{summary['relabeled']} relabeled.")
+        return summary
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+    finally:
+        if db is not None:
+            db.close()
+
+
+if __name__ == "__main__":
+    sync_emails()
@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+import time
+
+from gmail_api import execute_with_retry
+
+
+DEFAULT_TTL_SECONDS = 3600
+
+
+class LabelRegistry:
+    """
+    Case-insensitive label name to label ID lookup, built from one `labels.list` call.
+
+    Args:
+        service: Authenticated Gmail API service.
+        cache_path (str | None): JSON file used to persist the labels between runs.
+        ttl (float): Seconds a persisted label list stays valid.
+        auto_create (bool): Create labels that do not exist instead of skipping them.
+        clock (callable): Wall-clock time source, replaceable in tests.
+    """
+
+    def __init__(self, service, cache_path=None, ttl=DEFAULT_TTL_SECONDS, auto_create=False, clock=time.time):
+        self.service = service
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.auto_create = auto_create
+        self.clock = clock
+        self.labels = None  # {lowercase name: label id}
+        self.fetched_at = None
+        self.refreshed_this_run = False
+
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path, "r") as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable label cache {self.cache_path}: {e}")
+            return False
+        if self.clock() - cached.get("fetched_at", 0) > self.ttl:
+            return False
+        self.labels = cached["labels"]
+        self.fetched_at = cached["fetched_at"]
+        return True
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        with open(self.cache_path, "w") as cache_file:
+            json.dump({"fetched_at": self.fetched_at, "labels": self.labels}, cache_file)
+
+    def refresh(self):
+        """Reloads all labels from Gmail and persists them if a cache path is set."""
+        response = execute_with_retry(
+            self.service.users().labels().list(userId="me"), method="labels.list")
+        self.labels = {label["name"].lower(): label["id"] for label in response.get("labels", [])}
+        self.fetched_at = self.clock()
+        self.refreshed_this_run = True
+        self._save_cache()
+
+    def start_run(self):
+        """Allows one more refresh on a miss, for registries reused across runs."""
+        self.refreshed_this_run = False
+
+    def invalidate(self):
+        """Forgets the known labels, in memory and on disk."""
+        self.labels = None
+        self.fetched_at = None
+        if self.cache_path and os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+
+    def _create(self, name):
+        label = execute_with_retry(self.service.users().labels().create(
+            userId="me", body={"name": name, "labelListVisibility": "labelShow",
+                               "messageListVisibility": "show"}), method="labels.create")
+        logging.info(f"Created missing label {name}")
+        self.labels[label["name"].lower()] = label["id"]
+        self._save_cache()
+        return label["id"]
+
+    def get_id(self, name):
+        """
+        Returns the ID of the label called `name` (case-insensitive).
+
+        A miss against cached labels triggers one refresh, in case the label was
+        created since they were fetched. A label that is still missing is created
+        when `auto_create` is set, otherwise None is returned.
+        """
+        if self.labels is None and not self._load_cache():
+            self.refresh()
+
+        label_id = self.labels.get(name.lower())
+        if label_id is None and not self.refreshed_this_run:
+            self.refresh()
+            label_id = self.labels.get(name.lower())
+        if label_id is None and self.auto_create:
+            label_id = self._create(name)
+        return label_id
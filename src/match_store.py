@@ -0,0 +1,270 @@
+"""
+Precomputed rule matches, kept up to date as emails are stored.
+
+The rules of the last rule run are the *active* rules (`ActiveRule`). Their
+matches live in the `RuleMatch` table, so a rule run reads them instead of
+evaluating every rule against the whole mailbox:
+
+- Emails inserted or changed while rules are active are queued by triggers in
+  `PendingRuleMatch`. The fetch paths evaluate them right after every insert
+  (`refresh_pending_matches`), and so does the rule run for anything written
+  another way.
+- Relative date conditions are not re-checked by scanning. Each match is
+  stored with the window in which its date conditions hold, e.g.
+  `received_at less_than 7 days` matches until received_at + 7 days, and the
+  read at time `now` only selects windows containing `now` through the
+  (rule_hash, valid_until) index. Expired windows can never match again and are
+  deleted by `purge_expired_matches`.
+- A rule that was not active yet is evaluated once over the stored emails when
+  it is activated. Rules missing from the program being activated are dropped
+  with their matches.
+- Rules with full-text conditions (`matches`) are never activated. They need the
+  FTS5 index, which may not exist, and are evaluated live on every rule run.
+"""
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from db_utils import (
+    ActiveRule, RuleMatch, PendingRuleMatch, Email, OPEN_START, OPEN_END, db_proxy
+)
+from rule_compiler import CompiledRule, Condition, RuleProgram
+from rule_engine import evaluate_rules, full_text_query
+from metrics import increment, stage
+
+# Emails evaluated per query; keeps `IN (...)` lists and inserts below SQLite's parameter limit.
+MATCH_CHUNK_SIZE = 500
+
+
+def date_windows(rule, received_at):
+    """
+    Returns the (valid_from, valid_until) windows in which the date conditions of a
+    rule hold for an email received at `received_at`, bounds excluded.
+
+    `less_than N` (received in the last N days) holds until received_at + N days,
+    `greater_than N` (older than N days) from received_at + N days on. An "All" rule
+    needs every window at once, so they are intersected; an "Any" rule needs one
+    of them, so overlapping windows are merged and the rest returned as they are
+    (a match is keyed by its start, so two windows may not share one).
+    """
+    windows = []
+    for condition in rule.conditions:
+        if not condition.is_date:
+            continue
+        boundary = received_at + timedelta(days=condition.value)
+        windows.append((OPEN_START, boundary) if condition.predicate == "less_than" else (boundary, OPEN_END))
+    if rule.predicate == "All" and windows:
+        windows = [(max(start for start, _ in windows), min(end for _, end in windows))]
+    merged = []
+    for start, end in sorted(window for window in windows if window[0] < window[1]):
+        if merged and start < merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _row_program(rules):
+    """The rules with their date conditions left out, renumbered, for `evaluate_rules`."""
+    return RuleProgram(rules=tuple(
+        CompiledRule(index=position, predicate=rule.predicate,
+                     conditions=tuple(condition for condition in rule.conditions if not condition.is_date),
+                     actions=(), rule_hash=rule.rule_hash)
+        for position, rule in enumerate(rules)), source_hash="")
+
+
+def _match_rows(rules, emails):
+    """Returns the `RuleMatch` rows of `rules` for (email ID, received_at) pairs."""
+    evaluated = [rule for rule in rules if any(not condition.is_date for condition in rule.conditions)]
+    hits = {}
+    if evaluated:
+        email_ids = [email_id for email_id, _ in emails]
+        row_matches = evaluate_rules(_row_program(evaluated), query=Email.id.in_(email_ids))
+        hits = {rule.rule_hash: row_matches[position] for position, rule in enumerate(evaluated)}
+
+    rows = []
+    for rule in rules:
+        matched = hits.get(rule.rule_hash)
+        has_dates = any(condition.is_date for condition in rule.conditions)
+        for email_id, received_at in emails:
+            # Without other conditions an "All" rule only depends on the dates, an "Any" rule
+            # only matches through them
+            row_match = email_id in matched if matched is not None else rule.predicate == "All"
+            if rule.predicate == "All":
+                if not row_match:
+                    continue
+                windows = date_windows(rule, received_at) if has_dates else [(OPEN_START, OPEN_END)]
+            else:
+                windows = [(OPEN_START, OPEN_END)] if row_match else date_windows(rule, received_at)
+            rows += [(rule.rule_hash, email_id, start, end) for start, end in windows]
+    return rows
+
+
+def record_matches(rules, email_ids):
+    """
+    Evaluates `rules` on the given emails and replaces their stored matches.
+
+    Emails that are no longer stored just lose their matches.
+
+    Returns:
+        int: Number of `RuleMatch` rows written.
+    """
+    email_ids = list(email_ids)
+    rule_hashes = [rule.rule_hash for rule in rules]
+    written = 0
+    for start in range(0, len(email_ids), MATCH_CHUNK_SIZE):
+        chunk = email_ids[start:start + MATCH_CHUNK_SIZE]
+        emails = list(Email.select(Email.id, Email.received_at).where(Email.id.in_(chunk)).tuples())
+        rows = _match_rows(rules, emails) if emails and rules else []
+        with db_proxy.atomic():
+            RuleMatch.delete().where(RuleMatch.email_id.in_(chunk) & RuleMatch.rule_hash.in_(rule_hashes)).execute()
+            fields = [RuleMatch.rule_hash, RuleMatch.email_id, RuleMatch.valid_from, RuleMatch.valid_until]
+            for row_start in range(0, len(rows), MATCH_CHUNK_SIZE):
+                RuleMatch.insert_many(rows[row_start:row_start + MATCH_CHUNK_SIZE], fields=fields).execute()
+        written += len(rows)
+    increment("rule_matches_recorded", written)
+    return written
+
+
+def active_rules():
+    """Returns the active rules as `CompiledRule`s (without actions, which matching does not need)."""
+    return [CompiledRule(index=position, predicate=rule.predicate,
+                         conditions=tuple(Condition(*condition) for condition in json.loads(rule.conditions)),
+                         actions=(), rule_hash=rule.rule_hash)
+            for position, rule in enumerate(ActiveRule.select().order_by(ActiveRule.rule_hash))]
+
+
+def activate_rules(program):
+    """
+    Makes the rules of `program` the active rules.
+
+    New rules are evaluated over every stored email first; rules that are no longer
+    in the program are dropped with their matches.
+
+    Returns:
+        list[str]: Hashes of the newly activated rules.
+    """
+    wanted = {}
+    for rule in program.rules:
+        wanted.setdefault(rule.rule_hash, rule)
+    active = {rule_hash for (rule_hash,) in ActiveRule.select(ActiveRule.rule_hash).tuples()}
+    dropped = sorted(active - set(wanted))
+    added = [rule for rule_hash, rule in wanted.items() if rule_hash not in active]
+
+    with db_proxy.atomic():
+        if dropped:
+            RuleMatch.delete().where(RuleMatch.rule_hash.in_(dropped)).execute()
+            ActiveRule.delete().where(ActiveRule.rule_hash.in_(dropped)).execute()
+        if active <= set(dropped):
+            # Nothing is queued while no rule is active; new rules are evaluated on everything below
+            PendingRuleMatch.delete().execute()
+
+    if added:
+        # Marked active only once evaluated everywhere, so an interrupted run starts over
+        logging.info(f"Evaluating {len(added)} new rules over the stored emails")
+        last_id = ""
+        while True:
+            chunk = [email_id for (email_id,) in Email.select(Email.id).where(Email.id > last_id)
+                     .order_by(Email.id).limit(MATCH_CHUNK_SIZE).tuples()]
+            if not chunk:
+                break
+            record_matches(added, chunk)
+            last_id = chunk[-1]
+        conditions = {rule.rule_hash: json.dumps([[condition.field, condition.predicate, condition.value]
+                                                  for condition in rule.conditions]) for rule in added}
+        ActiveRule.insert_many([(rule.rule_hash, rule.predicate, conditions[rule.rule_hash], datetime.now())
+                                for rule in added],
+                               fields=[ActiveRule.rule_hash, ActiveRule.predicate, ActiveRule.conditions,
+                                       ActiveRule.activated_at]).execute()
+    return [rule.rule_hash for rule in added]
+
+
+def refresh_pending_matches():
+    """
+    Evaluates the active rules on the emails queued since they were last evaluated.
+
+    Called after every insert by the fetch paths, so the rule run finds the
+    matches of new emails already stored. Cheap when nothing is queued.
+
+    Returns:
+        int: Number of emails evaluated.
+    """
+    evaluated = 0
+    rules = None
+    while True:
+        chunk = [email_id for (email_id,) in PendingRuleMatch.select(PendingRuleMatch.email_id)
+                 .limit(MATCH_CHUNK_SIZE).tuples()]
+        if not chunk:
+            return evaluated
+        if rules is None:
+            rules = active_rules()
+        with stage("match"):
+            record_matches(rules, chunk)
+        PendingRuleMatch.delete().where(PendingRuleMatch.email_id.in_(chunk)).execute()
+        evaluated += len(chunk)
+
+
+def read_matches(program, now, email_ids=None):
+    """
+    Returns the stored matches of the rules of `program` at time `now`.
+
+    Args:
+        program (RuleProgram): Active rules (see `activate_rules`).
+        now (datetime): Reference time for the relative date conditions.
+        email_ids (list[str] | None): Only return matches of these emails.
+
+    Returns:
+        dict[int, set[str]]: Matching email IDs per rule index, like `rule_engine.evaluate_rules`.
+    """
+    matches = {rule.index: set() for rule in program.rules}
+    indexes = defaultdict(list)
+    for rule in program.rules:
+        indexes[rule.rule_hash].append(rule.index)
+    if not indexes:
+        return matches
+
+    current = (RuleMatch.rule_hash.in_(list(indexes)) & (RuleMatch.valid_until > now)
+               & (RuleMatch.valid_from < now))
+    if email_ids is None:
+        filters = [current]
+    else:
+        filters = [current & RuleMatch.email_id.in_(email_ids[start:start + MATCH_CHUNK_SIZE])
+                   for start in range(0, len(email_ids), MATCH_CHUNK_SIZE)]
+    for where in filters:
+        for rule_hash, email_id in RuleMatch.select(RuleMatch.rule_hash, RuleMatch.email_id).where(where).tuples():
+            for index in indexes[rule_hash]:
+                matches[index].add(email_id)
+    return matches
+
+
+def purge_expired_matches(now):
+    """Deletes the matches whose window closed before `now`. Returns how many were deleted."""
+    return RuleMatch.delete().where(RuleMatch.valid_until <= now).execute()
+
+
+def uses_full_text(rule):
+    """True if a condition of `rule` can only be answered by the FTS5 index."""
+    return any(full_text_query(condition) is not None for condition in rule.conditions)
+
+
+def precomputed_matches(program, now, email_ids=None):
+    """
+    Returns the matches of `program` at `now` from the match tables, activating
+    the program and evaluating queued emails first.
+
+    Same result as `rule_engine.evaluate_rules(program, ...)`, but only new emails
+    and newly activated rules are evaluated. Rules with full-text conditions are
+    left out of the match tables and evaluated live.
+    """
+    stored = RuleProgram(rules=tuple(rule for rule in program.rules if not uses_full_text(rule)),
+                         source_hash=program.source_hash)
+    live = RuleProgram(rules=tuple(rule for rule in program.rules if uses_full_text(rule)),
+                       source_hash=program.source_hash)
+    activate_rules(stored)
+    refresh_pending_matches()
+    matches = read_matches(stored, now, email_ids)
+    if live.rules:
+        query = Email.id.in_(list(email_ids)) if email_ids is not None else None
+        matches.update(evaluate_rules(live, query=query, now=now))
+    return matches
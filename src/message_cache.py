@@ -0,0 +1,158 @@
+"""
+On-disk cache of raw (RFC 822) Gmail messages.
+
+Message contents are stored once per SHA-256 digest under `objects/`, and a small
+SQLite index maps message IDs to digests. When the cache grows past its size
+limit, the least recently used contents are evicted first.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_DIR = "message_cache"
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024  # 1 GiB
+
+# Keeps `IN (...)` clauses well below SQLite's bound parameter limit.
+LOOKUP_CHUNK_SIZE = 500
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS blob (
+        digest TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS blob_last_access ON blob (last_access)",
+    """CREATE TABLE IF NOT EXISTS message (
+        message_id TEXT PRIMARY KEY, digest TEXT NOT NULL REFERENCES blob (digest))""",
+    "CREATE INDEX IF NOT EXISTS message_digest ON message (digest)",
+)
+
+
+class MessageCache:
+    """
+    Content-addressed, size-bounded LRU cache of raw messages keyed by message ID.
+
+    Safe to share between threads.
+
+    Args:
+        directory (str): Cache directory, created if missing.
+        max_bytes (int): Total size of the cached contents above which the least
+            recently used ones are evicted.
+        clock (callable): Wall-clock time source, replaceable in tests.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, clock=time.time):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode = wal")
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+        self.total_bytes = self.connection.execute("SELECT coalesce(sum(size), 0) FROM blob").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def get_many(self, message_ids):
+        """
+        Returns the cached raw messages among `message_ids` and marks them as recently used.
+
+        Returns:
+            dict[str, bytes]: Raw message by ID. Missing IDs are left out.
+        """
+        message_ids = list(message_ids)
+        found = {}
+        with self.lock:
+            digests = {}
+            for start in range(0, len(message_ids), LOOKUP_CHUNK_SIZE):
+                chunk = message_ids[start:start + LOOKUP_CHUNK_SIZE]
+                digests.update(self.connection.execute(
+                    f"SELECT message_id, digest FROM message WHERE message_id IN ({','.join('?' * len(chunk))})",
+                    chunk).fetchall())
+            for message_id, digest in digests.items():
+                try:
+                    with open(self._path(digest), "rb") as blob:
+                        found[message_id] = blob.read()
+                except OSError:
+                    logging.warning(f"Cached content of message {message_id} is missing, dropping it")
+                    self._forget(digest)
+            now = self.clock()
+            with self.connection:
+                self.connection.executemany("UPDATE blob SET last_access = ? WHERE digest = ?",
+                                            [(now, digests[message_id]) for message_id in found])
+        return found
+
+    def get(self, message_id):
+        """Returns the cached raw message, or None."""
+        return self.get_many([message_id]).get(message_id)
+
+    def put(self, message_id, raw):
+        """
+        Stores a raw message. Identical contents are kept only once.
+
+        Returns:
+            str: SHA-256 digest of the contents.
+        """
+        digest = hashlib.sha256(raw).hexdigest()
+        with self.lock:
+            path = self._path(digest)
+            known = self.connection.execute("SELECT 1 FROM blob WHERE digest = ?", (digest,)).fetchone()
+            if not known:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temporary = f"{path}.{threading.get_ident()}.tmp"
+                with open(temporary, "wb") as blob:
+                    blob.write(raw)
+                os.replace(temporary, path)  # Readers never see a partly written file
+                self.total_bytes += len(raw)
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO blob (digest, size, last_access) VALUES (?, ?, ?)",
+                                        (digest, len(raw), self.clock()))
+                self.connection.execute("INSERT OR REPLACE INTO message (message_id, digest) VALUES (?, ?)",
+                                        (message_id, digest))
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+        return digest
+
+    def _forget(self, digest):
+        row = self.connection.execute("SELECT size FROM blob WHERE digest = ?", (digest,)).fetchone()
+        with self.connection:
+            self.connection.execute("DELETE FROM message WHERE digest = ?", (digest,))
+            self.connection.execute("DELETE FROM blob WHERE digest = ?", (digest,))
+        if row:
+            self.total_bytes -= row[0]
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        """Drops least recently used contents until the cache fits in `max_bytes`."""
+        evicted = 0
+        cursor = self.connection.execute("SELECT digest FROM blob ORDER BY last_access")
+        for (digest,) in cursor.fetchall():
+            if self.total_bytes <= self.max_bytes:
+                break
+            self._forget(digest)
+            evicted += 1
+        logging.info(f"Evicted {evicted} messages from the cache, {self.total_bytes} bytes left")
+
+    def message_ids(self):
+        """Returns the IDs of every cached message."""
+        with self.lock:
+            return [message_id for (message_id,) in self.connection.execute("SELECT message_id FROM message")]
+
+    def __contains__(self, message_id):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT 1 FROM message WHERE message_id = ?", (message_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT count(*) FROM message").fetchone()[0]
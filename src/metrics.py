@@ -0,0 +1,226 @@
+"""
+In-process metrics and profiling for fetch and rule runs.
+
+The code records into one process-wide registry, `METRICS`:
+- stage timers (`stage("list")`, `stage("get")`, ... ) with call count, total and max seconds;
+- counters, e.g. API calls by method or rows scanned per rule;
+- gauges, e.g. the peak traced memory.
+
+At the end of a run the registry is written as JSON or as a Prometheus text file
+(for the node exporter textfile collector). Recording is a dictionary update
+under a lock, cheap enough to leave on; the cProfile / tracemalloc hook in
+`profiled` is opt-in.
+
+Entry points add the shared command line flags with `add_arguments` and wrap
+their work in `instrumented(args)`.
+"""
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+
+PROMETHEUS_PREFIX = "gmail_processor_"
+PROFILE_KINDS = ("cpu", "memory")
+PROFILE_TOP = 25
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, gauges and timers, each keyed by a name and labels.
+
+    Args:
+        clock (callable): Monotonic time source for the timers, replaceable in tests.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+
+    def increment(self, name, value=1, **labels):
+        """Adds `value` to a counter."""
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Sets a gauge to `value`."""
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        """Records one timed call of `seconds`."""
+        key = _key(name, labels)
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                timer = self.timers[key] = {"count": 0, "sum": 0.0, "max": 0.0}
+            timer["count"] += 1
+            timer["sum"] += seconds
+            timer["max"] = max(timer["max"], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Times the `with` block, also when it raises."""
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.observe(name, self.clock() - started, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timers.clear()
+
+    def snapshot(self):
+        """
+        Returns every metric as a JSON-serializable dict:
+        {"counters": {name: [{"labels": {...}, "value": n}]}, "gauges": {...},
+         "timers": {name: [{"labels": {...}, "count": n, "sum": s, "max": s}]}}
+        """
+        with self.lock:
+            snapshot = {"counters": {}, "gauges": {}, "timers": {}}
+            for kind, values in (("counters", self.counters), ("gauges", self.gauges)):
+                for (name, labels), value in sorted(values.items()):
+                    snapshot[kind].setdefault(name, []).append({"labels": dict(labels), "value": value})
+            for (name, labels), timer in sorted(self.timers.items()):
+                snapshot["timers"].setdefault(name, []).append({"labels": dict(labels), **timer})
+        return snapshot
+
+    def to_prometheus(self, prefix=PROMETHEUS_PREFIX):
+        """Returns the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, samples in snapshot["counters"].items():
+            lines.append(f"# TYPE {prefix}{name}_total counter")
+            lines += [f"{prefix}{name}_total{_labels(sample['labels'])} {sample['value']}" for sample in samples]
+        for name, samples in snapshot["gauges"].items():
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            lines += [f"{prefix}{name}{_labels(sample['labels'])} {sample['value']}" for sample in samples]
+        for name, samples in snapshot["timers"].items():
+            lines.append(f"# TYPE {prefix}{name} summary")
+            for sample in samples:
+                labels = _labels(sample["labels"])
+                lines.append(f"{prefix}{name}_sum{labels} {sample['sum']:.6f}")
+                lines.append(f"{prefix}{name}_count{labels} {sample['count']}")
+            lines.append(f"# TYPE {prefix}{name}_max gauge")
+            lines += [f"{prefix}{name}_max{_labels(sample['labels'])} {sample['max']:.6f}" for sample in samples]
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        with open(path, "w") as metrics_file:
+            json.dump(self.snapshot(), metrics_file, indent=2)
+
+    def write_prometheus(self, path):
+        # Written next to the target and renamed, so a collector never reads half a file
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w") as metrics_file:
+            metrics_file.write(self.to_prometheus())
+        os.replace(temporary_path, path)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+METRICS = Metrics()
+
+
+def increment(name, value=1, **labels):
+    """Adds `value` to a counter of the process-wide registry."""
+    METRICS.increment(name, value, **labels)
+
+
+def stage(name):
+    """Times a pipeline stage (list, get, parse, insert, query, modify) in the process-wide registry."""
+    return METRICS.timer("stage_seconds", stage=name)
+
+
+@contextlib.contextmanager
+def profiled(kind=None, output_path=None, top=PROFILE_TOP):
+    """
+    Profiles the `with` block, if asked to.
+
+    Args:
+        kind (str | None): "cpu" for cProfile, "memory" for tracemalloc, None to do nothing.
+        output_path (str | None): Where to dump the raw profile (`pstats` file or
+            tracemalloc snapshot) for later inspection.
+        top (int): Number of functions / allocation sites logged at the end.
+    """
+    if kind is None:
+        yield
+        return
+    if kind not in PROFILE_KINDS:
+        raise ValueError(f"kind must be one of {PROFILE_KINDS}, got {kind!r}")
+
+    if kind == "cpu":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if output_path:
+                profiler.dump_stats(output_path)
+            text = io.StringIO()
+            pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(top)
+            logging.info(f"CPU profile, top {top} functions by cumulative time:\n{text.getvalue()}")
+        return
+
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        METRICS.set("memory_peak_bytes", peak)
+        if output_path:
+            snapshot.dump(output_path)
+        lines = [str(statistic) for statistic in snapshot.statistics("lineno")[:top]]
+        logging.info(f"Peak traced memory {peak / 1024 / 1024:.1f} MiB, top {top} allocation sites:\n"
+                     + "\n".join(lines))
+
+
+def add_arguments(parser):
+    """Adds the shared --verbose, --metrics-* and --profile flags to an entry point's parser."""
+    parser.add_argument("--verbose", action="store_true",
+                        help="Log every message and API call (debug level) instead of per-run summaries.")
+    parser.add_argument("--metrics-json", help="Write the run metrics as JSON to this file.")
+    parser.add_argument("--metrics-prom", help="Write the run metrics in the Prometheus text format to this file.")
+    parser.add_argument("--profile", choices=PROFILE_KINDS, help="Profile the run with cProfile or tracemalloc.")
+    parser.add_argument("--profile-output", help="Dump the raw profile to this file.")
+
+
+@contextlib.contextmanager
+def instrumented(args):
+    """Applies the flags from `add_arguments` around a run, writing the metrics at the end."""
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+    try:
+        with profiled(args.profile, args.profile_output):
+            yield METRICS
+    finally:
+        if args.metrics_json:
+            METRICS.write_json(args.metrics_json)
+        if args.metrics_prom:
+            METRICS.write_prometheus(args.metrics_prom)
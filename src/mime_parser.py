@@ -0,0 +1,208 @@
+"""
+Plain-text body extraction from Gmail API message payloads.
+
+Gmail returns the MIME tree of a message as nested `payload.parts`, with each
+leaf's content transfer-decoded but still base64url encoded in `body.data`.
+Raw RFC 822 messages (`format=raw`, or the message cache) are handled too.
+"""
+import base64
+import binascii
+import codecs
+import email
+import email.policy
+import html
+import logging
+import re
+
+DEFAULT_CHARSET = "utf-8"
+
+# The body of the first of these types found in the tree is stored, in this order of preference.
+TEXT_TYPES = ("text/plain", "text/html")
+
+# HTML is longer than the text it holds, so a capped HTML part is decoded this much further.
+HTML_OVERSCAN = 4
+
+CHARSET = re.compile(r"""charset\s*=\s*["']?([\w.:-]+)""", re.IGNORECASE)
+INVISIBLE_HTML = re.compile(r"<(script|style|head|title)\b.*?</\1\s*>|<!--.*?-->", re.IGNORECASE | re.DOTALL)
+BLOCK_BREAK = re.compile(r"<(?:br|/p|/div|/tr|/li|/h[1-6])\b[^>]*>", re.IGNORECASE)
+TAG = re.compile(r"<[^>]*>")
+# Runs of spaces and any other horizontal whitespace; single spaces are left alone, which is most of them.
+SPACES = re.compile(r"[ \t\r\f\v\xa0]{2,}|[\t\r\f\v\xa0]")
+BLANK_LINES = re.compile(r"\n\s*\n+")
+
+
+def _header(part, name):
+    name = name.lower()
+    for header in part.get("headers", ()):
+        if header.get("name", "").lower() == name:
+            return header.get("value", "")
+    return ""
+
+
+def _is_attachment(part):
+    return bool(part.get("filename")) or _header(part, "Content-Disposition").lower().startswith("attachment")
+
+
+def find_text_parts(payload):
+    """
+    Walks the MIME tree without recursion and returns the first inline part of each
+    type in `TEXT_TYPES` that has data, in document order.
+
+    Returns:
+        dict[str, dict]: {mime type: part}.
+    """
+    found = {}
+    stack = [payload]
+    while stack and len(found) < len(TEXT_TYPES):
+        part = stack.pop()
+        mime_type = (part.get("mimeType") or "").lower()
+        if mime_type.startswith("multipart/"):
+            stack.extend(reversed(part.get("parts", ())))
+        elif mime_type in TEXT_TYPES and mime_type not in found and not _is_attachment(part):
+            if part.get("body", {}).get("data"):
+                found[mime_type] = part
+        elif part.get("parts"):
+            # message/rfc822 and parts without a type can still carry children
+            stack.extend(reversed(part["parts"]))
+    return found
+
+
+def decode_part(part, max_bytes=None):
+    """
+    Decodes the text of a leaf part, in its declared charset.
+
+    Args:
+        part (dict): MIME part with base64url data in `body.data`.
+        max_bytes (int | None): Decode at most about this many bytes of the part.
+            Only the matching prefix of the base64 data is decoded.
+
+    Returns:
+        str: The decoded text. Undecodable bytes are replaced, never raised.
+    """
+    data = part["body"]["data"]
+    final = True
+    if max_bytes is not None and len(data) > (max_bytes + 2) // 3 * 4:
+        data = data[:(max_bytes + 2) // 3 * 4]
+        final = False  # A multi-byte character may be cut in two at the end
+    data += "=" * (-len(data) % 4)
+    try:
+        raw = base64.urlsafe_b64decode(data)
+    except (binascii.Error, ValueError) as e:
+        logging.error(f"Undecodable {part.get('mimeType')} part: {e}")
+        return ""
+
+    return _decode_text(raw, _header(part, "Content-Type"), final)
+
+
+def _decode_text(raw, content_type, final=True):
+    match = CHARSET.search(content_type)
+    charset = match.group(1) if match else DEFAULT_CHARSET
+    try:
+        decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+    except LookupError:
+        logging.warning(f"Unknown charset {charset!r}, decoding as {DEFAULT_CHARSET}")
+        decoder = codecs.getincrementaldecoder(DEFAULT_CHARSET)(errors="replace")
+    return decoder.decode(raw, final=final)
+
+
+def strip_html(markup):
+    """Cheap HTML to text conversion: drops scripts, styles and tags, keeps line breaks."""
+    text = INVISIBLE_HTML.sub("", markup)
+    text = BLOCK_BREAK.sub("\n", text)
+    text = html.unescape(TAG.sub("", text))
+    text = SPACES.sub(" ", text)
+    return BLANK_LINES.sub("\n\n", text).strip()
+
+
+def truncate_utf8(text, max_bytes):
+    """Cuts `text` to at most `max_bytes` of UTF-8 without splitting a character."""
+    if max_bytes is None or len(text) * 4 <= max_bytes:
+        return text
+    return text.encode("utf-8")[:max_bytes].decode("utf-8", "ignore")
+
+
+def extract_body(payload, max_bytes=None):
+    """
+    Returns the plain-text body of a message payload.
+
+    The first inline text/plain part anywhere in the MIME tree is used; messages
+    without one fall back to their first text/html part with the tags stripped.
+    Single-part messages carry the text in `payload.body.data` and are handled
+    the same way. Only the chosen part is decoded.
+
+    Args:
+        payload (dict): `payload` of a `users.messages.get` response.
+        max_bytes (int | None): Cap on the UTF-8 size of the returned body.
+
+    Returns:
+        str: The body, or "" if the message has no text part.
+    """
+    parts = find_text_parts(payload)
+    if "text/plain" in parts:
+        return truncate_utf8(decode_part(parts["text/plain"], max_bytes), max_bytes)
+    if "text/html" in parts:
+        overscan = max_bytes * HTML_OVERSCAN if max_bytes is not None else None
+        return truncate_utf8(strip_html(decode_part(parts["text/html"], overscan)), max_bytes)
+    return ""
+
+
+def extract_body_from_raw(raw, max_bytes=None):
+    """
+    Returns the plain-text body of a raw RFC 822 message, chosen like `extract_body`.
+
+    Args:
+        raw (bytes): The message as returned by `format=raw` (base64url decoded).
+        max_bytes (int | None): Cap on the UTF-8 size of the returned body.
+    """
+    message = email.message_from_bytes(raw, policy=email.policy.compat32)
+    found = {}
+    stack = [message]
+    while stack and len(found) < len(TEXT_TYPES):
+        part = stack.pop()
+        if part.is_multipart():
+            stack.extend(reversed(part.get_payload()))
+            continue
+        mime_type = part.get_content_type()
+        attachment = part.get_filename() or (part.get("Content-Disposition") or "").lower().startswith("attachment")
+        if mime_type in TEXT_TYPES and mime_type not in found and not attachment:
+            found[mime_type] = part
+
+    for mime_type in TEXT_TYPES:
+        if mime_type in found:
+            part = found[mime_type]
+            text = _decode_text(part.get_payload(decode=True) or b"", part.get("Content-Type", ""))
+            if mime_type == "text/html":
+                text = strip_html(text)
+            return truncate_utf8(text, max_bytes)
+    return ""
+
+
+# Levels of nested MIME parts kept by the partial response of `partial_fields`.
+PARTIAL_DEPTH = 4
+
+
+def partial_fields(depth=PARTIAL_DEPTH):
+    """
+    Returns the `payload` selector of a partial response that keeps what
+    `extract_body` reads, down to `depth` levels of nested parts.
+
+    Deeper parts are left out of the response (see `is_truncated`).
+    """
+    part = "mimeType,filename,headers(name,value),body/data"
+    for _ in range(depth):
+        part = f"mimeType,filename,headers(name,value),body/data,parts({part})"
+    return f"payload({part})"
+
+
+def is_truncated(payload):
+    """
+    Returns True if a partial response cut the MIME tree of `payload` short: a
+    multipart part came back without its parts, so its text may be missing.
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get("mimeType", "").startswith("multipart/") and not part.get("parts"):
+            return True
+        stack.extend(part.get("parts", []))
+    return False
@@ -0,0 +1,246 @@
+"""
+Syncs and applies rules for several mailboxes at once, one worker process per account.
+
+Accounts are listed in a JSON config:
+
+    {
+      "defaults": {"rules": "rules.json"},
+      "accounts": [
+        {"name": "work", "token": "tokens/work.json", "database": "work.db"},
+        {"name": "home", "token": "tokens/home.json", "database": "home.db", "rules": "home_rules.json"}
+      ]
+    }
+
+Every account has its own token, database, label cache and Gmail quota, so the
+accounts run fully isolated and in parallel. A failing account is reported in
+the combined summary without affecting the others.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils import authenticate_gmail, CLIENT_SECRETS_PATH
+from gmail_client import get_gmail_client
+from db_utils import get_or_initialize_db
+from gmail_api import configure_scheduler
+from history_sync import sync_mailbox
+from rule_compiler import load_rule_program
+from label_registry import LabelRegistry
+from message_cache import MessageCache
+from process_mail import apply_rules
+from action_executor import format_report
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+ACCOUNT_KEYS = {"name", "token", "database", "rules", "label_cache", "cache_dir", "client_secrets",
+                "message_format"}
+REQUIRED_ACCOUNT_KEYS = ("name", "token", "database", "rules")
+
+
+class AccountConfigError(ValueError):
+    """Raised when an accounts file is invalid. Lists every problem found."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("Invalid accounts config:\n" + "\n".join(f"- {error}" for error in errors))
+
+
+def load_accounts(config_path):
+    """
+    Reads and validates an accounts config (see the module docstring).
+
+    `defaults` are merged into every account, and relative paths are resolved
+    against the directory of the config file.
+
+    Returns:
+        list[dict]: One dict per account with at least name, token, database and rules.
+
+    Raises:
+        AccountConfigError: If accounts are missing keys, have unknown keys or share a
+            name, token or database.
+    """
+    with open(config_path, "r") as config_file:
+        try:
+            config = json.load(config_file)
+        except ValueError as e:
+            raise AccountConfigError([f"{config_path}: not valid JSON ({e})"]) from e
+    if not isinstance(config, dict) or not isinstance(config.get("accounts"), list):
+        raise AccountConfigError(["expected an object with an 'accounts' list"])
+
+    base_dir = os.path.dirname(os.path.abspath(config_path))
+    defaults = config.get("defaults", {})
+    accounts, errors = [], []
+    for index, entry in enumerate(config["accounts"]):
+        location = f"accounts[{index}]"
+        if not isinstance(entry, dict):
+            errors.append(f"{location}: expected an object")
+            continue
+        account = {**defaults, **entry}
+        errors += [f"{location}: unknown key '{key}'" for key in sorted(set(account) - ACCOUNT_KEYS)]
+        errors += [f"{location}: missing '{key}'" for key in REQUIRED_ACCOUNT_KEYS if not account.get(key)]
+        name = account.get("name", str(index))
+        account.setdefault("label_cache", f"labels_cache_{name}.json")
+        for key in ("token", "database", "rules", "label_cache", "cache_dir", "client_secrets"):
+            if account.get(key):
+                account[key] = os.path.join(base_dir, account[key])
+        accounts.append(account)
+
+    for key in ("name", "token", "database"):
+        values = [account.get(key) for account in accounts if account.get(key)]
+        errors += [f"accounts: '{key}' {value!r} is used by several accounts"
+                   for value in sorted({value for value in values if values.count(value) > 1})]
+    if errors:
+        raise AccountConfigError(errors)
+    return accounts
+
+
+def process_account(account, service=None, sync=True, dry_run=False, full_text=False):
+    """
+    Syncs one mailbox and applies its rules. Runs in a worker process.
+
+    Args:
+        account (dict): Account from `load_accounts`.
+        service: Gmail API service to use instead of authenticating with the account token.
+        sync (bool): Sync the mailbox before applying the rules.
+        dry_run (bool): Plan the label changes without applying them.
+        full_text (bool): Answer word-style `contains` conditions through the FTS5 index.
+
+    Returns:
+        dict: {"account", "ok", "error", "elapsed", "sync", "report"}. Errors are
+        returned rather than raised, so one account cannot stop the others.
+    """
+    started = time.perf_counter()
+    result = {"account": account["name"], "ok": False, "error": None, "sync": None, "report": None}
+    db = None
+    try:
+        # A worker process can run several accounts in turn, and each has its own quota
+        configure_scheduler()
+        db = get_or_initialize_db(db_name=account["database"])
+        http_factory = None
+        if service is None:
+            client = get_gmail_client(account["token"], account.get("client_secrets", CLIENT_SECRETS_PATH),
+                                      interactive=False)
+            service = client.service()
+            http_factory = client.http
+
+        if sync:
+            summary = sync_mailbox(service, db, message_format=account.get("message_format", "full"))
+            result["sync"] = {key: value for key, value in summary.items() if key != "added_ids"}
+
+        program = load_rule_program(account["rules"])
+        label_registry = LabelRegistry(service, cache_path=account["label_cache"])
+        cache = MessageCache(account["cache_dir"]) if account.get("cache_dir") else None
+        report = apply_rules(service, program, label_registry, dry_run=dry_run, full_text=full_text, cache=cache,
+                             http_factory=http_factory)
+        logging.info(f"[{account['name']}] {format_report(report)}")
+        result["report"] = report.summary()
+        result["ok"] = report.ok
+    except Exception as e:
+        logging.error(f"[{account['name']}] Processing failed: {e}")
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if db is not None:
+            db.close()
+    result["elapsed"] = time.perf_counter() - started
+    return result
+
+
+def run_accounts(accounts, max_processes=None, worker=process_account, **options):
+    """
+    Processes every account in a pool of worker processes.
+
+    Args:
+        accounts (list[dict]): Accounts from `load_accounts`.
+        max_processes (int | None): Pool size. Defaults to one process per account,
+            capped at the number of CPUs.
+        worker (callable): Picklable function called as `worker(account, **options)`.
+        **options: Passed to `worker` (see `process_account`).
+
+    Returns:
+        list[dict]: Per-account results, in config order.
+    """
+    if not accounts:
+        return []
+    max_processes = max_processes or min(len(accounts), os.cpu_count() or 1)
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_processes) as executor:
+        futures = {executor.submit(worker, account, **options): account["name"] for account in accounts}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:  # The worker process itself died
+                logging.error(f"[{name}] Worker failed: {e}")
+                results[name] = {"account": name, "ok": False, "error": f"{type(e).__name__}: {e}",
+                                 "sync": None, "report": None, "elapsed": None}
+    return [results[account["name"]] for account in accounts]
+
+
+def combine_results(results):
+    """Returns totals over the per-account results from `run_accounts`."""
+    totals = {"accounts": len(results), "failed_accounts": [result["account"] for result in results
+                                                            if result["error"] or not result["ok"]],
+              "added": 0, "deleted": 0, "relabeled": 0, "calls": 0, "failed_emails": 0}
+    for result in results:
+        for key in ("added", "deleted", "relabeled"):
+            totals[key] += (result["sync"] or {}).get(key, 0)
+        totals["calls"] += (result["report"] or {}).get("calls", 0)
+        totals["failed_emails"] += (result["report"] or {}).get("failed_emails", 0)
+    return totals
+
+
+def format_results(results):
+    """Returns a human readable combined summary, one line per account."""
+    lines = []
+    for result in results:
+        if result["error"]:
+            lines.append(f"{result['account']}: FAILED - {result['error']}")
+            continue
+        sync = result["sync"] or {}
+        report = result["report"] or {}
+        lines.append(f"{result['account']}: {sync.get('added', 0)} added, {sync.get('deleted', 0)} deleted, "
+                     f"{report.get('calls', 0)} API calls, {report.get('failed_emails', 0)} failed emails "
+                     f"in {result['elapsed']:.1f}s")
+    totals = combine_results(results)
+    lines.append(f"Total: {totals['accounts']} accounts, {totals['added']} added, {totals['calls']} API calls, "
+                 f"{len(totals['failed_accounts'])} with failures")
+    return "\n".join(lines)
+
+
+def authorize_accounts(accounts):
+    """Runs the browser authorization flow, one account at a time, for accounts without a valid token."""
+    for account in accounts:
+        logging.info(f"Authorizing {account['name']} ({account['token']})")
+        os.makedirs(os.path.dirname(account["token"]) or ".", exist_ok=True)
+        authenticate_gmail(account["token"], account.get("client_secrets", CLIENT_SECRETS_PATH))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync and apply rules for every account in a config file.")
+    parser.add_argument("--config", default="accounts.json", help="Accounts config file.")
+    parser.add_argument("--processes", type=int, help="Worker processes (default: one per account, up to the CPUs).")
+    parser.add_argument("--authorize", action="store_true",
+                        help="Authorize the accounts that have no valid token yet, then exit.")
+    parser.add_argument("--no-sync", action="store_true", help="Only apply the rules to the stored emails.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Print the planned label changes without applying them.")
+    parser.add_argument("--fts", action="store_true",
+                        help="Answer word-style contains conditions through the full-text index.")
+    parser.add_argument("--summary", help="Write the per-account results as JSON to this file.")
+    args = parser.parse_args()
+
+    accounts = load_accounts(args.config)
+    if args.authorize:
+        authorize_accounts(accounts)
+    else:
+        results = run_accounts(accounts, max_processes=args.processes, sync=not args.no_sync,
+                               dry_run=args.dry_run, full_text=args.fts)
+        logging.info("\n" + format_results(results))
+        if args.summary:
+            with open(args.summary, "w") as summary_file:
+                json.dump({"totals": combine_results(results), "accounts": results}, summary_file, indent=2)
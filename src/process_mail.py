@@ -1,37 +1,175 @@
+import argparse
 import json
 import os
 import sys
 import logging
-from datetime import datetime, timedelta
-from googleapiclient.discovery import build
-from utils import authenticate_gmail
-from db_utils import Email, get_or_initialize_db
-from peewee import DateTimeField
-from functools import reduce
-import operator
+from collections import defaultdict
+from datetime import datetime
+from gmail_client import get_gmail_client
+from db_utils import get_or_initialize_db, Email
+from rule_compiler import load_rule_program
+from rule_engine import evaluate_rules
+from match_store import precomputed_matches, purge_expired_matches
+from label_registry import LabelRegistry
+from action_planner import plan_actions, format_plan
+from action_executor import ExecutionReport, execute_plan_concurrently, format_report, DEFAULT_MAX_WORKERS
+from action_journal import filter_unapplied, record_applied
+from gmail_mail_fetch import load_missing_bodies
+from message_cache import MessageCache, DEFAULT_CACHE_DIR
+from metrics import stage, add_arguments, instrumented
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+LABEL_CACHE_PATH = "labels_cache.json"
+
 
 # def load_rules():
 #     logging.info("Loading rules from rules.json")
 #     with open("rules.json", "r") as file:
 #         return json.load(file)
 
-def process_emails_based_on_rules(rules_path, testing=False):
+def apply_rules(service, program, label_registry, email_ids=None, dry_run=False, full_text=False, now=None,
+                force=False, cache=None, max_workers=DEFAULT_MAX_WORKERS, rate_limiter=None, http_factory=None,
+                precomputed=True):
+    """
+    Evaluates a compiled rule program and applies the resulting label changes.
+
+    Every applied action is journaled per (email, rule hash, action), and journaled
+    actions are skipped on later runs. Editing a rule changes its hash, so the
+    edited rule is applied again to the emails it matches.
+
+    Batches are sent concurrently (see `action_executor.execute_plan_concurrently`).
+    A batch that keeps failing is reported and left out of the journal, so the next
+    run retries it, while the other batches are still applied and journaled.
+
+    Matches are read from the precomputed match tables (see `match_store`), so only
+    emails stored since the last run, and rules that changed, are evaluated. Rules
+    with full-text conditions are evaluated live.
+
+    Args:
+        service: Authenticated Gmail API service.
+        program (RuleProgram): Compiled rules.
+        label_registry (LabelRegistry): Resolves `move_to_<label>` names to label IDs.
+        email_ids (Iterable[str] | None): Only evaluate these emails. Defaults to every stored email.
+        dry_run (bool): If True, print the planned label changes instead of applying them.
+        full_text (bool): Answer word-style `contains` conditions through the FTS5 index.
+        now (datetime | None): Reference time for relative date conditions.
+        force (bool): Apply actions even if the journal says they were already applied.
+        cache (MessageCache | None): When a rule reads the body, bodies of emails stored
+            with `--metadata` are loaded first, from this cache or from Gmail.
+        max_workers (int): Maximum number of concurrent modify calls.
+        rate_limiter (TokenBucket | None): Extra quota bucket charged before every call, on top of
+            the process-wide `gmail_api.SCHEDULER`.
+        http_factory (callable | None): Returns the HTTP object for the calling thread.
+        precomputed (bool): Read the precomputed matches. False evaluates every rule
+            over the stored emails instead, as does `full_text`, whose word matching
+            the match tables do not record.
+
+    Returns:
+        ExecutionReport: The plan, per-rule outcomes, failed batches and call latencies.
+    """
+    query = None
+    if email_ids is not None:
+        email_ids = list(email_ids)
+        if not email_ids:
+            return ExecutionReport([], dry_run=dry_run)
+        query = Email.id.in_(email_ids)
+
+    if program.needs_body:
+        load_missing_bodies(service, email_ids, cache=cache)
+
+    with stage("query"):
+        if precomputed and not full_text:
+            if now is None:
+                purge_expired_matches(datetime.now())
+            rule_matches = precomputed_matches(program, now or datetime.now(), email_ids)
+        else:
+            # All rules are evaluated in a single pass over the Email table
+            rule_matches = evaluate_rules(program, query=query, now=now or datetime.now(), full_text=full_text)
+
+    # Collect actions per email, they are applied once all rules are evaluated
+    entries = []
+    for rule in program.rules:
+        logging.info(
+            f"Rule {rule.index} matched {len(rule_matches[rule.index])} emails, queueing actions {list(rule.actions)}")
+        for email_id in sorted(rule_matches[rule.index]):
+            entries.extend((email_id, rule.rule_hash, action) for action in rule.actions)
+    if not force:
+        entries = filter_unapplied(entries)
+
+    resolved = {}
+    plan = plan_actions([(email_id, (action,)) for email_id, _, action in entries], label_registry,
+                        resolved_actions=resolved)
+    if dry_run:
+        print(format_plan(plan))
+        return ExecutionReport(plan, dry_run=True)
+
+    # Actions whose label is missing stay out of the journal, so they apply once it exists
+    pending = defaultdict(list)
+    skipped = []
+    for entry in entries:
+        if resolved.get(entry[2]) is not None:
+            pending[entry[0]].append(entry)
+        else:
+            skipped.append(entry)
+
+    report = ExecutionReport(plan, entries_by_email=dict(pending),
+                             rule_names={rule.rule_hash: f"rules[{rule.index}]" for rule in program.rules})
+    report.record_entries(skipped, "skipped")
+
+    def journal_batch(batch):
+        record_applied([entry for email_id in batch["ids"] for entry in pending.pop(email_id, ())])
+
+    with stage("modify"):
+        execute_plan_concurrently(service, plan, report=report, on_applied=journal_batch, max_workers=max_workers,
+                                  rate_limiter=rate_limiter, http_factory=http_factory)
+    # What is left without a failure had no net label change (e.g. read and unread cancelled out)
+    unchanged = [entry for email_id, email_entries in pending.items() if email_id not in report.failed_ids
+                 for entry in email_entries]
+    record_applied(unchanged)
+    report.record_entries(unchanged, "succeeded")
+    logging.info(
+        f"Applied actions to {len({email_id for email_id, _, _ in entries})} emails with {report.calls} API calls")
+    return report
+
+
+def process_emails_based_on_rules(rules_path, testing=False, auto_create_labels=False, label_cache_path=None,
+                                  dry_run=False, full_text=False, force=False, cache_dir=None,
+                                  max_workers=DEFAULT_MAX_WORKERS, report_path=None, precomputed=True):
     """
     Processes emails based on user-defined rules specified in a JSON file.
 
     Args:
         rules_path (str): Path to the JSON file containing rules.
         testing (bool): If True, uses a test database.
+        auto_create_labels (bool): If True, `move_to_<label>` creates labels that do not exist yet.
+        label_cache_path (str | None): JSON file persisting the label list between runs.
+        dry_run (bool): If True, print the planned label changes instead of applying them.
+        full_text (bool): If True, word-style `contains` conditions on subject and body are
+            answered by the FTS5 index (see `db_utils.enable_full_text_search`).
+        force (bool): If True, re-apply actions the journal records as already applied.
+        cache_dir (str | None): Directory of the raw message cache used to load missing bodies.
+        max_workers (int): Maximum number of concurrent modify calls.
+        report_path (str | None): JSON file the run report is written to.
+        precomputed (bool): Read the rule matches precomputed at insert time instead of
+            evaluating every rule over the whole mailbox.
+
+    Returns:
+        ExecutionReport | None: The run report, or None if the run could not start.
 
     What this function does:
-    - Load rules from the JSON file.
+    - Load, validate and compile rules from the JSON file (invalid rules abort the run with the list of problems).
     - Authenticate with Gmail API.
-    - Query emails from the database that match rule conditions.
-    - Apply specified actions - supported actions: mark_as_read, mark_as_unread, move_to_{label_name}, flag_message(Starred).
+    - Resolve label names through a registry built once per run.
+    - Load the bodies of emails ingested without one, if a rule reads the body.
+    - Read the emails matching each rule from the precomputed match table, evaluating only new emails and changed rules
+      (or, with `precomputed=False`, find them in a single pass over the database).
+    - Skip the actions already applied by an earlier run, according to the journal.
+    - Merge the actions of all matching rules into one net label change per email.
+    - Apply the changes grouped into `batchModify` calls - supported actions: mark_as_read, mark_as_unread, move_to_{label_name}, flag_message(Starred).
+    - Send the calls concurrently through the process-wide quota scheduler, retrying 429/5xx responses with backoff.
+    - Report failed batches per rule instead of aborting, along with call latency percentiles.
     - Handle errors gracefully and log all operations.
     """
     logging.info(
@@ -39,99 +177,25 @@ def process_emails_based_on_rules(rules_path, testing=False):
     try:
         db = get_or_initialize_db(testing=testing)
         logging.info("Database connection established")
-        with open(rules_path, "r") as rules_file:
-            rules = json.load(rules_file)
-        logging.info("Rules loaded successfully")
-
-        creds = authenticate_gmail()
-        service = build("gmail", "v1", credentials=creds)
-
-        for rule in rules.get("rules", []):
-            logging.info(f"Applying rule: {rule}")
-            predicate = rule["predicate"]
-            conditions = rule["conditions"]
-            actions = rule["actions"]
-
-            query = Email.select()
-            condition_list = []
-
-            for condition in conditions:
-                field, pred, value = condition["field"], condition["predicate"], condition["value"]
-                logging.info(f"Processing condition: {condition}")
-
-                if hasattr(Email, field):
-                    field_attr = getattr(Email, field)
-
-                    if isinstance(Email._meta.fields[field], DateTimeField):
-                        value = int(value)
-                        delta = timedelta(
-                            days=value *
-                            30 if condition.get("unit") == "months" else value
-                        )
-                        compare_date = datetime.now() - delta
-
-                        if pred == "less_than":
-                            condition_list.append(field_attr > compare_date)
-                        elif pred == "greater_than":
-                            condition_list.append(field_attr < compare_date)
-
-                    else:
-                        if pred == "contains":
-                            condition_list.append(field_attr.contains(value))
-                        elif pred == "equals":
-                            condition_list.append(field_attr == value)
-                        elif pred == "not_equals":
-                            condition_list.append(field_attr != value)
-                        elif pred == "not_contains":
-                            condition_list.append(~field_attr.contains(value))
-
-            # Apply predicates conditons: All (AND), Any (OR)
-            if condition_list:
-                if predicate == "All":
-                    query = query.where(*condition_list)
-                elif predicate == "Any":
-                    query = query.where(reduce(operator.or_, condition_list))
-
-            # Apply actions to emails
-            for email in query:
-                logging.info(
-                    f"Processing email {email.id} for rule actions...")
-                for action in actions:
-                    logging.info(
-                        f"Applying action: {action} to email {email.id}")
-
-                    if action == "mark_as_read":
-                        service.users().messages().modify(
-                            userId="me", id=email.id, body={"removeLabelIds": ["UNREAD"]}
-                        ).execute()
-
-                    elif action == "mark_as_unread":
-                        service.users().messages().modify(
-                            userId="me", id=email.id, body={"addLabelIds": ["UNREAD"]}
-                        ).execute()
-
-                    elif action.startswith("move_to_"):
-                        label_name = action.replace("move_to_", "")
-                        labels = service.users().labels().list(userId="me").execute().get("labels", [])
-                        label_id = next(
-                            (lbl["id"] for lbl in labels if lbl["name"].lower(
-                            ) == label_name.lower()), None
-                        )
-                        if label_id:
-                            service.users().messages().modify(
-                                userId="me", id=email.id, body={"addLabelIds": [label_id]}
-                            ).execute()
-
-                    elif action == "flag_message":
-                        service.users().messages().modify(
-                            userId="me", id=email.id, body={"addLabelIds": ["STARRED"]}
-                        ).execute()
-
-                    else:
-                        logging.warning(f"Unknown action: {action}")
+        program = load_rule_program(rules_path)
+        logging.info(f"Rules loaded successfully ({len(program.rules)} rules)")
+
+        client = get_gmail_client()
+        service = client.service()
+        label_registry = LabelRegistry(
+            service, cache_path=label_cache_path, auto_create=auto_create_labels)
+        cache = MessageCache(cache_dir) if cache_dir else None
+        report = apply_rules(service, program, label_registry, dry_run=dry_run, full_text=full_text, force=force,
+                             cache=cache, max_workers=max_workers,
+                             http_factory=client.http, precomputed=precomputed)
+        logging.log(logging.INFO if report.ok else logging.WARNING, format_report(report))
+        if report_path:
+            with open(report_path, "w") as report_file:
+                json.dump(report.summary(), report_file, indent=2)
 
         db.close()
         logging.info("Database connection closed successfully")
+        return report
 
     except Exception as e:
         logging.error(f"Error processing emails based on rules: {e}")
@@ -140,10 +204,32 @@ def process_emails_based_on_rules(rules_path, testing=False):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply rules.json to the stored emails.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Print the planned label changes without applying them.")
+    parser.add_argument("--fts", action="store_true",
+                        help="Answer word-style contains conditions through the full-text index.")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-apply actions that earlier runs already applied.")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="Raw message cache used when bodies must be downloaded.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS,
+                        help="Maximum number of concurrent modify calls.")
+    parser.add_argument("--report", help="Write the run report (per-rule outcomes, failures, latencies) "
+                                         "to this JSON file.")
+    parser.add_argument("--rescan", action="store_true",
+                        help="Evaluate every rule over all stored emails instead of reading the precomputed matches.")
+    add_arguments(parser)
+    args = parser.parse_args()
+
     rules_path = input("Enter the path to the rules.json file: ")
     if not os.path.isfile(rules_path):
         logging.error("Invalid rules file path. Please provide a valid path.")
         sys.exit(1)
 
-    process_emails_based_on_rules(rules_path)
+    with instrumented(args):
+        process_emails_based_on_rules(rules_path, label_cache_path=LABEL_CACHE_PATH, dry_run=args.dry_run,
+                                      full_text=args.fts, force=args.force, cache_dir=args.cache_dir,
+                                      max_workers=args.workers, report_path=args.report,
+                                      precomputed=not args.rescan)
     logging.info("Emails processed successfully based on rules.")
@@ -0,0 +1,308 @@
+import hashlib
+import json
+import operator
+import re
+import sqlite3
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from functools import reduce
+
+from db_utils import Email, FULL_TEXT_FIELDS, full_text_expression, body_expression, sender_domain_of
+
+
+STRING_FIELDS = {"sender", "sender_domain", "subject", "body"}
+DATE_FIELDS = {"received_at"}
+STRING_PREDICATES = {"contains", "not_contains", "equals", "not_equals"}
+FULL_TEXT_PREDICATE = "matches"
+DATE_PREDICATES = {"less_than", "greater_than"}
+DATE_UNITS = {"days": 1, "months": 30}
+RULE_PREDICATES = {"All", "Any"}
+SIMPLE_ACTIONS = {"mark_as_read", "mark_as_unread", "flag_message"}
+MOVE_ACTION = re.compile(r"^move_to_.+$")
+
+_program_cache = {}
+_local = threading.local()
+
+
+class RuleValidationError(ValueError):
+    """Raised when a rules file does not follow the rules schema. Lists every problem found."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("Invalid rules:\n" + "\n".join(f"- {error}" for error in errors))
+
+
+def _field_value(email, field):
+    value = email.get(field) if isinstance(email, dict) else getattr(email, field)
+    if field == "sender_domain" and value is None:
+        # Rows that were never stored have no generated column yet
+        return sender_domain_of(_field_value(email, "sender"))
+    return value
+
+
+def full_text_match(text, query):
+    """
+    Evaluates an FTS5 query against a single text, with the exact semantics of
+    the database index, using a scratch in-memory FTS5 table.
+
+    Raises:
+        sqlite3.OperationalError: If `query` is not valid FTS5 syntax.
+    """
+    connection = getattr(_local, "fts_connection", None)
+    if connection is None:
+        connection = sqlite3.connect(":memory:")
+        connection.execute("CREATE VIRTUAL TABLE document USING fts5(content)")
+        _local.fts_connection = connection
+    connection.execute("DELETE FROM document")
+    connection.execute("INSERT INTO document(content) VALUES (?)", (text or "",))
+    return connection.execute(
+        "SELECT 1 FROM document WHERE document MATCH ?", (query,)).fetchone() is not None
+
+
+@dataclass(frozen=True)
+class Condition:
+    """A validated rule condition. Date conditions hold their value in days."""
+    field: str
+    predicate: str
+    value: object
+
+    @property
+    def is_date(self):
+        return self.field in DATE_FIELDS
+
+    def compare_date(self, now):
+        return now - timedelta(days=self.value)
+
+    def to_expression(self, now):
+        """Builds the peewee expression for this condition, dates relative to `now`."""
+        if self.predicate == FULL_TEXT_PREDICATE:
+            return full_text_expression(self.field, self.value)
+        if self.field == "body":
+            return body_expression(self.predicate, self.value)
+        field_attr = getattr(Email, self.field)
+        if self.is_date:
+            if self.predicate == "less_than":
+                return field_attr > self.compare_date(now)
+            return field_attr < self.compare_date(now)
+        if self.predicate == "contains":
+            return field_attr.contains(self.value)
+        if self.predicate == "not_contains":
+            return ~field_attr.contains(self.value)
+        if self.predicate == "equals":
+            return field_attr == self.value
+        return field_attr != self.value
+
+    def matches(self, email, now):
+        """
+        Evaluates the condition against an `Email` row (or a row dict) in memory,
+        with the same semantics as the SQL expression: substring checks are
+        case-insensitive like SQLite's LIKE, equality is case-sensitive.
+        """
+        value = _field_value(email, self.field)
+        if self.is_date:
+            if isinstance(value, str):
+                value = datetime.fromisoformat(value)
+            if self.predicate == "less_than":
+                return value > self.compare_date(now)
+            return value < self.compare_date(now)
+
+        value = value or ""
+        if self.predicate == FULL_TEXT_PREDICATE:
+            return full_text_match(value, self.value)
+        if self.predicate == "contains":
+            return self.value.lower() in value.lower()
+        if self.predicate == "not_contains":
+            return self.value.lower() not in value.lower()
+        if self.predicate == "equals":
+            return value == self.value
+        return value != self.value
+
+
+@dataclass(frozen=True)
+class CompiledRule:
+    """A validated rule: conditions joined by All (AND) or Any (OR), and its actions."""
+    index: int
+    predicate: str
+    conditions: tuple
+    actions: tuple
+    rule_hash: str
+
+    def to_expression(self, now=None):
+        """Builds the peewee WHERE expression for the rule."""
+        now = now or datetime.now()
+        expressions = [condition.to_expression(now) for condition in self.conditions]
+        combine = operator.and_ if self.predicate == "All" else operator.or_
+        return reduce(combine, expressions)
+
+    def matches(self, email, now=None):
+        """Evaluates the rule against an `Email` row (or a row dict) without a database query."""
+        now = now or datetime.now()
+        results = (condition.matches(email, now) for condition in self.conditions)
+        return all(results) if self.predicate == "All" else any(results)
+
+
+@dataclass(frozen=True)
+class RuleProgram:
+    """Immutable compiled form of a rules file."""
+    rules: tuple
+    source_hash: str
+
+    @property
+    def needs_body(self):
+        """True if any rule has a condition on the email body."""
+        return any(condition.field == "body" for rule in self.rules for condition in rule.conditions)
+
+    def match(self, email, now=None):
+        """Returns the rules matching an `Email` row (or a row dict), in file order."""
+        now = now or datetime.now()
+        return [rule for rule in self.rules if rule.matches(email, now)]
+
+
+def _compile_condition(condition, location, errors):
+    if not isinstance(condition, dict):
+        errors.append(f"{location}: condition must be an object")
+        return None
+
+    field, predicate, value = condition.get("field"), condition.get("predicate"), condition.get("value")
+    if predicate == FULL_TEXT_PREDICATE:
+        if field not in FULL_TEXT_FIELDS:
+            errors.append(
+                f"{location}.predicate: {FULL_TEXT_PREDICATE!r} is only supported for {list(FULL_TEXT_FIELDS)}")
+            return None
+        if not isinstance(value, str) or not value.strip():
+            errors.append(f"{location}.value: expected a full-text query, got {value!r}")
+            return None
+        try:
+            full_text_match("", value)
+        except sqlite3.OperationalError as e:
+            errors.append(f"{location}.value: invalid full-text query {value!r} ({e})")
+            return None
+        return Condition(field, predicate, value)
+
+    if field in STRING_FIELDS:
+        if predicate not in STRING_PREDICATES:
+            errors.append(
+                f"{location}.predicate: unknown predicate {predicate!r} for field {field!r}, "
+                f"expected one of {sorted(STRING_PREDICATES)}")
+            return None
+        if not isinstance(value, str):
+            errors.append(f"{location}.value: expected a string, got {value!r}")
+            return None
+        if "unit" in condition:
+            errors.append(f"{location}.unit: only date fields take a unit")
+            return None
+        return Condition(field, predicate, value)
+
+    if field in DATE_FIELDS:
+        if predicate not in DATE_PREDICATES:
+            errors.append(
+                f"{location}.predicate: unknown predicate {predicate!r} for field {field!r}, "
+                f"expected one of {sorted(DATE_PREDICATES)}")
+            return None
+        unit = condition.get("unit", "days")
+        if unit not in DATE_UNITS:
+            errors.append(f"{location}.unit: unknown unit {unit!r}, expected one of {sorted(DATE_UNITS)}")
+            return None
+        try:
+            amount = int(value)
+        except (TypeError, ValueError):
+            errors.append(f"{location}.value: expected a whole number of {unit}, got {value!r}")
+            return None
+        if amount < 0:
+            errors.append(f"{location}.value: must not be negative")
+            return None
+        return Condition(field, predicate, amount * DATE_UNITS[unit])
+
+    errors.append(
+        f"{location}.field: unknown field {field!r}, expected one of {sorted(STRING_FIELDS | DATE_FIELDS)}")
+    return None
+
+
+def _compile_rule(rule, index, errors):
+    location = f"rules[{index}]"
+    if not isinstance(rule, dict):
+        errors.append(f"{location}: rule must be an object")
+        return None
+
+    error_count = len(errors)
+    if rule.get("predicate") not in RULE_PREDICATES:
+        errors.append(f"{location}.predicate: expected 'All' or 'Any', got {rule.get('predicate')!r}")
+
+    raw_conditions = rule.get("conditions")
+    conditions = []
+    if not isinstance(raw_conditions, list) or not raw_conditions:
+        errors.append(f"{location}.conditions: expected a non-empty list of conditions")
+    else:
+        for position, condition in enumerate(raw_conditions):
+            compiled = _compile_condition(condition, f"{location}.conditions[{position}]", errors)
+            if compiled is not None:
+                conditions.append(compiled)
+
+    actions = rule.get("actions")
+    if not isinstance(actions, list) or not actions:
+        errors.append(f"{location}.actions: expected a non-empty list of actions")
+    else:
+        for position, action in enumerate(actions):
+            if not isinstance(action, str) or not (action in SIMPLE_ACTIONS or MOVE_ACTION.match(action)):
+                errors.append(
+                    f"{location}.actions[{position}]: unknown action {action!r}, expected one of "
+                    f"{sorted(SIMPLE_ACTIONS)} or move_to_<label>")
+
+    if len(errors) > error_count:
+        return None
+
+    canonical = json.dumps({"predicate": rule["predicate"],
+                            "conditions": [[c.field, c.predicate, c.value] for c in conditions],
+                            "actions": actions}, sort_keys=True)
+    return CompiledRule(index=index, predicate=rule["predicate"], conditions=tuple(conditions),
+                        actions=tuple(actions), rule_hash=hashlib.sha256(canonical.encode("utf-8")).hexdigest())
+
+
+def compile_rules(rules, source_hash=None):
+    """
+    Validates parsed rules JSON and compiles it into a `RuleProgram`.
+
+    Args:
+        rules (dict): Parsed rules file, {"rules": [...]}.
+        source_hash (str | None): Hash of the source text, computed from `rules` if omitted.
+
+    Returns:
+        RuleProgram: The compiled rules.
+
+    Raises:
+        RuleValidationError: If any rule is invalid. All problems are reported at once.
+    """
+    if source_hash is None:
+        source_hash = hashlib.sha256(json.dumps(rules, sort_keys=True).encode("utf-8")).hexdigest()
+
+    if not isinstance(rules, dict) or not isinstance(rules.get("rules"), list):
+        raise RuleValidationError(["rules: expected an object with a 'rules' list"])
+
+    errors = []
+    compiled = [_compile_rule(rule, index, errors) for index, rule in enumerate(rules["rules"])]
+    if errors:
+        raise RuleValidationError(errors)
+    return RuleProgram(rules=tuple(compiled), source_hash=source_hash)
+
+
+def load_rule_program(rules_path):
+    """
+    Reads, validates and compiles a rules file.
+
+    Compiled programs are cached by the SHA-256 of the file contents, so an
+    unchanged file is only compiled once per process.
+    """
+    with open(rules_path, "r") as rules_file:
+        source = rules_file.read()
+    source_hash = hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    program = _program_cache.get(source_hash)
+    if program is None:
+        try:
+            rules = json.loads(source)
+        except ValueError as e:
+            raise RuleValidationError([f"{rules_path}: not valid JSON ({e})"]) from e
+        program = compile_rules(rules, source_hash=source_hash)
+        _program_cache[source_hash] = program
+    return program
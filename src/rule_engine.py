@@ -0,0 +1,269 @@
+import operator
+import re
+from collections import defaultdict, deque
+from datetime import datetime
+from functools import reduce
+
+from peewee import JOIN, fn
+
+from db_utils import Email, EmailBody, FULL_TEXT_FIELDS, full_text_expression
+from metrics import increment
+
+# Values made only of whole words can be answered by the full-text index.
+WORD_VALUE = re.compile(r"^\w+(?:\s+\w+)*$")
+
+# Above this many rules an OR of index conditions costs more than a plain scan.
+MAX_PREFILTER_RULES = 64
+
+
+class MultiPatternMatcher:
+    """
+    Aho-Corasick automaton that finds which of many substrings occur in a text
+    in one pass over the text, regardless of the number of patterns.
+
+    Matching is case-insensitive, like SQLite's LIKE used by `contains`.
+
+    Args:
+        patterns (Iterable[str]): Substrings to look for.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [pattern.lower() for pattern in patterns]
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        self.always = {index for index, pattern in enumerate(self.patterns) if not pattern}
+
+        for index, pattern in enumerate(self.patterns):
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state].add(index)
+
+        # Breadth-first pass to link every state to its longest proper suffix state.
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+
+    def find(self, text):
+        """Returns the indices of the patterns that occur in `text`."""
+        found = set(self.always)
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in (text or "").lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+        return found
+
+
+def full_text_query(condition, full_text=False):
+    """
+    Returns the FTS5 query answering `condition` through the full-text index, or
+    None if the condition is evaluated on the row itself.
+
+    `matches` conditions always use the index. With `full_text` set, word-style
+    `contains` / `not_contains` conditions on indexed fields are answered as a
+    phrase query, which matches whole words instead of arbitrary substrings.
+    """
+    if condition.predicate == "matches":
+        return condition.value
+    if (full_text and condition.predicate in ("contains", "not_contains")
+            and condition.field in FULL_TEXT_FIELDS and WORD_VALUE.match(condition.value)):
+        return f'"{condition.value}"'
+    return None
+
+
+def _is_indexable(condition):
+    """True for conditions SQLite can answer from an index on the email table."""
+    return condition.is_date or (
+        condition.field in ("sender", "sender_domain") and condition.predicate == "equals")
+
+
+def index_prefilter(program, now):
+    """
+    Returns a WHERE expression that every row matched by any rule satisfies and
+    that SQLite can answer from the received_at / sender / sender_domain indexes,
+    or None if some rule could match rows outside any index range.
+    """
+    if not program.rules or len(program.rules) > MAX_PREFILTER_RULES:
+        return None
+
+    terms = []
+    for rule in program.rules:
+        indexable = [condition.to_expression(now) for condition in rule.conditions if _is_indexable(condition)]
+        if rule.predicate == "All" and indexable:
+            terms.append(reduce(operator.and_, indexable))
+        elif rule.predicate == "Any" and len(indexable) == len(rule.conditions):
+            terms.append(reduce(operator.or_, indexable))
+        else:
+            return None
+    return reduce(operator.or_, terms)
+
+
+def _compile_condition(condition, columns, pattern_ids, full_text_ids, now, full_text):
+    """Returns a function of (row, found) evaluating one condition on a streamed row tuple."""
+    fts_query = full_text_query(condition, full_text)
+    if fts_query is not None:
+        ids = full_text_ids[(condition.field, fts_query)]
+        if condition.predicate == "not_contains":
+            return lambda row, found: row[0] not in ids
+        return lambda row, found: row[0] in ids
+
+    position = columns.index(condition.field)
+
+    if condition.is_date:
+        compare_date = condition.compare_date(now)
+        if condition.predicate == "less_than":
+            return lambda row, found: row[position] > compare_date
+        return lambda row, found: row[position] < compare_date
+
+    if condition.predicate in ("contains", "not_contains"):
+        key = (condition.field, pattern_ids[condition.field][condition.value.lower()])
+        if condition.predicate == "contains":
+            return lambda row, found: key in found
+        return lambda row, found: key not in found
+
+    value = condition.value
+    if condition.predicate == "equals":
+        return lambda row, found: row[position] == value
+    return lambda row, found: row[position] != value
+
+
+def evaluate_rules(program, query=None, now=None, full_text=False):
+    """
+    Evaluates every rule of a compiled program in one pass over the `Email` table.
+
+    Only the columns referenced by the rules are read (bodies only if some rule
+    has a body condition), and when every rule has a
+    date or sender equality condition only the index ranges they cover are. All `contains` /
+    `not_contains` values of a field are searched for together with one
+    `MultiPatternMatcher`, and rules are only evaluated on rows containing their
+    substrings.
+
+    The pass has a fixed cost per row, so it pays off with many rules: in
+    `benchmarks/bench_rule_engine.py` it is 1.1-1.4x faster than one SQL query
+    per rule at 500 rules (5k to 100k rows), slower at 300 rules (0.8x), and
+    2-5x slower at 50 to 100 rules.
+
+    Args:
+        program (RuleProgram): Compiled rules.
+        query (peewee.Query | None): Optional pre-filter, e.g. `Email.id.in_(new_ids)`
+            as a WHERE expression. Defaults to the whole table.
+        now (datetime | None): Reference time for relative date conditions.
+        full_text (bool): Answer word-style `contains` / `not_contains` conditions on
+            subject and body through the FTS5 index (see `full_text_query`).
+
+    The rows read are counted in the `rows_scanned` metric, and the rows each rule
+    was actually evaluated on in `rule_rows_scanned`, labelled `rules[<index>]`.
+
+    Returns:
+        dict[int, set[str]]: Matching email IDs per rule index.
+    """
+    now = now or datetime.now()
+    matches = {rule.index: set() for rule in program.rules}
+    if not program.rules:
+        return matches
+
+    # Conditions answered by the full-text index are resolved to ID sets up front,
+    # so their columns never have to be read. They are limited to `query` as well,
+    # so evaluating a few new emails does not collect the matches of the whole mailbox.
+    full_text_ids = {}
+    row_conditions = []
+    for rule in program.rules:
+        for condition in rule.conditions:
+            fts_query = full_text_query(condition, full_text)
+            if fts_query is None:
+                row_conditions.append(condition)
+            elif (condition.field, fts_query) not in full_text_ids:
+                where = full_text_expression(condition.field, fts_query)
+                if query is not None:
+                    where = where & query
+                full_text_ids[(condition.field, fts_query)] = {
+                    email_id for (email_id,) in Email.select(Email.id).where(where).tuples()}
+
+    fields = sorted({condition.field for condition in row_conditions})
+    columns = ["id"] + fields
+
+    # One automaton per text field over the distinct substring values used on it.
+    pattern_ids = {}
+    for condition in row_conditions:
+        if condition.predicate in ("contains", "not_contains"):
+            values = pattern_ids.setdefault(condition.field, {})
+            values.setdefault(condition.value.lower(), len(values))
+    matchers = [(columns.index(field), field, MultiPatternMatcher(values))
+                for field, values in pattern_ids.items()]
+
+    # Rules that need a substring to be present are only evaluated on rows where
+    # the automaton found it; every other rule is evaluated on every row.
+    compiled = []
+    triggered = defaultdict(list)
+    always = []
+    for rule in program.rules:
+        checks = [_compile_condition(condition, columns, pattern_ids, full_text_ids, now, full_text)
+                  for condition in rule.conditions]
+        compiled.append((matches[rule.index], all if rule.predicate == "All" else any, checks))
+
+        keys = [(condition.field, pattern_ids[condition.field][condition.value.lower()])
+                for condition in rule.conditions
+                if condition.predicate == "contains" and full_text_query(condition, full_text) is None]
+        if rule.predicate == "All" and keys:
+            triggered[keys[0]].append(len(compiled) - 1)
+        elif rule.predicate == "Any" and len(keys) == len(rule.conditions):
+            for key in set(keys):
+                triggered[key].append(len(compiled) - 1)
+        else:
+            always.append(len(compiled) - 1)
+
+    # Bodies live compressed in their own table and are only joined and
+    # decompressed when some row condition actually looks at them.
+    select = Email.select(*(fn.body_text(EmailBody.data) if column == "body" else getattr(Email, column)
+                            for column in columns))
+    if "body" in columns:
+        select = select.join(EmailBody, JOIN.LEFT_OUTER, on=(EmailBody.email_id == Email.id))
+    if query is not None:
+        select = select.where(query)
+    prefilter = index_prefilter(program, now)
+    if prefilter is not None:
+        select = select.where(prefilter)
+
+    scanned = 0
+    evaluated = [0] * len(compiled)
+    for row in select.tuples().iterator():
+        scanned += 1
+        found = set()
+        for position, field, matcher in matchers:
+            found.update((field, index) for index in matcher.find(row[position]))
+
+        candidates = set(always)
+        for key in found:
+            candidates.update(triggered.get(key, ()))
+
+        for candidate in candidates:
+            evaluated[candidate] += 1
+            matched_ids, combine, checks = compiled[candidate]
+            if combine(check(row, found) for check in checks):
+                matched_ids.add(row[0])
+
+    increment("rows_scanned", scanned)
+    for rule, count in zip(program.rules, evaluated):
+        increment("rule_rows_scanned", count, rule=f"rules[{rule.index}]")
+    return matches
@@ -0,0 +1,12 @@
+import pytest
+from gmail_api import configure_scheduler
+
+
+@pytest.fixture(autouse=True)
+def unthrottled_scheduler():
+    """
+    Gives every test a fresh process-wide quota scheduler that only keeps the
+    accounting: the fake services have no real quota, and rate limited responses
+    in one test must not slow down the next.
+    """
+    yield configure_scheduler(rate=None)
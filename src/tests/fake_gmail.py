@@ -0,0 +1,439 @@
+"""
+In-process stand-in for the Gmail API service used by the tests.
+
+It mirrors the shape of the `googleapiclient` resource objects closely enough
+for the fetch and rule code paths, and counts every simulated HTTP round trip.
+The benchmarks use it too, with simulated latency and per-user quota.
+"""
+import base64
+import threading
+import time
+from collections import Counter
+from collections.abc import Mapping
+from itertools import islice
+from email.mime.application import MIMEApplication
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.nonmultipart import MIMENonMultipart
+
+from gmail_api import QUOTA_UNITS
+from mime_parser import PARTIAL_DEPTH
+
+# Gmail rejects batch requests carrying more calls than this.
+MAX_BATCH_CALLS = 100
+
+
+def make_message(message_id, sender="Sender <sender@example.com>", subject="Subject",
+                 body="Body", internal_date="1700000000000"):
+    """Builds a `format=full` message resource with a single text/plain part."""
+    return {
+        "id": message_id,
+        "internalDate": internal_date,
+        "labelIds": ["INBOX", "UNREAD"],
+        "snippet": body[:20],
+        "payload": {
+            "mimeType": "multipart/alternative",
+            "headers": [
+                {"name": "From", "value": sender},
+                {"name": "Subject", "value": subject},
+                {"name": "To", "value": "me@example.com"},
+            ],
+            "parts": [
+                {
+                    "mimeType": "text/plain",
+                    "body": {"data": base64.urlsafe_b64encode(body.encode("utf-8")).decode("ascii")},
+                },
+                {
+                    "mimeType": "text/html",
+                    "body": {"data": base64.urlsafe_b64encode(f"<p>{body}</p>".encode("utf-8")).decode("ascii")},
+                },
+            ],
+        },
+    }
+
+
+def _project_part(part, depth=PARTIAL_DEPTH):
+    """Keeps the MIME part fields selected by `mime_parser.partial_fields`, down to `depth` levels."""
+    projected = {"mimeType": part.get("mimeType"), "filename": part.get("filename", ""),
+                 "headers": [{"name": h["name"], "value": h["value"]} for h in part.get("headers", [])],
+                 "body": {"data": part.get("body", {}).get("data")}}
+    if "parts" in part and depth > 0:
+        projected["parts"] = [_project_part(child, depth - 1) for child in part["parts"]]
+    return projected
+
+
+def _to_mime(part):
+    """Rebuilds an RFC 822 (MIME) message from a `format=full` payload, for `format=raw`."""
+    mime_type = part.get("mimeType", "text/plain")
+    maintype, subtype = mime_type.split("/", 1)
+    if maintype == "multipart":
+        message = MIMEMultipart(subtype, _subparts=[_to_mime(child) for child in part.get("parts", [])])
+    elif part.get("parts"):  # message/rfc822
+        message = MIMEMessage(_to_mime(part["parts"][0]), subtype)
+    else:
+        data = part.get("body", {}).get("data") or ""
+        raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+        if maintype == "text":
+            message = MIMENonMultipart(maintype, subtype)
+            message.set_payload(raw)
+            message.replace_header("Content-Type", _header(part, "Content-Type") or f"{mime_type}; charset=utf-8")
+            message["Content-Transfer-Encoding"] = "8bit"
+        else:
+            message = MIMEApplication(raw, subtype)
+        if part.get("filename"):
+            message.add_header("Content-Disposition", "attachment", filename=part["filename"])
+    for header in part.get("headers", []):
+        if header["name"].lower() not in ("content-type", "content-transfer-encoding", "mime-version"):
+            message[header["name"]] = header["value"]
+    return message
+
+
+def _header(part, name):
+    for header in part.get("headers", []):
+        if header["name"].lower() == name.lower():
+            return header["value"]
+    return None
+
+
+class FakeHttpError(Exception):
+    """Mimics `googleapiclient.errors.HttpError` closely enough for status checks."""
+
+    def __init__(self, status, message=""):
+        super().__init__(message or f"HTTP {status}")
+        self.status_code = status
+        self.resp = type("Resp", (), {"status": status})()
+
+
+class FakeRequest:
+    def __init__(self, service, method, fn, kwargs):
+        self.service = service
+        self.method = method
+        self.fn = fn
+        self.kwargs = kwargs
+
+    def _run(self):
+        return self.fn(**self.kwargs)
+
+    def execute(self, *args, **kwargs):
+        service = self.service
+        with service.lock:
+            service.round_trips += 1
+            service._record_call(self.method, self.kwargs)
+            service.in_flight += 1
+            service.max_in_flight = max(service.max_in_flight, service.in_flight)
+        try:
+            if service.latency:
+                time.sleep(service.latency)
+            service._charge_quota(self.method)
+            service._maybe_fail_transiently(self.kwargs)
+            return self._run()
+        finally:
+            with service.lock:
+                service.in_flight -= 1
+
+
+class FakeBatch:
+    def __init__(self, service, callback=None):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request, callback or self.callback, request_id))
+
+    def execute(self, *args, **kwargs):
+        if len(self.requests) > MAX_BATCH_CALLS:
+            raise FakeHttpError(400, f"Too many requests in batch, at most {MAX_BATCH_CALLS} are allowed")
+        with self.service.lock:
+            self.service.round_trips += 1
+            self.service.batch_sizes.append(len(self.requests))
+        if self.service.latency:
+            time.sleep(self.service.latency)
+        for request, callback, request_id in self.requests:
+            with self.service.lock:
+                self.service._record_call(request.method, request.kwargs)
+            try:
+                self.service._charge_quota(request.method)
+                response, exception = request._run(), None
+            except Exception as e:
+                response, exception = None, e
+            callback(request_id, response, exception)
+
+
+class _Messages:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, **kwargs):
+        return FakeRequest(self.service, "messages.list", self.service._list_messages, kwargs)
+
+    def get(self, **kwargs):
+        return FakeRequest(self.service, "messages.get", self.service._get_message, kwargs)
+
+    def modify(self, **kwargs):
+        return FakeRequest(self.service, "messages.modify", self.service._modify_message, kwargs)
+
+    def batchModify(self, **kwargs):
+        return FakeRequest(self.service, "messages.batchModify", self.service._batch_modify_messages, kwargs)
+
+
+class _History:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, **kwargs):
+        return FakeRequest(self.service, "history.list", self.service._list_history, kwargs)
+
+
+class _Labels:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, **kwargs):
+        return FakeRequest(self.service, "labels.list", self.service._list_labels, kwargs)
+
+    def create(self, **kwargs):
+        return FakeRequest(self.service, "labels.create", self.service._create_label, kwargs)
+
+
+class _Users:
+    def __init__(self, service):
+        self.service = service
+
+    def messages(self):
+        return _Messages(self.service)
+
+    def history(self):
+        return _History(self.service)
+
+    def labels(self):
+        return _Labels(self.service)
+
+    def getProfile(self, **kwargs):
+        return FakeRequest(self.service, "users.getProfile", self.service._get_profile, kwargs)
+
+    def watch(self, **kwargs):
+        return FakeRequest(self.service, "users.watch", self.service._watch, kwargs)
+
+
+class FakeGmailService:
+    """
+    Fake Gmail service backed by an in-memory dict of message resources.
+
+    Args:
+        messages: Message resources, or a mapping of ID to resource (e.g. a
+            `benchmarks.mailbox.SyntheticMailbox` generating them on demand).
+        latency (float): Seconds every simulated round trip takes.
+        quota_per_second (float | None): Per-user quota in units (see `gmail_api.QUOTA_UNITS`);
+            calls beyond it within the same second fail with a 429. None disables it.
+        record_calls (bool): Keep every call in `calls`. Benchmarks with millions of
+            calls turn it off and read `method_counts` instead.
+        clock (callable): Time source of the quota windows.
+
+    Attributes:
+        round_trips (int): Number of simulated HTTP requests (a batch counts once).
+        calls (list): (method, kwargs) for every individual API call.
+        batch_sizes (list[int]): Number of calls carried by each executed batch.
+        failing_ids (set[str]): Message IDs whose `messages.get` raises a 404.
+        failing_page_tokens (set[str]): Page tokens whose `messages.list` raises a 500.
+        history_id (int): Current mailbox historyId, bumped by every mutation helper.
+        oldest_history_id (int): History before this ID is reported as expired (404).
+        latency (float): Seconds every simulated round trip takes.
+        transient_failures (dict[str, int]): Remaining number of 429 responses to
+            return for a message ID before calls for it succeed.
+        max_in_flight (int): Highest number of concurrently executing requests seen.
+        method_counts (Counter): Number of calls per API method, also with `record_calls` off.
+        throttled (int): Number of calls rejected for exceeding `quota_per_second`.
+    """
+
+    def __init__(self, messages=(), latency=0.0, quota_per_second=None, record_calls=True, clock=time.monotonic):
+        if isinstance(messages, Mapping):
+            self.messages = messages
+        else:
+            self.messages = {msg["id"]: msg for msg in messages}
+        self.round_trips = 0
+        self.calls = []
+        self.batch_sizes = []
+        self.failing_ids = set()
+        self.failing_page_tokens = set()
+        self.history_id = 1000
+        self.oldest_history_id = 0
+        self.history = []
+        self.history_page_size = 100
+        self.latency = latency
+        self.labels = {"INBOX": "INBOX", "UNREAD": "UNREAD", "STARRED": "STARRED"}
+        self.transient_failures = {}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.quota_per_second = quota_per_second
+        self.record_calls = record_calls
+        self.clock = clock
+        self.method_counts = Counter()
+        self.throttled = 0
+        self.quota_window = None
+        self.quota_used = 0
+
+    def _record_call(self, method, kwargs):
+        # Called with the lock held
+        self.method_counts[method] += 1
+        if self.record_calls:
+            self.calls.append((method, kwargs))
+
+    def _charge_quota(self, method):
+        if not self.quota_per_second:
+            return
+        units = QUOTA_UNITS.get(method, 1)
+        with self.lock:
+            window = int(self.clock())
+            if window != self.quota_window:
+                self.quota_window, self.quota_used = window, 0
+            if self.quota_used + units > self.quota_per_second:
+                self.throttled += 1
+                throttled = True
+            else:
+                self.quota_used += units
+                throttled = False
+        if throttled:
+            raise FakeHttpError(429, "User-rate limit exceeded")
+
+    def _maybe_fail_transiently(self, kwargs):
+        message_id = kwargs.get("id")
+        with self.lock:
+            remaining = self.transient_failures.get(message_id, 0)
+            if remaining:
+                self.transient_failures[message_id] = remaining - 1
+        if remaining:
+            raise FakeHttpError(429, "Too many concurrent requests for user")
+
+    def users(self):
+        return _Users(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def _record(self, **change):
+        self.history_id += 1
+        self.history.append({"id": str(self.history_id), **change})
+
+    def add_message(self, msg):
+        self.messages[msg["id"]] = msg
+        self._record(messagesAdded=[{"message": {"id": msg["id"], "labelIds": msg.get("labelIds", [])}}])
+
+    def delete_message(self, message_id):
+        del self.messages[message_id]
+        self._record(messagesDeleted=[{"message": {"id": message_id}}])
+
+    def relabel_message(self, message_id, add=(), remove=()):
+        msg = self.messages[message_id]
+        msg["labelIds"] = [label for label in msg.get("labelIds", []) if label not in remove]
+        msg["labelIds"] += [label for label in add if label not in msg["labelIds"]]
+        message = {"id": message_id, "labelIds": list(msg["labelIds"])}
+        change = {}
+        if add:
+            change["labelsAdded"] = [{"message": message, "labelIds": list(add)}]
+        if remove:
+            change["labelsRemoved"] = [{"message": message, "labelIds": list(remove)}]
+        self._record(**change)
+
+    def count(self, method):
+        return sum(1 for name, _ in self.calls if name == method)
+
+    def _list_messages(self, userId, maxResults=100, pageToken=None, **kwargs):
+        if pageToken in self.failing_page_tokens:
+            raise FakeHttpError(500, f"Backend error for page {pageToken}")
+        start = int(pageToken) if pageToken else 0
+        ids = list(islice(self.messages, start, start + maxResults))
+        result = {"messages": [{"id": message_id, "threadId": message_id} for message_id in ids],
+                  "resultSizeEstimate": len(ids)}
+        if start + maxResults < len(self.messages):
+            result["nextPageToken"] = str(start + maxResults)
+        return result
+
+    def _list_labels(self, userId):
+        return {"labels": [{"id": label_id, "name": name} for name, label_id in self.labels.items()]}
+
+    def _create_label(self, userId, body):
+        label_id = f"Label_{len(self.labels)}"
+        self.labels[body["name"]] = label_id
+        return {"id": label_id, "name": body["name"]}
+
+    def _apply_label_delta(self, message_id, add, remove):
+        msg = self.messages.get(message_id)
+        if msg is None:
+            raise FakeHttpError(404, f"Message {message_id} not found")
+        known = set(self.labels.values())
+        for label_id in list(add) + list(remove):
+            if label_id not in known:
+                raise FakeHttpError(400, f"Invalid label: {label_id}")
+        labels = [label for label in msg.get("labelIds", []) if label not in remove]
+        msg["labelIds"] = labels + [label for label in add if label not in labels]
+
+    def _modify_message(self, userId, id, body):
+        self._apply_label_delta(id, body.get("addLabelIds", []), body.get("removeLabelIds", []))
+        return {"id": id, "labelIds": self.messages[id]["labelIds"]}
+
+    def _batch_modify_messages(self, userId, body):
+        if len(body["ids"]) > 1000:
+            raise FakeHttpError(400, "Too many ids, at most 1000 are allowed")
+        for message_id in body["ids"]:
+            self._apply_label_delta(message_id, body.get("addLabelIds", []), body.get("removeLabelIds", []))
+        return ""
+
+    def _get_profile(self, userId):
+        return {"emailAddress": "me@example.com", "messagesTotal": len(self.messages),
+                "historyId": str(self.history_id)}
+
+    def _watch(self, userId, body):
+        return {"historyId": str(self.history_id), "expiration": "1700000000000"}
+
+    def _list_history(self, userId, startHistoryId, historyTypes=None, pageToken=None, **kwargs):
+        if int(startHistoryId) < self.oldest_history_id:
+            raise FakeHttpError(404, "Requested entity was not found.")
+        records = [record for record in self.history if int(record["id"]) > int(startHistoryId)]
+        start = int(pageToken) if pageToken else 0
+        result = {"history": records[start:start + self.history_page_size],
+                  "historyId": str(self.history_id)}
+        if start + self.history_page_size < len(records):
+            result["nextPageToken"] = str(start + self.history_page_size)
+        return result
+
+    def _get_message(self, userId, id, fields=None, format="full", metadataHeaders=None, **kwargs):
+        if id in self.failing_ids or id not in self.messages:
+            raise FakeHttpError(404, f"Message {id} not found")
+        msg = self.messages[id]
+        if format == "raw":
+            return {"id": msg["id"], "raw": base64.urlsafe_b64encode(_to_mime(msg["payload"]).as_bytes()).decode()}
+        if format == "minimal":
+            return {"id": msg["id"], "labelIds": msg.get("labelIds", [])}
+        if format == "metadata":
+            wanted = {name.lower() for name in metadataHeaders or ()}
+            headers = [header for header in msg["payload"].get("headers", [])
+                       if not wanted or header["name"].lower() in wanted]
+            return {"id": msg["id"], "labelIds": msg.get("labelIds", []), "internalDate": msg["internalDate"],
+                    "payload": {"headers": headers}}
+        if fields is None:
+            return msg
+        # Apply the subset of the partial response syntax used by the fetcher.
+        return {
+            "id": msg["id"],
+            "labelIds": msg.get("labelIds", []),
+            "internalDate": msg["internalDate"],
+            "payload": _project_part(msg["payload"]),
+        }
+
+
+class FakeGmailClient:
+    """Stand-in for `gmail_client.GmailClient` serving a given (fake or mock) service."""
+
+    def __init__(self, service):
+        self._service = service
+
+    def credentials(self):
+        return None
+
+    def service(self):
+        return self._service
+
+    def http(self):
+        return None
@@ -0,0 +1,59 @@
+import unittest
+from action_executor import ExecutionReport, execute_plan_concurrently, format_report, percentile
+from tests.fake_gmail import FakeGmailService, make_message
+
+
+def read_batch(ids):
+    return {"add": [], "remove": ["UNREAD"], "ids": ids}
+
+
+class TestActionExecutor(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeGmailService((make_message(f"id{i}") for i in range(40)), latency=0.01)
+
+    def test_calls_run_concurrently_up_to_the_cap(self):
+        plan = [read_batch([f"id{i}"]) for i in range(20)]
+
+        report = execute_plan_concurrently(self.service, plan, max_workers=4)
+
+        self.assertTrue(report.ok)
+        self.assertEqual(report.calls, 20)
+        self.assertLessEqual(self.service.max_in_flight, 4)
+        self.assertGreater(self.service.max_in_flight, 1)
+        self.assertNotIn("UNREAD", self.service.messages["id19"]["labelIds"])
+
+    def test_rate_limited_calls_are_retried(self):
+        self.service.transient_failures["id1"] = 1
+
+        with self.assertLogs(level="WARNING"):
+            report = execute_plan_concurrently(self.service, [read_batch(["id0"]), read_batch(["id1"])])
+
+        self.assertTrue(report.ok)
+        self.assertEqual(self.service.count("messages.modify"), 3)
+
+    def test_one_bad_message_does_not_fail_its_batch(self):
+        entries = {f"id{i}": [(f"id{i}", "hash", "mark_as_read")] for i in range(10)}
+        entries["id99"] = [("id99", "hash", "mark_as_read")]
+        report = ExecutionReport([], entries_by_email=entries, rule_names={"hash": "rules[0]"})
+        applied = []
+
+        with self.assertLogs(level="ERROR"):
+            execute_plan_concurrently(self.service, [read_batch([f"id{i}" for i in range(5)] + ["id99"]),
+                                                     read_batch([f"id{i}" for i in range(5, 10)])],
+                                      report=report, on_applied=lambda batch: applied.extend(batch["ids"]))
+
+        self.assertEqual(sorted(applied), sorted(f"id{i}" for i in range(10)))
+        self.assertEqual(report.failed_ids, {"id99"})
+        self.assertEqual(report.failures[0]["status"], 404)
+        self.assertEqual(report.summary()["rules"], {"rules[0]": {"succeeded": 10, "failed": 1, "skipped": 0}})
+        self.assertIn("rules[0]: 10 applied, 1 failed, 0 skipped", format_report(report))
+
+    def test_percentiles(self):
+        self.assertIsNone(percentile([], 0.5))
+        self.assertEqual(percentile([3, 1, 2, 4], 0.5), 2)
+        self.assertEqual(percentile(range(1, 101), 0.99), 99)
+        self.assertEqual(percentile([7], 0.99), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
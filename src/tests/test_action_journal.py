@@ -0,0 +1,93 @@
+import unittest
+from datetime import datetime
+from action_journal import filter_unapplied, record_applied, clear_journal
+from db_utils import get_or_initialize_db, insert_emails, AppliedAction, Email
+from label_registry import LabelRegistry
+from process_mail import apply_rules
+from rule_compiler import compile_rules
+from tests.fake_gmail import FakeGmailService, make_message
+
+
+def github_rule(actions):
+    return {"predicate": "All", "conditions": [{"field": "sender", "predicate": "contains", "value": "github"}],
+            "actions": actions}
+
+
+class TestActionJournal(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        clear_journal()
+        self.store([f"id{i}" for i in range(5)])
+        self.service = FakeGmailService(make_message(f"id{i}") for i in range(8))
+        self.registry = LabelRegistry(self.service)
+
+    def tearDown(self):
+        Email.delete().execute()
+        clear_journal()
+        self.db.close()
+
+    def store(self, email_ids):
+        insert_emails([{"id": email_id, "sender": "ci@github.com", "subject": "Build", "body": "",
+                        "received_at": datetime(2025, 1, 1)} for email_id in email_ids])
+
+    def run_rules(self, rules, **kwargs):
+        self.service.calls.clear()
+        apply_rules(self.service, compile_rules({"rules": rules}), self.registry, **kwargs)
+        return [kwargs for method, kwargs in self.service.calls if method.startswith("messages.")]
+
+    def test_second_run_only_applies_actions_to_new_emails(self):
+        rules = [github_rule(["mark_as_read", "flag_message"])]
+        self.assertEqual(len(self.run_rules(rules)), 1)
+        self.assertEqual(AppliedAction.select().count(), 10)
+
+        self.assertEqual(self.run_rules(rules), [])
+
+        self.store(["id5"])
+        calls = self.run_rules(rules)
+        self.assertEqual([call["id"] for call in calls], ["id5"])
+
+    def test_edited_rule_and_force_apply_again(self):
+        self.run_rules([github_rule(["mark_as_read"])])
+
+        calls = self.run_rules([github_rule(["mark_as_read", "flag_message"])])
+        self.assertEqual(calls[0]["body"], {"ids": [f"id{i}" for i in range(5)], "addLabelIds": ["STARRED"],
+                                            "removeLabelIds": ["UNREAD"]})
+
+        self.assertEqual(len(self.run_rules([github_rule(["mark_as_read"])], force=True)), 1)
+
+    def test_dry_runs_and_missing_labels_are_not_journaled(self):
+        rules = [github_rule(["move_to_Builds"])]
+        self.run_rules(rules, dry_run=True)
+        with self.assertLogs(level="WARNING"):
+            self.run_rules(rules)
+        self.assertEqual(AppliedAction.select().count(), 0)
+
+        self.service.labels["Builds"] = "Label_9"
+        self.registry.start_run()
+        self.assertEqual(len(self.run_rules(rules)), 1)
+
+    def test_failed_emails_are_not_journaled(self):
+        self.service.messages.pop("id3")  # batchModify rejects the whole batch
+
+        with self.assertLogs(level="ERROR"):
+            self.run_rules([github_rule(["mark_as_read"])])
+
+        journaled = {email_id for (email_id,) in AppliedAction.select(AppliedAction.email_id).tuples()}
+        self.assertEqual(journaled, {"id0", "id1", "id2", "id4"})
+
+    def test_bulk_lookup_and_deleted_emails(self):
+        entries = [("id1", "hash", "mark_as_read"), ("id2", "hash", "mark_as_read")]
+        self.assertEqual(record_applied(entries[:1]), 1)
+        self.assertEqual(record_applied(entries[:1]), 0)
+
+        self.assertEqual(filter_unapplied(entries), entries[1:])
+
+        Email.delete().where(Email.id == "id1").execute()
+        self.assertEqual(AppliedAction.select().count(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
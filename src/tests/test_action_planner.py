@@ -0,0 +1,110 @@
+import json
+import unittest
+from unittest.mock import patch
+from action_planner import plan_actions, format_plan
+from action_executor import execute_plan_concurrently
+from label_registry import LabelRegistry
+from process_mail import process_emails_based_on_rules
+from db_utils import get_or_initialize_db, Email
+from tests.fake_gmail import FakeGmailService, FakeGmailClient, make_message
+
+
+class TestActionPlanner(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeGmailService(make_message(f"id{i}") for i in range(2500))
+        self.service.labels["Important"] = "Label_1"
+        self.registry = LabelRegistry(self.service)
+
+    def test_opposite_actions_cancel_out(self):
+        plan = plan_actions([("a", ["mark_as_read"]), ("a", ["mark_as_unread"]),
+                             ("b", ["mark_as_read", "flag_message"])], self.registry)
+
+        self.assertEqual(plan, [{"add": ["STARRED"], "remove": ["UNREAD"], "ids": ["b"]}])
+
+    def test_groups_identical_deltas_and_chunks_at_1000_ids(self):
+        matches = [(f"id{i}", ["mark_as_read"]) for i in range(2500)]
+        matches += [(f"id{i}", ["move_to_important"]) for i in range(10)]
+
+        plan = plan_actions(matches, self.registry)
+
+        sizes = sorted((tuple(batch["add"]), tuple(batch["remove"]), len(batch["ids"])) for batch in plan)
+        self.assertEqual(sizes, [((), ("UNREAD",), 490), ((), ("UNREAD",), 1000), ((), ("UNREAD",), 1000),
+                                 (("Label_1",), ("UNREAD",), 10)])
+
+    def test_unknown_actions_and_labels_are_skipped(self):
+        with self.assertLogs(level="WARNING") as logs:
+            plan = plan_actions([("a", ["archive_forever", "move_to_missing"])], self.registry)
+
+        self.assertEqual(plan, [])
+        self.assertEqual(len(logs.output), 2)
+
+    def test_plan_uses_batch_modify_and_modify_for_single_ids(self):
+        plan = plan_actions([(f"id{i}", ["flag_message"]) for i in range(1500)]
+                            + [("id2000", ["mark_as_read"])], self.registry)
+
+        report = execute_plan_concurrently(self.service, plan)
+
+        self.assertEqual(report.calls, 3)
+        self.assertEqual(self.service.count("messages.batchModify"), 2)
+        self.assertEqual(self.service.count("messages.modify"), 1)
+        self.assertIn("STARRED", self.service.messages["id1499"]["labelIds"])
+        self.assertNotIn("UNREAD", self.service.messages["id2000"]["labelIds"])
+
+    def test_format_plan(self):
+        plan = [{"add": ["STARRED"], "remove": [], "ids": [f"id{i}" for i in range(12)]}]
+
+        self.assertEqual(
+            format_plan(plan),
+            "Batch 1: 12 email(s), add ['STARRED'], remove -: "
+            "id0, id1, id2, id3, id4, id5, id6, id7, id8, id9, ... (2 more)")
+        self.assertEqual(format_plan([]), "No label changes planned.")
+
+
+class TestProcessEmailsPlanning(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        self.service = FakeGmailService(make_message(f"id{i}") for i in range(20))
+        for i in range(20):
+            Email.create(id=f"id{i}", sender="bot@github.com", subject=f"Build {i}", body="",
+                         received_at="2025-01-01 00:00:00")
+        self.rules = {"rules": [
+            {"predicate": "All", "conditions": [{"field": "sender", "predicate": "contains", "value": "github"}],
+             "actions": ["mark_as_read", "flag_message"]},
+            {"predicate": "All", "conditions": [{"field": "subject", "predicate": "equals", "value": "Build 3"}],
+             "actions": ["mark_as_unread"]},
+        ]}
+
+    def tearDown(self):
+        self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        self.db.close()
+
+    def run_rules(self, **kwargs):
+        with patch("process_mail.get_gmail_client", return_value=FakeGmailClient(self.service)), \
+                patch("builtins.open", unittest.mock.mock_open(read_data=json.dumps(self.rules))):
+            process_emails_based_on_rules("rules.json", testing=True, **kwargs)
+
+    def test_rules_are_applied_in_aggregated_batches(self):
+        self.run_rules()
+
+        self.assertEqual(self.service.count("messages.batchModify"), 1)
+        self.assertEqual(self.service.count("messages.modify"), 1)
+        self.assertEqual(self.service.messages["id5"]["labelIds"], ["INBOX", "STARRED"])
+        self.assertEqual(self.service.messages["id3"]["labelIds"], ["INBOX", "UNREAD", "STARRED"])
+
+    def test_dry_run_prints_plan_without_modifying(self):
+        with patch("builtins.print") as mock_print:
+            self.run_rules(dry_run=True)
+
+        self.assertEqual(self.service.count("messages.batchModify"), 0)
+        self.assertEqual(self.service.count("messages.modify"), 0)
+        printed = mock_print.call_args[0][0]
+        self.assertIn("Batch 1: 19 email(s)", printed)
+        self.assertIn("Batch 2: 1 email(s), add ['STARRED'], remove -: id3", printed)
+
+
+if __name__ == "__main__":
+    unittest.main()
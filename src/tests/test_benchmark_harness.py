@@ -0,0 +1,69 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from benchmarks import harness
+from benchmarks.mailbox import SyntheticMailbox
+from gmail_mail_fetch import parse_message
+from tests.fake_gmail import FakeGmailService, FakeHttpError
+
+
+class TestSyntheticMailbox(unittest.TestCase):
+    def test_messages_are_reproducible_and_match_their_rows(self):
+        mailbox = SyntheticMailbox(500, seed=7)
+
+        self.assertEqual(mailbox.row(123), SyntheticMailbox(500, seed=7).row(123))
+        self.assertNotEqual(mailbox.row(123), SyntheticMailbox(500, seed=8).row(123))
+        parsed = parse_message(mailbox["msg00000123"])
+        self.assertEqual({key: parsed[key] for key in ("id", "sender", "subject", "body", "received_at")},
+                         {key: value for key, value in mailbox.row(123).items() if key != "labels"})
+        self.assertEqual(len(list(mailbox)), 500)
+        self.assertNotIn("msg00000500", mailbox)
+
+    def test_senders_are_skewed(self):
+        mailbox = SyntheticMailbox(2000, senders=1000, sender_skew=1.2)
+        senders = [row["sender"] for row in mailbox.rows()]
+
+        self.assertGreater(senders.count(mailbox.top_senders(1)[0]), len(senders) / 10)
+
+
+class TestFakeServiceQuota(unittest.TestCase):
+    def test_calls_over_the_per_second_quota_are_throttled(self):
+        now = [0.0]
+        service = FakeGmailService(SyntheticMailbox(10), quota_per_second=10, clock=lambda: now[0])
+
+        for _ in range(2):
+            service.users().messages().get(userId="me", id="msg00000001").execute()
+        with self.assertRaises(FakeHttpError) as raised:
+            service.users().messages().get(userId="me", id="msg00000001").execute()
+        now[0] = 1.0
+        service.users().messages().get(userId="me", id="msg00000001").execute()
+
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertEqual(service.throttled, 1)
+        self.assertEqual(service.method_counts["messages.get"], 4)
+
+
+class TestHarness(unittest.TestCase):
+    def test_writes_results_and_flags_regressions(self):
+        with tempfile.TemporaryDirectory() as directory, patch.dict(harness.SIZES, {"tiny": 300}):
+            output = os.path.join(directory, "results.json")
+            self.assertEqual(harness.main(["--sizes", "tiny", "--rules", "8", "--output", output]), 0)
+            with open(output) as results_file:
+                document = json.load(results_file)
+
+        by_scenario = {entry["scenario"]: entry for entry in document["results"]}
+        self.assertEqual(set(by_scenario), {"fetch", "rules", "actions"})
+        self.assertEqual(by_scenario["fetch"]["inserted"], 300)
+        self.assertEqual(by_scenario["fetch"]["api_calls"]["messages.get"], 300)
+        self.assertEqual(by_scenario["actions"]["failed_emails"], 0)
+        self.assertGreater(by_scenario["actions"]["changed"], 0)
+
+        slower = {"results": [{**entry, "seconds": entry["seconds"] * 2 + 1} for entry in document["results"]]}
+        self.assertEqual(len(harness.find_regressions(slower, document, tolerance=0.25)), 3)
+        self.assertEqual(harness.find_regressions(document, slower, tolerance=0.25), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from unittest.mock import patch
+from concurrent_fetch import fetch_messages_concurrently, fetch_emails_concurrently_and_store
+from db_utils import get_or_initialize_db, Email
+from tests.fake_gmail import FakeGmailService, FakeGmailClient, make_message
+
+
+class TestConcurrentFetch(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        self.service = FakeGmailService(
+            (make_message(f"id{i}", subject=f"Subject {i}") for i in range(30)), latency=0.01)
+
+    def tearDown(self):
+        Email.delete().execute()
+        self.db.close()
+
+    def test_runs_calls_concurrently_within_the_limit(self):
+        rows = list(fetch_messages_concurrently(
+            self.service, [f"id{i}" for i in range(30)], max_workers=5))
+
+        self.assertEqual(sorted(row["id"] for row in rows), sorted(f"id{i}" for i in range(30)))
+        self.assertGreater(self.service.max_in_flight, 1)
+        self.assertLessEqual(self.service.max_in_flight, 5)
+
+    @patch("gmail_api.backoff_delay", return_value=0)
+    def test_transient_errors_are_retried_and_missing_messages_skipped(self, mock_delay):
+        self.service.transient_failures = {"id1": 2}
+        self.service.failing_ids.add("id2")
+
+        with self.assertLogs(level="WARNING") as logs:
+            rows = list(fetch_messages_concurrently(self.service, ["id1", "id2", "id3"]))
+
+        self.assertEqual(sorted(row["id"] for row in rows), ["id1", "id3"])
+        self.assertEqual(sum("Retrying messages.get" in line for line in logs.output), 2)
+        self.assertTrue(any("Error processing message id2" in line for line in logs.output))
+
+    @patch("concurrent_fetch.get_gmail_client")
+    def test_fetch_emails_concurrently_and_store(self, mock_get_client):
+        mock_get_client.return_value = FakeGmailClient(self.service)
+
+        stats = fetch_emails_concurrently_and_store(testing=True, num_messages=25, max_workers=8)
+
+        self.assertEqual(stats, {"listed": 25, "skipped": 0, "fetched": 25, "inserted": 25})
+        self.db.connect(reuse_if_open=True)
+        self.assertEqual(Email.select().count(), 25)
+        self.assertEqual(Email.get(Email.id == "id7").subject, "Subject 7")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import MagicMock
+from daemon import MailDaemon, QueueNotificationSource, PubSubPullSource, decode_notification, start_push_server
+from history_sync import HISTORY_ID_KEY
+from label_registry import LabelRegistry
+from db_utils import get_or_initialize_db, get_sync_state, set_sync_state, Email
+from tests.fake_gmail import FakeGmailService, make_message
+
+RULES = {"rules": [{"predicate": "All", "conditions": [
+    {"field": "sender", "predicate": "contains", "value": "github"}], "actions": ["mark_as_read"]}]}
+
+
+def encode_notification(history_id):
+    data = json.dumps({"emailAddress": "me@example.com", "historyId": history_id}).encode("utf-8")
+    return {"data": base64.b64encode(data).decode("ascii"), "messageId": "1"}
+
+
+class TestMailDaemon(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        set_sync_state(HISTORY_ID_KEY, None)
+        self.directory = tempfile.TemporaryDirectory()
+        self.rules_path = os.path.join(self.directory.name, "rules.json")
+        with open(self.rules_path, "w") as rules_file:
+            json.dump(RULES, rules_file)
+
+        self.service = FakeGmailService(
+            [make_message("old1", sender="ci@github.com"), make_message("old2", sender="friend@mail.com")])
+        self.source = QueueNotificationSource()
+        self.daemon = MailDaemon(self.service, self.db, self.rules_path, LabelRegistry(self.service),
+                                 source=self.source, poll_interval=60)
+
+    def tearDown(self):
+        Email.delete().execute()
+        set_sync_state(HISTORY_ID_KEY, None)
+        self.directory.cleanup()
+        self.db.close()
+
+    def modified_ids(self):
+        ids = []
+        for method, kwargs in self.service.calls:
+            if method == "messages.modify":
+                ids.append(kwargs["id"])
+            elif method == "messages.batchModify":
+                ids += kwargs["body"]["ids"]
+        return ids
+
+    def test_notification_applies_rules_to_new_messages_only(self):
+        self.daemon.run(max_cycles=1)  # Catch-up cycle: full resync and rules on everything
+        self.assertEqual(self.modified_ids(), ["old1"])
+        self.service.calls.clear()
+
+        self.service.add_message(make_message("new1", sender="ci@github.com"))
+        self.service.add_message(make_message("new2", sender="friend@mail.com"))
+        self.source.put(decode_notification(encode_notification(self.service.history_id)))
+        started = time.monotonic()
+        self.daemon.run(max_cycles=2)
+
+        self.assertLess(time.monotonic() - started, 5)  # Not the 60 second poll interval
+        self.assertEqual(self.modified_ids(), ["new1"])
+        self.assertEqual(self.service.count("messages.get"), 2)
+        self.assertEqual(get_sync_state(HISTORY_ID_KEY), str(self.service.history_id))
+
+    def test_notifications_already_synced_do_not_trigger_a_cycle(self):
+        self.daemon.poll_interval = 0.3
+        # Covered by the catch-up cycle the daemon starts with
+        self.source.put({"emailAddress": "me@example.com", "historyId": str(self.service.history_id)})
+
+        started = time.monotonic()
+        self.daemon.run(max_cycles=2)
+
+        # The stale notification was skipped; the second cycle is the scheduled poll.
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual(self.service.count("history.list"), 1)
+
+    def test_watch_is_started_and_a_failed_cycle_does_not_stop_the_daemon(self):
+        self.daemon.topic = "projects/p/topics/gmail"
+        self.daemon.poll_interval = 0.01
+        original = self.service._list_messages
+        failures = [RuntimeError("backend unavailable")]
+
+        def fail_once(**kwargs):
+            if failures:
+                raise failures.pop()
+            return original(**kwargs)
+
+        self.service._list_messages = fail_once  # The first full resync fails
+        with self.assertLogs(level="ERROR"):
+            self.daemon.run(max_cycles=2)
+
+        self.assertEqual(self.service.count("users.watch"), 1)
+        watch = next(kwargs for method, kwargs in self.service.calls if method == "users.watch")
+        self.assertEqual(watch["body"]["topicName"], "projects/p/topics/gmail")
+        self.assertEqual(Email.select().count(), 2)
+
+    def test_a_failed_wait_does_not_stop_the_daemon(self):
+        self.daemon.poll_interval = 0.05
+        failures = [RuntimeError("pubsub unavailable")]
+        wait = self.source.wait
+
+        def fail_once(timeout):
+            if failures:
+                raise failures.pop()
+            return wait(timeout)
+
+        self.source.wait = fail_once
+        with self.assertLogs(level="ERROR"):
+            self.daemon.run(max_cycles=2)
+
+        self.assertEqual(self.daemon.cycles, 2)
+
+    def test_stop_event_ends_the_loop(self):
+        stop = threading.Event()
+        self.daemon.source = None
+        stop.set()
+
+        self.daemon.run(stop_event=stop)
+
+        self.assertEqual(self.daemon.cycles, 0)
+
+
+class TestPubSubPullSource(unittest.TestCase):
+    def test_empty_pull_sleeps_off_the_timeout(self):
+        pubsub = MagicMock()
+        subscriptions = pubsub.projects.return_value.subscriptions.return_value
+        subscriptions.pull.return_value.execute.side_effect = [
+            {}, {"receivedMessages": [{"ackId": "a1", "message": encode_notification("42")}]}]
+        sleeps = []
+        source = PubSubPullSource(pubsub, "projects/p/subscriptions/s", clock=lambda: 0.0, sleep=sleeps.append)
+
+        self.assertEqual(source.wait(30), [])
+        self.assertEqual(sleeps, [30])
+
+        self.assertEqual(source.wait(30), [{"emailAddress": "me@example.com", "historyId": "42"}])
+        self.assertEqual(sleeps, [30])
+        subscriptions.acknowledge.assert_called_once_with(
+            subscription="projects/p/subscriptions/s", body={"ackIds": ["a1"]})
+
+
+class TestPushEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.source = QueueNotificationSource()
+        self.server = start_push_server(self.source, host="127.0.0.1", port=0, token="secret")
+        self.url = f"http://127.0.0.1:{self.server.server_port}/gmail"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, url, envelope):
+        request = urllib.request.Request(url, data=json.dumps(envelope).encode("utf-8"), method="POST",
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_push_requests_are_queued(self):
+        status = self.post(self.url + "?token=secret", {"message": encode_notification("1234")})
+
+        self.assertEqual(status, 204)
+        self.assertEqual(self.source.wait(1), [{"emailAddress": "me@example.com", "historyId": "1234"}])
+
+    def test_requests_without_token_or_message_are_rejected(self):
+        self.assertEqual(self.post(self.url, {"message": encode_notification("1")}), 403)
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(self.post(self.url + "?token=secret", {"nothing": 1}), 400)
+        self.assertEqual(self.source.wait(0.05), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from db_utils import (
+    initialize_db, get_or_initialize_db, get_schema_version, insert_emails, sender_domain_of, Email, EmailBody,
+    SCHEMA_VERSION
+)
+from rule_compiler import compile_rules
+from rule_engine import evaluate_rules, index_prefilter
+
+# Schema written by the first release, before versioned migrations existed.
+ORIGINAL_SCHEMA = (
+    'CREATE TABLE "email" ("id" VARCHAR(255) NOT NULL PRIMARY KEY, "sender" VARCHAR(255) NOT NULL, '
+    '"subject" VARCHAR(255) NOT NULL, "body" TEXT NOT NULL, "received_at" DATETIME NOT NULL)'
+)
+
+
+def query_plan(db, query):
+    sql, params = query.sql()
+    return " ".join(row[3] for row in db.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params).fetchall())
+
+
+class TestDatabaseSchema(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "emails.db")
+
+    def tearDown(self):
+        Email._meta.database.close()
+        self.directory.cleanup()
+        get_or_initialize_db(testing=True)
+
+    def test_new_database_starts_at_latest_version_with_tuned_pragmas(self):
+        db = initialize_db(self.path)
+
+        self.assertEqual(get_schema_version(db), SCHEMA_VERSION)
+        self.assertEqual(db.pragma("journal_mode"), "wal")
+        self.assertEqual(db.pragma("synchronous"), 1)  # NORMAL
+        index_names = {index.name for index in db.get_indexes("email")}
+        self.assertTrue({"email_sender", "email_received_at", "email_sender_domain"} <= index_names)
+
+    def test_safe_profile_keeps_sqlite_defaults(self):
+        db = initialize_db(self.path, profile="safe")
+
+        self.assertEqual(db.pragma("journal_mode"), "delete")
+
+    def test_original_database_is_upgraded_in_place(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute(ORIGINAL_SCHEMA)
+        connection.execute("INSERT INTO email VALUES ('1', 'ci@GitHub.com', 'Build', 'body', '2025-01-01 00:00:00')")
+        connection.commit()
+        connection.close()
+
+        db = initialize_db(self.path)
+
+        self.assertEqual(get_schema_version(db), SCHEMA_VERSION)
+        email = Email.get(Email.id == "1")
+        self.assertEqual((email.subject, email.labels, email.sender_domain), ("Build", "", "github.com"))
+        plan = query_plan(db, Email.select(Email.id).where(Email.sender_domain == "github.com"))
+        self.assertIn("USING INDEX email_sender_domain", plan)
+
+        db.close()
+        db = initialize_db(self.path)
+        self.assertEqual(get_schema_version(db), SCHEMA_VERSION)
+        self.assertEqual(Email.select().count(), 1)
+
+    def test_upgrade_without_drop_column_support_copies_the_table(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute(ORIGINAL_SCHEMA)
+        connection.execute("INSERT INTO email VALUES ('1', 'ci@GitHub.com', 'Build', 'body', '2025-01-01 00:00:00')")
+        connection.commit()
+        connection.close()
+
+        with patch("db_utils.sqlite3.sqlite_version_info", (3, 34, 1)):
+            db = initialize_db(self.path)
+
+        self.assertNotIn("body", {column.name for column in db.get_columns("email")})
+        self.assertEqual(Email.get(Email.id == "1").body, "body")
+        self.assertEqual(db.get_tables().count("email_with_body"), 0)
+        self.assertTrue({"email_sender", "email_received_at", "email_sender_domain"}
+                        <= {index.name for index in db.get_indexes("email")})
+        Email.delete().execute()
+        self.assertEqual(EmailBody.select().count(), 0)
+
+    def test_too_old_sqlite_is_reported(self):
+        with patch("db_utils.sqlite3.sqlite_version_info", (3, 22, 0)):
+            with self.assertRaises(RuntimeError):
+                initialize_db(self.path)
+
+    def test_sender_domain_is_generated_and_never_written(self):
+        initialize_db(self.path)
+        email = Email.create(id="1", sender="Bot <bot@Medium.com>", subject="s", body="",
+                             received_at=datetime(2025, 1, 1))
+        email = Email.get(Email.id == "1")
+        email.subject = "changed"
+        email.save()
+
+        self.assertEqual(Email.get(Email.id == "1").sender_domain, "medium.com")
+        self.assertEqual(sender_domain_of("Bot <bot@Medium.com>"), "medium.com")
+        self.assertEqual(sender_domain_of("no address"), "")
+
+    def test_rule_scan_uses_indexes_when_every_rule_is_indexable(self):
+        db = initialize_db(self.path)
+        now = datetime.now()
+        insert_emails([{"id": str(i), "sender": f"user@{'github.com' if i % 3 else 'shop.com'}",
+                        "subject": "s", "body": "", "received_at": now - timedelta(days=i)}
+                       for i in range(60)])
+        program = compile_rules({"rules": [
+            {"predicate": "All", "conditions": [
+                {"field": "sender", "predicate": "contains", "value": "github"},
+                {"field": "received_at", "predicate": "less_than", "value": "7"}], "actions": ["flag_message"]},
+            {"predicate": "All", "conditions": [
+                {"field": "sender_domain", "predicate": "equals", "value": "shop.com"}], "actions": ["flag_message"]},
+        ]})
+
+        prefilter = index_prefilter(program, now)
+        plan = query_plan(db, Email.select(Email.id).where(prefilter))
+        matches = evaluate_rules(program, now=now)
+
+        self.assertIn("INDEX email_received_at", plan)
+        self.assertIn("INDEX email_sender_domain", plan)
+        self.assertEqual(matches[0], {str(i) for i in range(7) if i % 3})
+        self.assertEqual(matches[1], {str(i) for i in range(60) if i % 3 == 0})
+        for rule in program.rules:
+            self.assertEqual(matches[rule.index],
+                             {email.id for email in Email.select(Email.id).where(rule.to_expression(now))})
+
+    def test_prefilter_is_skipped_when_a_rule_needs_a_full_scan(self):
+        program = compile_rules({"rules": [{"predicate": "Any", "conditions": [
+            {"field": "sender", "predicate": "contains", "value": "github"},
+            {"field": "received_at", "predicate": "less_than", "value": "7"}], "actions": ["flag_message"]}]})
+
+        self.assertIsNone(index_prefilter(program, datetime.now()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime
+from db_utils import (
+    initialize_db, get_or_initialize_db, get_schema_version, encode_body, decode_body, insert_emails,
+    full_text_expression, Email, EmailBody, SCHEMA_VERSION, BODY_RAW, BODY_ZLIB
+)
+from rule_compiler import compile_rules
+from rule_engine import evaluate_rules
+
+# Schema and FTS layout of version 2, when bodies were stored inline in the email table.
+VERSION_2_SCHEMA = [
+    'CREATE TABLE "email" ("id" VARCHAR(255) NOT NULL PRIMARY KEY, "sender" VARCHAR(255) NOT NULL, '
+    '"subject" VARCHAR(255) NOT NULL, "body" TEXT NOT NULL, "received_at" DATETIME NOT NULL, '
+    '"labels" TEXT NOT NULL DEFAULT \'\', "sender_domain" VARCHAR(255) GENERATED ALWAYS AS '
+    "(lower(substr(sender, instr(sender, '@') + 1))) VIRTUAL)",
+    "CREATE VIRTUAL TABLE email_fts USING fts5(subject, body, content=email, content_rowid=rowid)",
+    """CREATE TRIGGER email_fts_after_insert AFTER INSERT ON email BEGIN
+        INSERT INTO email_fts(rowid, subject, body) VALUES (new.rowid, new.subject, new.body);
+    END""",
+    "PRAGMA user_version = 2",
+]
+
+
+def matching_ids(expression):
+    return {email.id for email in Email.select(Email.id).where(expression)}
+
+
+class TestBodyCodec(unittest.TestCase):
+    def test_round_trips_and_compresses_large_bodies(self):
+        body = "Your build #1234 failed on main. " * 200
+
+        encoded = encode_body(body)
+
+        self.assertEqual(decode_body(encoded), body)
+        self.assertLess(len(encoded) * 10, len(body))
+        self.assertEqual(encode_body("hi"), BODY_RAW + b"hi")
+        self.assertEqual(encode_body(body, codec="zlib")[:1], BODY_ZLIB)
+        self.assertEqual(decode_body(None), "")
+        self.assertEqual(decode_body(encode_body("héllo " * 50)), "héllo " * 50)
+
+
+class TestEmailBodyStorage(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        insert_emails([
+            {"id": "a", "sender": "ci@github.com", "subject": "Build", "body": "build failed " * 20,
+             "received_at": datetime(2025, 1, 1), "labels": ""},
+            {"id": "b", "sender": "shop@shop.com", "subject": "Invoice", "body": "pay now",
+             "received_at": datetime(2025, 1, 2), "labels": ""},
+        ])
+
+    def tearDown(self):
+        Email.delete().execute()
+        self.db.close()
+
+    def test_bodies_are_stored_compressed_and_loaded_lazily(self):
+        self.assertNotIn("body", {column.name for column in self.db.get_columns("email")})
+        stored = EmailBody.get(EmailBody.email_id == "a")
+        self.assertLess(len(stored.data), len("build failed " * 20))
+
+        email = Email.get(Email.id == "a")
+        self.assertEqual(email.body, "build failed " * 20)
+
+        email.body = "fixed"
+        email.save()
+        self.assertEqual(Email.get(Email.id == "a").body, "fixed")
+
+    def test_deleting_an_email_deletes_its_body(self):
+        Email.delete().where(Email.id == "a").execute()
+
+        self.assertIsNone(EmailBody.get_or_none(EmailBody.email_id == "a"))
+        self.assertIsNotNone(EmailBody.get_or_none(EmailBody.email_id == "b"))
+
+    def test_body_conditions_match_in_sql_and_in_the_single_pass_engine(self):
+        program = compile_rules({"rules": [
+            {"predicate": "All", "conditions": [{"field": "body", "predicate": "contains", "value": "FAILED"}],
+             "actions": ["flag_message"]},
+            {"predicate": "All", "conditions": [{"field": "body", "predicate": "not_contains", "value": "pay"}],
+             "actions": ["flag_message"]},
+            {"predicate": "All", "conditions": [{"field": "body", "predicate": "equals", "value": "pay now"}],
+             "actions": ["flag_message"]},
+        ]})
+
+        matches = evaluate_rules(program)
+
+        self.assertEqual(matches, {0: {"a"}, 1: {"a"}, 2: {"b"}})
+        for rule in program.rules:
+            self.assertEqual(matches[rule.index], matching_ids(rule.to_expression()))
+
+
+class TestBodyMigration(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "emails.db")
+
+    def tearDown(self):
+        Email._meta.database.close()
+        self.directory.cleanup()
+        get_or_initialize_db(testing=True)
+
+    def test_inline_bodies_are_moved_and_full_text_index_rebuilt(self):
+        connection = sqlite3.connect(self.path)
+        for statement in VERSION_2_SCHEMA:
+            connection.execute(statement)
+        connection.execute("INSERT INTO email (id, sender, subject, body, received_at) VALUES "
+                           "('1', 'ci@github.com', 'Build', 'the release build is green', '2025-01-01 00:00:00')")
+        connection.commit()
+        connection.close()
+
+        db = initialize_db(self.path)
+
+        self.assertEqual(get_schema_version(db), SCHEMA_VERSION)
+        self.assertNotIn("body", {column.name for column in db.get_columns("email")})
+        self.assertEqual(Email.get(Email.id == "1").body, "the release build is green")
+        self.assertEqual(matching_ids(full_text_expression("body", "release")), {"1"})
+        self.assertEqual(matching_ids(full_text_expression("subject", "build")), {"1"})
+
+        insert_emails([{"id": "2", "sender": "x@example.com", "subject": "Hello",
+                        "body": "another release", "received_at": datetime(2025, 1, 2)}])
+        self.assertEqual(matching_ids(full_text_expression("body", "release")), {"1", "2"})
+        Email.delete().where(Email.id == "1").execute()
+        self.assertEqual(matching_ids(full_text_expression("body", "release")), {"2"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import random
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from email_snapshot import export_snapshot, evaluate_snapshot, read_meta, Snapshot
+from rule_compiler import compile_rules
+from rule_engine import evaluate_rules
+from db_utils import get_or_initialize_db, insert_emails, ActiveRule, Email
+
+RULES = {"rules": [
+    {"predicate": "All", "actions": ["mark_as_read"], "conditions": [
+        {"field": "sender_domain", "predicate": "equals", "value": "github.com"},
+        {"field": "received_at", "predicate": "less_than", "value": "7", "unit": "days"}]},
+    {"predicate": "Any", "actions": ["flag_message"], "conditions": [
+        {"field": "subject", "predicate": "contains", "value": "INVOICE"},
+        {"field": "received_at", "predicate": "greater_than", "value": "1", "unit": "months"}]},
+    {"predicate": "All", "actions": ["move_to_Old"], "conditions": [
+        {"field": "sender", "predicate": "not_equals", "value": "Friend <friend@mail.com>"},
+        {"field": "subject", "predicate": "not_contains", "value": "hello"}]},
+    {"predicate": "All", "actions": ["mark_as_unread"], "conditions": [
+        {"field": "body", "predicate": "contains", "value": "pay"}]},
+]}
+
+
+class TestEmailSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        ActiveRule.delete().execute()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        self.now = datetime(2025, 3, 1, 12, 0, 0)
+        self.rng = random.Random(3)
+        self.program = compile_rules(RULES)
+        self.insert(f"id{i:03}" for i in range(150))
+
+    def tearDown(self):
+        Email.delete().execute()
+        self.directory.cleanup()
+        self.db.close()
+
+    def insert(self, email_ids, received_at=None):
+        insert_emails([{
+            "id": email_id, "sender": self.rng.choice(["ci@github.com", "Friend <friend@mail.com>", "no-at"]),
+            "subject": self.rng.choice(["Invoice 7", "hello", "Ünïcode"]), "body": self.rng.choice(["pay now", ""]),
+            "received_at": received_at or self.now - timedelta(hours=self.rng.randint(0, 24 * 60)),
+        } for email_id in email_ids])
+
+    def simulate(self, now):
+        snapshot = Snapshot(self.path)
+        return {index: set(snapshot.ids(mask)) for index, mask in evaluate_snapshot(self.program, snapshot, now).items()}
+
+    def test_simulation_matches_the_database(self):
+        self.assertEqual(export_snapshot(self.path, bodies=True), 150)
+
+        for days in (0, 5, 40):
+            now = self.now + timedelta(days=days)
+            self.assertEqual(self.simulate(now), evaluate_rules(self.program, now=now))
+
+    def test_updates_append_from_the_watermark(self):
+        export_snapshot(self.path, bodies=True, chunk_size=40)
+        watermark = datetime.fromisoformat(read_meta(self.path)["watermark"])
+        self.insert(["same_time"], received_at=watermark)
+        self.insert(["newer1", "newer2"], received_at=self.now + timedelta(hours=1))
+        # Bytes of an interrupted update past the recorded sizes are dropped
+        with open(os.path.join(self.path, "subject.codes.i4"), "ab") as column_file:
+            column_file.write(b"\xff" * 12)
+
+        self.assertEqual(export_snapshot(self.path, bodies=True, chunk_size=40), 3)
+        self.assertEqual(export_snapshot(self.path, bodies=True), 0)
+
+        self.assertEqual(Snapshot(self.path).rows, 153)
+        self.assertEqual(self.simulate(self.now), evaluate_rules(self.program, now=self.now))
+
+    def test_body_conditions_need_bodies(self):
+        export_snapshot(self.path)
+
+        with self.assertRaises(ValueError):
+            evaluate_snapshot(self.program, Snapshot(self.path), self.now)
+        self.program = compile_rules({"rules": RULES["rules"][:3]})
+        self.assertEqual(self.simulate(self.now), evaluate_rules(self.program, now=self.now))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+from email_writer import EmailWriter
+from gmail_mail_fetch import sync_all_emails
+from db_utils import get_or_initialize_db, insert_emails, ActiveRule, Email, EmailBody
+from tests.fake_gmail import FakeGmailService, make_message
+
+
+def make_row(email_id, subject="Subject", body="Body"):
+    return {"id": email_id, "sender": "sender@example.com", "subject": subject, "body": body,
+            "received_at": datetime(2025, 1, 1), "labels": "INBOX"}
+
+
+class TestEmailWriter(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        ActiveRule.delete().execute()
+
+    def tearDown(self):
+        Email.delete().execute()
+        self.db.close()
+
+    def test_rows_are_committed_in_chunks(self):
+        stats = {"fetched": 0, "inserted": 0}
+        with EmailWriter(self.db, rows_per_commit=40, stats=stats) as writer:
+            for i in range(100):
+                writer.put(make_row(f"id{i:03}"))
+            writer.flush()
+            self.assertEqual(Email.select().count(), 100)
+            writer.put(make_row("id000"))
+
+        self.assertEqual(writer.commits, 4)
+        self.assertEqual(writer.inserted, 100)
+        self.assertEqual(stats, {"fetched": 101, "inserted": 100})
+
+    def test_statements_stay_below_the_parameter_limit(self):
+        with patch("db_utils.max_variables", return_value=12), \
+                patch.object(Email, "insert_many", wraps=Email.insert_many) as insert_many:
+            self.assertEqual(insert_emails([make_row(f"id{i}") for i in range(7)]), 7)
+
+        self.assertEqual([len(call.args[0]) for call in insert_many.call_args_list], [2, 2, 2, 1])
+        self.assertEqual(EmailBody.select().count(), 7)
+
+    def test_upsert_updates_changed_messages_only(self):
+        service = FakeGmailService(make_message(f"id{i}", subject="Old", body="Old body") for i in range(5))
+        sync_all_emails(service, self.db)
+        service.messages["id1"] = make_message("id1", subject="New", body="New body")
+        service.messages["id2"]["labelIds"] = ["INBOX"]
+
+        ignored = sync_all_emails(service, self.db, resume=False)
+        upserted = sync_all_emails(service, self.db, resume=False, on_conflict="upsert")
+
+        self.assertEqual(ignored["inserted"], 0)
+        self.assertEqual(upserted, {"listed": 5, "skipped": 0, "fetched": 5, "inserted": 2})
+        self.assertEqual(Email.get_by_id("id1").subject, "New")
+        self.assertEqual(Email.get_by_id("id1").body, "New body")
+        self.assertEqual(Email.get_by_id("id2").labels, "INBOX")
+        self.assertEqual(Email.get_by_id("id3").subject, "Old")
+
+    def test_writer_errors_reach_the_caller(self):
+        with patch("email_writer.insert_emails", side_effect=RuntimeError("disk full")):
+            with self.assertRaises(RuntimeError):
+                with EmailWriter(self.db, rows_per_commit=2) as writer:
+                    for i in range(10):  # More rows than the queue holds
+                        writer.put(make_row(f"id{i}"))
+
+        self.assertEqual(Email.select().count(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
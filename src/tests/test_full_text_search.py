@@ -0,0 +1,104 @@
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+from db_utils import (
+    get_or_initialize_db, enable_full_text_search, full_text_search_enabled, full_text_expression, Email
+)
+from rule_compiler import compile_rules, RuleValidationError
+from rule_engine import evaluate_rules, _compile_condition
+
+
+def matching_ids(field, query):
+    return {email.id for email in Email.select(Email.id).where(full_text_expression(field, query))}
+
+
+class TestFullTextSearch(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        for email_id, subject, body in [
+            ("a", "Invoice 42 due", "Please pay the invoice by Friday"),
+            ("b", "Weekly digest", "Top stories about invoices and payments"),
+            ("c", "Build failed", "The nightly build failed on main"),
+        ]:
+            Email.create(id=email_id, sender="x@example.com", subject=subject, body=body,
+                         received_at=datetime(2025, 1, 1))
+
+    def tearDown(self):
+        Email.delete().execute()
+        self.db.close()
+
+    def test_migration_indexes_existing_rows_and_triggers_keep_it_in_sync(self):
+        enable_full_text_search(self.db)
+        self.assertTrue(full_text_search_enabled(self.db))
+        self.assertEqual(matching_ids("subject", "invoice"), {"a"})
+
+        Email.create(id="d", sender="y@example.com", subject="Second invoice", body="",
+                     received_at=datetime(2025, 1, 2))
+        Email.update(subject="Paid").where(Email.id == "a").execute()
+        Email.delete().where(Email.id == "c").execute()
+
+        self.assertEqual(matching_ids("subject", "invoice"), {"d"})
+        self.assertEqual(matching_ids("body", "build"), set())
+        self.assertEqual(matching_ids("body", "invoice*"), {"a", "b"})
+
+        enable_full_text_search(self.db)  # Running the migration again is harmless
+        self.assertEqual(matching_ids("subject", "invoice"), {"d"})
+
+    def test_matches_predicate(self):
+        enable_full_text_search(self.db)
+        program = compile_rules({"rules": [{"predicate": "All", "conditions": [
+            {"field": "body", "predicate": "matches", "value": "invoice* NOT digest"}],
+            "actions": ["flag_message"]}]})
+
+        self.assertEqual(evaluate_rules(program), {0: {"a", "b"}})
+        self.assertTrue(program.rules[0].matches({"body": "an invoice"}))
+        self.assertFalse(program.rules[0].matches({"body": "no bill here"}))
+        self.assertEqual({email.id for email in Email.select().where(program.rules[0].to_expression())},
+                         {"a", "b"})
+
+    def test_matches_predicate_is_validated(self):
+        with self.assertRaises(RuleValidationError) as error:
+            compile_rules({"rules": [{"predicate": "All", "conditions": [
+                {"field": "sender", "predicate": "matches", "value": "github"},
+                {"field": "body", "predicate": "matches", "value": "AND OR ("}],
+                "actions": ["flag_message"]}]})
+
+        self.assertEqual(len(error.exception.errors), 2)
+        self.assertIn("invalid full-text query", error.exception.errors[1])
+
+    def test_word_style_contains_routed_through_index(self):
+        enable_full_text_search(self.db)
+        program = compile_rules({"rules": [
+            {"predicate": "All", "conditions": [{"field": "body", "predicate": "contains", "value": "build failed"}],
+             "actions": ["flag_message"]},
+            {"predicate": "All", "conditions": [{"field": "body", "predicate": "not_contains", "value": "invoice"}],
+             "actions": ["flag_message"]},
+        ]})
+
+        with patch("rule_engine.MultiPatternMatcher") as mock_matcher:
+            routed = evaluate_rules(program, full_text=True)
+        mock_matcher.assert_not_called()
+
+        self.assertEqual(routed, {0: {"c"}, 1: {"b", "c"}})
+        # Substring semantics without the index: "invoices" contains "invoice"
+        self.assertEqual(evaluate_rules(program), {0: {"c"}, 1: {"c"}})
+
+    def test_index_lookups_are_limited_to_the_query(self):
+        enable_full_text_search(self.db)
+        program = compile_rules({"rules": [
+            {"predicate": "Any", "conditions": [{"field": "body", "predicate": "matches", "value": "invoice*"}],
+             "actions": ["flag_message"]}]})
+
+        with patch("rule_engine._compile_condition", wraps=_compile_condition) as compile_condition:
+            matches = evaluate_rules(program, query=Email.id.in_(["b", "c"]))
+
+        self.assertEqual(matches, {0: {"b"}})
+        full_text_ids = compile_condition.call_args.args[3]
+        self.assertEqual(list(full_text_ids.values()), [{"b"}])
+
+
+if __name__ == "__main__":
+    unittest.main()
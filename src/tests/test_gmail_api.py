@@ -0,0 +1,159 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+from gmail_api import (TokenBucket, QuotaScheduler, configure_scheduler, execute_with_retry, execute_batch,
+                       is_retryable_error, backoff_delay, api_priority, current_priority)
+from tests.fake_gmail import FakeHttpError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_blocks_once_burst_capacity_is_used(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, capacity=10, clock=clock, sleep=clock.sleep)
+
+        bucket.acquire(5)
+        bucket.acquire(5)
+        self.assertEqual(clock.sleeps, [])
+
+        bucket.acquire(5)
+        self.assertAlmostEqual(sum(clock.sleeps), 0.5)
+
+    def test_rejects_requests_larger_than_capacity(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=10).acquire(11)
+
+
+class TestQuotaScheduler(unittest.TestCase):
+    def wait_for_depth(self, scheduler, priority):
+        deadline = time.monotonic() + 2
+        while scheduler.stats()["queue_depth"][priority] == 0:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+
+    def test_higher_priority_calls_are_served_first(self):
+        scheduler = QuotaScheduler(rate=10, capacity=1)
+        scheduler.acquire(3)  # Leaves the bucket in debt for a while
+        served = []
+
+        def call(priority):
+            scheduler.acquire(1, priority=priority)
+            served.append(priority)
+
+        threads = []
+        for priority in ("backfill", "new_mail", "interactive"):
+            threads.append(threading.Thread(target=call, args=(priority,)))
+            threads[-1].start()
+            self.wait_for_depth(scheduler, priority)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(served, ["interactive", "new_mail", "backfill"])
+        self.assertEqual(scheduler.stats()["queue_depth"], {"interactive": 0, "new_mail": 0, "backfill": 0})
+
+    def test_rate_adapts_to_rate_limited_responses(self):
+        clock = FakeClock()
+        scheduler = QuotaScheduler(rate=100, increase=10, cooldown=1.0, clock=clock)
+
+        with self.assertLogs(level="WARNING"):
+            scheduler.record_response(FakeHttpError(429))
+        scheduler.record_response(FakeHttpError(403, "rateLimitExceeded"))  # Within the cooldown
+        scheduler.record_response(FakeHttpError(500))
+        self.assertEqual(scheduler.rate, 50)
+        self.assertEqual(scheduler.throttled, 2)
+
+        clock.now += 2
+        with self.assertLogs(level="WARNING"):
+            scheduler.record_response(FakeHttpError(429))
+        self.assertEqual(scheduler.rate, 25)
+
+        for _ in range(10):
+            scheduler.record_response()
+        self.assertEqual(scheduler.rate, 100)
+
+    def test_accounts_units_per_method(self):
+        scheduler = configure_scheduler(rate=None)
+        request = MagicMock()
+        request.execute.return_value = {}
+
+        execute_with_retry(request, method="messages.list")
+        execute_batch(MagicMock(), 20, "messages.get")
+
+        stats = scheduler.stats()
+        self.assertEqual(stats["units"], {"messages.list": 5, "messages.get": 100})
+        self.assertEqual(stats["calls"], {"messages.list": 1, "messages.get": 1})
+
+    def test_priority_context_is_per_thread(self):
+        seen = []
+        with api_priority("backfill"):
+            with api_priority("new_mail"):
+                self.assertEqual(current_priority(), "new_mail")
+            worker = threading.Thread(target=lambda: seen.append(current_priority()))
+            worker.start()
+            worker.join()
+            self.assertEqual(current_priority(), "backfill")
+        self.assertEqual(seen, ["interactive"])
+        with self.assertRaises(ValueError):
+            with api_priority("urgent"):
+                pass
+
+
+class TestExecuteWithRetry(unittest.TestCase):
+    def test_retries_rate_limit_and_server_errors(self):
+        request = MagicMock()
+        request.execute.side_effect = [FakeHttpError(429), FakeHttpError(503), {"id": "1"}]
+        sleeps = []
+
+        with self.assertLogs(level="WARNING"):
+            response = execute_with_retry(request, method="messages.get", sleep=sleeps.append)
+
+        self.assertEqual(response, {"id": "1"})
+        self.assertEqual(len(sleeps), 2)
+
+    def test_does_not_retry_client_errors(self):
+        request = MagicMock()
+        request.execute.side_effect = FakeHttpError(404)
+
+        with self.assertRaises(FakeHttpError):
+            execute_with_retry(request, sleep=lambda seconds: None)
+        self.assertEqual(request.execute.call_count, 1)
+
+    def test_gives_up_after_max_retries(self):
+        request = MagicMock()
+        request.execute.side_effect = FakeHttpError(500)
+
+        with self.assertLogs(level="WARNING"), self.assertRaises(FakeHttpError):
+            execute_with_retry(request, max_retries=2, sleep=lambda seconds: None)
+        self.assertEqual(request.execute.call_count, 3)
+
+    def test_charges_quota_units_per_method(self):
+        request = MagicMock()
+        request.execute.return_value = {}
+        bucket = MagicMock()
+
+        execute_with_retry(request, method="messages.batchModify", rate_limiter=bucket)
+
+        bucket.acquire.assert_called_once_with(50)
+
+    def test_retryable_error_classification(self):
+        self.assertTrue(is_retryable_error(FakeHttpError(403, "userRateLimitExceeded")))
+        self.assertFalse(is_retryable_error(FakeHttpError(403, "insufficientPermissions")))
+        self.assertFalse(is_retryable_error(ValueError("boom")))
+        self.assertLessEqual(backoff_delay(10, base_delay=1, max_delay=4), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from google.oauth2.credentials import Credentials
+from gmail_client import GmailClient, get_gmail_client
+
+NOW = datetime(2025, 1, 1, 12, 0, 0)
+
+
+def make_credentials(expires_in):
+    creds = Credentials(token="access", refresh_token="refresh", client_id="id", client_secret="secret",
+                        token_uri="https://oauth2.googleapis.com/token", expiry=NOW + expires_in)
+    creds.refresh_calls = 0
+
+    def refresh(request):
+        creds.refresh_calls += 1
+        creds.expiry = NOW + timedelta(hours=1)
+
+    creds.refresh = refresh
+    return creds
+
+
+class TestGmailClient(unittest.TestCase):
+    def client(self, creds):
+        self.authenticate = patch("gmail_client.authenticate_gmail", return_value=creds).start()
+        self.save_token = patch("gmail_client.save_token").start()
+        self.addCleanup(patch.stopall)
+        return GmailClient("token.json", clock=lambda: NOW)
+
+    def test_token_is_read_once_and_service_built_once(self):
+        client = self.client(make_credentials(timedelta(hours=1)))
+
+        first = client.service()
+        second = client.service()
+
+        self.assertIs(first, second)
+        self.assertEqual(self.authenticate.call_count, 1)
+        self.save_token.assert_not_called()
+        self.assertTrue(hasattr(first.users().messages(), "batchModify"))
+
+    def test_tokens_close_to_expiry_are_refreshed_once_across_threads(self):
+        creds = make_credentials(timedelta(minutes=2))
+        client = self.client(creds)
+
+        threads = [threading.Thread(target=client.credentials) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(creds.refresh_calls, 1)
+        self.assertEqual(client.refreshes, 1)
+        self.save_token.assert_called_once_with(creds, "token.json")
+
+    def test_each_thread_gets_its_own_http_object(self):
+        client = self.client(make_credentials(timedelta(hours=1)))
+        seen = []
+
+        thread = threading.Thread(target=lambda: seen.append(client.http()))
+        thread.start()
+        thread.join()
+
+        self.assertIs(client.http(), client.http())
+        self.assertIsNot(client.http(), seen[0])
+
+    def test_clients_are_shared_per_token_file(self):
+        self.assertIs(get_gmail_client("a.json"), get_gmail_client("./a.json"))
+        self.assertIsNot(get_gmail_client("a.json"), get_gmail_client("b.json"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,11 +5,10 @@ from db_utils import get_or_initialize_db, Email
 
 
 class TestFetchEmails(unittest.TestCase):
-    @patch("gmail_mail_fetch.authenticate_gmail")
-    @patch("gmail_mail_fetch.build")
+    @patch("gmail_mail_fetch.get_gmail_service")
     @patch("gmail_mail_fetch.input", return_value="2")
     @patch.object(Email, "insert_many")
-    def test_fetch_emails_and_store(self, mock_insert_many, mock_input, mock_build, mock_auth):
+    def test_fetch_emails_and_store(self, mock_insert_many, mock_input, mock_get_service):
 
         db = get_or_initialize_db(testing=True)
 
@@ -17,12 +16,9 @@ class TestFetchEmails(unittest.TestCase):
             db.connect(reuse_if_open=True)
         db.create_tables([Email], safe=True)
 
-        mock_creds = MagicMock()
-        mock_auth.return_value = mock_creds
-
         # Mock Gmail API service
         mock_service = MagicMock()
-        mock_build.return_value = mock_service
+        mock_get_service.return_value = mock_service
         mock_service.users().messages().list().execute.return_value = {
             "messages": [
                 {"id": "12345"},
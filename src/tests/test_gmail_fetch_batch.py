@@ -0,0 +1,76 @@
+import unittest
+from unittest.mock import patch
+from gmail_mail_fetch import fetch_emails_and_store, fetch_messages_batched, iter_parsed_messages, MESSAGE_FIELDS
+from db_utils import get_or_initialize_db, Email
+from tests.fake_gmail import FakeGmailService, make_message
+
+
+class TestFetchEmailsBatched(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+
+        self.service = FakeGmailService(
+            make_message(f"id{i}", subject=f"Subject {i}", body=f"Body {i}") for i in range(7))
+
+    def tearDown(self):
+        Email.delete().execute()
+        self.db.close()
+
+    def test_batches_group_get_calls_into_single_round_trips(self):
+        fetched = fetch_messages_batched(
+            self.service, [f"id{i}" for i in range(7)], batch_size=3)
+
+        self.assertEqual([msg["id"] for msg in fetched], [f"id{i}" for i in range(7)])
+        self.assertEqual(self.service.round_trips, 3)
+        self.assertEqual(self.service.batch_sizes, [3, 3, 1])
+
+    def test_failed_items_are_logged_and_skipped(self):
+        self.service.failing_ids.add("id2")
+
+        with self.assertLogs(level="ERROR") as logs:
+            fetched = fetch_messages_batched(
+                self.service, ["id1", "id2", "id3"], batch_size=10)
+
+        self.assertEqual([msg["id"] for msg in fetched], ["id1", "id3"])
+        self.assertIn("id2", logs.output[0])
+
+    def test_messages_deeper_than_the_partial_response_are_fetched_whole(self):
+        nested = make_message("nested", body="Forwarded text")
+        for _ in range(5):  # e.g. a signed message forwarded a few times
+            nested["payload"] = {"mimeType": "multipart/mixed", "headers": nested["payload"].pop("headers"),
+                                 "parts": [{**nested["payload"], "headers": []}]}
+        self.service.add_message(nested)
+
+        rows = list(iter_parsed_messages(self.service, ["id1", "nested"], partial=True))
+
+        self.assertEqual([row["body"] for row in rows], ["Body 1", "Forwarded text"])
+        self.assertEqual(self.service.batch_sizes, [2, 1])
+
+    def test_invalid_batch_size_is_rejected(self):
+        with self.assertRaises(ValueError):
+            fetch_messages_batched(self.service, ["id1"], batch_size=101)
+
+    @patch("gmail_mail_fetch.get_gmail_service")
+    @patch("gmail_mail_fetch.input", return_value="7")
+    def test_fetch_emails_and_store_batched_partial(self, mock_input, mock_get_service):
+        mock_get_service.return_value = self.service
+
+        fetch_emails_and_store(testing=True, batch_size=5, partial=True)
+
+        # One list call plus two batch requests instead of 1 + 7 round trips.
+        self.assertEqual(self.service.round_trips, 3)
+        get_calls = [kwargs for name, kwargs in self.service.calls if name == "messages.get"]
+        self.assertTrue(all(kwargs["fields"] == MESSAGE_FIELDS for kwargs in get_calls))
+
+        stored = Email.get(Email.id == "id4")
+        self.assertEqual(stored.sender, "sender@example.com")
+        self.assertEqual(stored.subject, "Subject 4")
+        self.assertEqual(stored.body, "Body 4")
+        self.assertEqual(Email.select().count(), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
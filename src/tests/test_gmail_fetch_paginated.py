@@ -0,0 +1,62 @@
+import unittest
+from unittest.mock import patch
+from gmail_mail_fetch import sync_all_emails, fetch_all_emails_and_store, PAGE_TOKEN_KEY
+from db_utils import get_or_initialize_db, get_sync_state, Email
+from tests.fake_gmail import FakeGmailService, FakeHttpError, make_message
+
+
+class TestPaginatedSync(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        self.service = FakeGmailService(make_message(f"id{i:03}") for i in range(250))
+
+    def tearDown(self):
+        Email.delete().execute()
+        self.db.close()
+
+    def test_follows_next_page_token_past_single_page(self):
+        stats = sync_all_emails(self.service, self.db, page_size=100, batch_size=50, chunk_size=40)
+
+        self.assertEqual(stats["inserted"], 250)
+        self.assertEqual(Email.select().count(), 250)
+        self.assertEqual(self.service.count("messages.list"), 3)
+        self.assertIsNone(get_sync_state(PAGE_TOKEN_KEY))
+
+    def test_resumes_from_checkpointed_page_after_crash(self):
+        self.service.failing_page_tokens.add("200")
+
+        # The failing page is retried with backoff before the sync gives up
+        with patch("gmail_api.backoff_delay", return_value=0), self.assertLogs(level="WARNING"), \
+                self.assertRaises(FakeHttpError):
+            sync_all_emails(self.service, self.db, page_size=100)
+
+        self.assertEqual([kwargs.get("pageToken") for name, kwargs in self.service.calls
+                          if name == "messages.list"].count("200"), 6)
+        self.assertEqual(Email.select().count(), 200)
+        self.assertEqual(get_sync_state(PAGE_TOKEN_KEY), "200")
+
+        self.service.failing_page_tokens.clear()
+        self.service.calls.clear()
+        stats = sync_all_emails(self.service, self.db, page_size=100)
+
+        self.assertEqual(stats["inserted"], 50)
+        self.assertEqual(Email.select().count(), 250)
+        list_calls = [kwargs for name, kwargs in self.service.calls if name == "messages.list"]
+        self.assertEqual([kwargs.get("pageToken") for kwargs in list_calls], ["200"])
+        self.assertIsNone(get_sync_state(PAGE_TOKEN_KEY))
+
+    @patch("gmail_mail_fetch.get_gmail_service")
+    def test_fetch_all_emails_and_store(self, mock_get_service):
+        mock_get_service.return_value = self.service
+
+        fetch_all_emails_and_store(testing=True, page_size=100)
+
+        self.db.connect(reuse_if_open=True)
+        self.assertEqual(Email.select().count(), 250)
+
+
+if __name__ == "__main__":
+    unittest.main()
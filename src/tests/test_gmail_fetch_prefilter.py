@@ -0,0 +1,53 @@
+import unittest
+from unittest.mock import patch
+from gmail_mail_fetch import fetch_emails_and_store, sync_all_emails
+from db_utils import get_or_initialize_db, filter_new_email_ids, Email
+from tests.fake_gmail import FakeGmailService, make_message
+
+
+class TestFetchPrefilter(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        self.service = FakeGmailService(make_message(f"id{i}") for i in range(10))
+
+    def tearDown(self):
+        Email.delete().execute()
+        self.db.close()
+
+    def test_filter_new_email_ids_keeps_order_and_drops_stored(self):
+        Email.create(id="id2", sender="a@example.com", subject="", body="",
+                     received_at="2025-01-01 00:00:00")
+
+        self.assertEqual(filter_new_email_ids(["id3", "id2", "id1"]), ["id3", "id1"])
+        self.assertEqual(filter_new_email_ids([]), [])
+
+    @patch("gmail_mail_fetch.get_gmail_service")
+    @patch("gmail_mail_fetch.input", return_value="20")
+    def test_repeated_run_makes_no_get_calls(self, mock_input, mock_get_service):
+        mock_get_service.return_value = self.service
+
+        first = fetch_emails_and_store(testing=True)
+        self.service.calls.clear()
+        self.db.connect(reuse_if_open=True)
+        self.service.messages["id10"] = make_message("id10")
+        second = fetch_emails_and_store(testing=True, batch_size=50)
+
+        self.assertEqual(first, {"listed": 10, "skipped": 0, "fetched": 10, "inserted": 10})
+        self.assertEqual(second, {"listed": 11, "skipped": 10, "fetched": 1, "inserted": 1})
+        self.assertEqual(self.service.count("messages.get"), 1)
+
+    def test_paginated_sync_skips_stored_pages(self):
+        sync_all_emails(self.service, self.db, page_size=4)
+        self.service.calls.clear()
+
+        stats = sync_all_emails(self.service, self.db, page_size=4)
+
+        self.assertEqual(stats, {"listed": 10, "skipped": 10, "fetched": 0, "inserted": 0})
+        self.assertEqual(self.service.count("messages.get"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
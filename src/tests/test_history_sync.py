@@ -0,0 +1,146 @@
+import unittest
+from unittest.mock import patch
+from history_sync import sync_mailbox, sync_emails, HISTORY_ID_KEY, FAILED_IDS_KEY, MAX_FETCH_ATTEMPTS
+from db_utils import get_or_initialize_db, get_sync_state, set_sync_state, Email
+from tests.fake_gmail import FakeGmailService, make_message
+
+
+class TestHistorySync(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        set_sync_state(HISTORY_ID_KEY, None)
+        set_sync_state(FAILED_IDS_KEY, None)
+        self.service = FakeGmailService(make_message(f"id{i}") for i in range(20))
+
+    def tearDown(self):
+        Email.delete().execute()
+        set_sync_state(HISTORY_ID_KEY, None)
+        set_sync_state(FAILED_IDS_KEY, None)
+        self.db.close()
+
+    def test_first_run_does_full_resync_and_stores_history_id(self):
+        summary = sync_mailbox(self.service, self.db)
+
+        self.assertTrue(summary["full_resync"])
+        self.assertEqual(Email.select().count(), 20)
+        self.assertEqual(get_sync_state(HISTORY_ID_KEY), str(self.service.history_id))
+
+    def test_steady_state_run_only_fetches_the_delta(self):
+        sync_mailbox(self.service, self.db)
+        self.service.calls.clear()
+
+        self.service.add_message(make_message("new1", subject="Fresh"))
+        self.service.delete_message("id3")
+        self.service.relabel_message("id5", add=["STARRED"], remove=["UNREAD"])
+
+        summary = sync_mailbox(self.service, self.db)
+
+        self.assertFalse(summary["full_resync"])
+        self.assertEqual((summary["added"], summary["deleted"], summary["relabeled"]), (1, 1, 1))
+        self.assertEqual(self.service.count("messages.list"), 0)
+        self.assertEqual(self.service.count("messages.get"), 1)
+        self.assertEqual(Email.get(Email.id == "new1").subject, "Fresh")
+        self.assertIsNone(Email.get_or_none(Email.id == "id3"))
+        self.assertEqual(Email.get(Email.id == "id5").label_ids, ["INBOX", "STARRED"])
+        self.assertEqual(get_sync_state(HISTORY_ID_KEY), str(self.service.history_id))
+
+    def test_message_added_then_deleted_is_never_fetched(self):
+        sync_mailbox(self.service, self.db)
+        self.service.calls.clear()
+
+        self.service.add_message(make_message("short-lived"))
+        self.service.delete_message("short-lived")
+        sync_mailbox(self.service, self.db)
+
+        self.assertEqual(self.service.count("messages.get"), 0)
+        self.assertIsNone(Email.get_or_none(Email.id == "short-lived"))
+
+    def test_expired_history_id_falls_back_to_full_resync(self):
+        sync_mailbox(self.service, self.db)
+        self.service.add_message(make_message("new1"))
+        self.service.oldest_history_id = self.service.history_id + 1
+
+        with self.assertLogs(level="WARNING"):
+            summary = sync_mailbox(self.service, self.db)
+
+        self.assertTrue(summary["full_resync"])
+        self.assertEqual(Email.select().count(), 21)
+
+    def test_full_resync_applies_deletions_and_label_changes_of_the_gap(self):
+        sync_mailbox(self.service, self.db)
+        self.service.add_message(make_message("new1"))
+        self.service.delete_message("id3")
+        self.service.relabel_message("id5", add=["STARRED"], remove=["UNREAD"])
+        self.service.oldest_history_id = self.service.history_id + 1
+        self.service.calls.clear()
+
+        with self.assertLogs(level="WARNING"):
+            summary = sync_mailbox(self.service, self.db)
+
+        self.assertEqual((summary["added"], summary["deleted"], summary["relabeled"]), (1, 1, 1))
+        self.assertIsNone(Email.get_or_none(Email.id == "id3"))
+        self.assertEqual(Email.get(Email.id == "id5").label_ids, ["INBOX", "STARRED"])
+        self.assertEqual(self.service.count("messages.get"), 20)  # 19 label refreshes and the new message
+
+    def test_failed_downloads_hold_back_the_history_id(self):
+        sync_mailbox(self.service, self.db)
+        start_history_id = get_sync_state(HISTORY_ID_KEY)
+        self.service.add_message(make_message("new1"))
+        self.service.add_message(make_message("new2"))
+        self.service.failing_ids.add("new2")
+
+        with self.assertLogs(level="WARNING"):
+            summary = sync_mailbox(self.service, self.db)
+
+        self.assertEqual((summary["added"], summary["added_ids"], summary["failed"]), (1, ["new1"], 1))
+        self.assertEqual(get_sync_state(HISTORY_ID_KEY), start_history_id)
+
+        self.service.failing_ids.clear()
+        summary = sync_mailbox(self.service, self.db)
+
+        self.assertEqual((summary["added_ids"], summary["failed"]), (["new2"], 0))
+        self.assertEqual(get_sync_state(HISTORY_ID_KEY), str(self.service.history_id))
+        self.assertIsNone(get_sync_state(FAILED_IDS_KEY))
+
+    def test_messages_lost_by_a_full_resync_are_fetched_by_the_next_sync(self):
+        self.service.failing_ids.add("id4")
+
+        with self.assertLogs(level="WARNING"):
+            summary = sync_mailbox(self.service, self.db)
+
+        self.assertEqual((summary["added"], summary["failed"]), (19, 1))
+        self.assertEqual(get_sync_state(HISTORY_ID_KEY), str(self.service.history_id))
+
+        self.service.failing_ids.clear()
+        summary = sync_mailbox(self.service, self.db)
+
+        self.assertEqual(summary["added_ids"], ["id4"])
+        self.assertEqual(Email.select().count(), 20)
+
+    def test_messages_that_keep_failing_are_given_up_on(self):
+        sync_mailbox(self.service, self.db)
+        self.service.add_message(make_message("broken"))
+        self.service.failing_ids.add("broken")
+
+        with self.assertLogs(level="WARNING"):
+            for _ in range(MAX_FETCH_ATTEMPTS):
+                summary = sync_mailbox(self.service, self.db)
+
+        self.assertEqual(summary["failed"], 0)
+        self.assertEqual(get_sync_state(HISTORY_ID_KEY), str(self.service.history_id))
+        self.assertIsNone(get_sync_state(FAILED_IDS_KEY))
+
+    @patch("history_sync.get_gmail_service")
+    def test_sync_emails(self, mock_get_service):
+        mock_get_service.return_value = self.service
+
+        summary = sync_emails(testing=True)
+
+        self.assertEqual(summary["added"], 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
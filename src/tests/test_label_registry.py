@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from label_registry import LabelRegistry
+from process_mail import process_emails_based_on_rules
+from db_utils import get_or_initialize_db, Email
+from tests.fake_gmail import FakeGmailService, make_message, FakeGmailClient
+
+
+class TestLabelRegistry(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeGmailService()
+        self.service.labels["Work"] = "Label_1"
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.cache_dir.name, "labels.json")
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_lists_labels_once_and_matches_case_insensitively(self):
+        registry = LabelRegistry(self.service)
+
+        self.assertEqual(registry.get_id("work"), "Label_1")
+        self.assertEqual(registry.get_id("WORK"), "Label_1")
+        self.assertEqual(registry.get_id("inbox"), "INBOX")
+        self.assertEqual(self.service.count("labels.list"), 1)
+
+    def test_missing_label_refreshes_once_then_skips(self):
+        registry = LabelRegistry(self.service, cache_path=self.cache_path)
+        LabelRegistry(self.service, cache_path=self.cache_path).get_id("work")
+        self.service.calls.clear()
+
+        self.service.labels["Later"] = "Label_2"
+        self.assertEqual(registry.get_id("later"), "Label_2")
+        self.assertIsNone(registry.get_id("nope"))
+        self.assertIsNone(registry.get_id("nope"))
+        self.assertEqual(self.service.count("labels.list"), 1)
+
+    def test_persisted_labels_respect_ttl(self):
+        now = [1000.0]
+        LabelRegistry(self.service, cache_path=self.cache_path, ttl=60, clock=lambda: now[0]).get_id("work")
+        self.service.calls.clear()
+
+        LabelRegistry(self.service, cache_path=self.cache_path, ttl=60, clock=lambda: now[0]).get_id("work")
+        self.assertEqual(self.service.count("labels.list"), 0)
+
+        now[0] += 61
+        LabelRegistry(self.service, cache_path=self.cache_path, ttl=60, clock=lambda: now[0]).get_id("work")
+        self.assertEqual(self.service.count("labels.list"), 1)
+
+    def test_invalidate_drops_persisted_labels(self):
+        registry = LabelRegistry(self.service, cache_path=self.cache_path)
+        registry.get_id("work")
+        with open(self.cache_path) as cache_file:
+            self.assertEqual(json.load(cache_file)["labels"]["work"], "Label_1")
+
+        registry.invalidate()
+
+        self.assertFalse(os.path.exists(self.cache_path))
+        self.assertIsNone(registry.labels)
+
+    def test_auto_create_missing_label(self):
+        registry = LabelRegistry(self.service, auto_create=True)
+
+        label_id = registry.get_id("Receipts")
+
+        self.assertEqual(self.service.labels["Receipts"], label_id)
+        self.assertEqual(registry.get_id("receipts"), label_id)
+        self.assertEqual(self.service.count("labels.create"), 1)
+
+
+class TestProcessEmailsLabelLookup(unittest.TestCase):
+    @patch("process_mail.get_gmail_client")
+    def test_labels_are_listed_once_per_run(self, mock_get_client):
+        db = get_or_initialize_db(testing=True)
+        if db.is_closed():
+            db.connect(reuse_if_open=True)
+        Email.delete().execute()
+
+        service = FakeGmailService(make_message(f"id{i}") for i in range(5))
+        service.labels["Important"] = "Label_9"
+        mock_get_client.return_value = FakeGmailClient(service)
+        for i in range(5):
+            Email.create(id=f"id{i}", sender="bot@github.com", subject="Build", body="",
+                         received_at="2025-01-01 00:00:00")
+
+        rules = {"rules": [{"predicate": "All",
+                            "conditions": [{"field": "sender", "predicate": "contains", "value": "github.com"}],
+                            "actions": ["move_to_important", "move_to_Missing"]}]}
+        with patch("builtins.open", unittest.mock.mock_open(read_data=json.dumps(rules))):
+            with self.assertLogs(level="WARNING"):
+                process_emails_based_on_rules("rules.json", testing=True)
+
+        self.assertEqual(service.count("labels.list"), 1)
+        self.assertEqual(service.count("messages.batchModify"), 1)
+        self.assertIn("Label_9", service.messages["id3"]["labelIds"])
+
+        db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
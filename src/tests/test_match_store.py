@@ -0,0 +1,152 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from match_store import (
+    activate_rules, precomputed_matches, refresh_pending_matches, purge_expired_matches, uses_full_text
+)
+from rule_compiler import compile_rules
+from rule_engine import evaluate_rules
+from gmail_mail_fetch import sync_all_emails
+from db_utils import get_or_initialize_db, insert_emails, ActiveRule, RuleMatch, PendingRuleMatch, Email
+from tests.fake_gmail import FakeGmailService, make_message
+
+RULES = {"rules": [
+    {"predicate": "All", "actions": ["mark_as_read"], "conditions": [
+        {"field": "sender", "predicate": "contains", "value": "github"},
+        {"field": "received_at", "predicate": "less_than", "value": "7", "unit": "days"}]},
+    {"predicate": "Any", "actions": ["flag_message"], "conditions": [
+        {"field": "subject", "predicate": "contains", "value": "invoice"},
+        {"field": "received_at", "predicate": "greater_than", "value": "1", "unit": "months"}]},
+    {"predicate": "All", "actions": ["move_to_Old"], "conditions": [
+        {"field": "received_at", "predicate": "greater_than", "value": "3", "unit": "days"},
+        {"field": "received_at", "predicate": "less_than", "value": "20", "unit": "days"}]},
+    {"predicate": "Any", "actions": ["mark_as_unread"], "conditions": [
+        {"field": "received_at", "predicate": "less_than", "value": "2", "unit": "days"},
+        {"field": "received_at", "predicate": "greater_than", "value": "50", "unit": "days"}]},
+    {"predicate": "All", "actions": ["mark_as_unread"], "conditions": [
+        {"field": "body", "predicate": "not_contains", "value": "pay"}]},
+]}
+
+
+class TestMatchStore(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        ActiveRule.delete().execute()
+        RuleMatch.delete().execute()
+        self.now = datetime(2025, 3, 1, 12, 0, 0)
+        self.rng = random.Random(5)
+        self.program = compile_rules(RULES)
+        self.insert(f"id{i:03}" for i in range(200))
+
+    def tearDown(self):
+        Email.delete().execute()
+        ActiveRule.delete().execute()
+        self.db.close()
+
+    def insert(self, email_ids):
+        insert_emails([{
+            "id": email_id, "sender": self.rng.choice(["ci@github.com", "friend@mail.com"]),
+            "subject": self.rng.choice(["Invoice 7", "hello"]), "body": self.rng.choice(["pay now", "hi"]),
+            "received_at": self.now - timedelta(hours=self.rng.randint(0, 24 * 90)),
+        } for email_id in email_ids])
+
+    def assert_same_as_a_rescan(self, now):
+        self.assertEqual(precomputed_matches(self.program, now), evaluate_rules(self.program, now=now))
+
+    def test_matches_follow_the_clock_without_rescanning(self):
+        activate_rules(self.program)
+        stored = RuleMatch.select().count()
+
+        for days in (0, 1, 3, 10, 19, 31, 45, 60):
+            self.assert_same_as_a_rescan(self.now + timedelta(days=days, minutes=7))
+        self.assertEqual(RuleMatch.select().count(), stored)
+
+        self.assertGreater(purge_expired_matches(self.now + timedelta(days=60)), 0)
+        self.assert_same_as_a_rescan(self.now + timedelta(days=61))
+
+    def test_only_new_and_changed_emails_are_evaluated(self):
+        activate_rules(self.program)
+
+        self.insert(["new1", "new2"])
+        Email.update(subject="Invoice 9").where(Email.id == "id001").execute()
+        Email.delete().where(Email.id == "id002").execute()
+
+        self.assertEqual(sorted(email_id for (email_id,) in PendingRuleMatch.select().tuples()),
+                         ["id001", "new1", "new2"])
+        self.assertEqual(refresh_pending_matches(), 3)
+        self.assertEqual(PendingRuleMatch.select().count(), 0)
+        self.assertEqual(RuleMatch.select().where(RuleMatch.email_id == "id002").count(), 0)
+        self.assert_same_as_a_rescan(self.now)
+
+    def test_changed_rules_are_replaced(self):
+        activate_rules(self.program)
+        edited = compile_rules({"rules": RULES["rules"][:1] + [
+            {"predicate": "All", "actions": ["flag_message"],
+             "conditions": [{"field": "sender", "predicate": "equals", "value": "friend@mail.com"}]}]})
+
+        added = activate_rules(edited)
+
+        self.assertEqual(added, [edited.rules[1].rule_hash])
+        self.assertEqual({rule_hash for (rule_hash,) in RuleMatch.select(RuleMatch.rule_hash).distinct().tuples()},
+                         {rule.rule_hash for rule in edited.rules})
+        self.program = edited
+        self.assert_same_as_a_rescan(self.now)
+
+    def test_any_rule_with_overlapping_date_windows(self):
+        self.program = compile_rules({"rules": [
+            {"predicate": "Any", "actions": ["mark_as_read"], "conditions": [
+                {"field": "received_at", "predicate": "less_than", "value": "2", "unit": "days"},
+                {"field": "received_at", "predicate": "less_than", "value": "5", "unit": "days"},
+                {"field": "received_at", "predicate": "greater_than", "value": "30", "unit": "days"},
+                {"field": "received_at", "predicate": "greater_than", "value": "60", "unit": "days"}]}]})
+
+        activate_rules(self.program)
+
+        self.assertEqual(RuleMatch.select().count(), 400)
+        for days in (0, 3, 6, 40, 70):
+            self.assert_same_as_a_rescan(self.now + timedelta(days=days))
+
+    def test_full_text_rules_are_evaluated_live(self):
+        self.program = compile_rules({"rules": RULES["rules"][:1] + [
+            {"predicate": "All", "actions": ["flag_message"],
+             "conditions": [{"field": "subject", "predicate": "matches", "value": "invoice"}]}]})
+
+        live = []
+
+        def evaluate(program, **kwargs):
+            if any(uses_full_text(rule) for rule in program.rules):
+                live.append([rule.index for rule in program.rules])
+                return {1: {"id001"}}  # The test database has no FTS5 index
+            return evaluate_rules(program, **kwargs)
+
+        with patch("match_store.evaluate_rules", side_effect=evaluate):
+            matches = precomputed_matches(self.program, self.now)
+
+        self.assertEqual(matches[1], {"id001"})
+        self.assertEqual(live, [[1]])
+        self.assertEqual({rule_hash for (rule_hash,) in ActiveRule.select(ActiveRule.rule_hash).tuples()},
+                         {self.program.rules[0].rule_hash})
+        # Without the FTS5 index, storing new emails still works
+        self.insert(["new1"])
+        self.assertEqual(refresh_pending_matches(), 1)
+
+    def test_fetched_emails_are_matched_on_insert(self):
+        activate_rules(self.program)
+        service = FakeGmailService(make_message(f"gh{i}", sender="CI <ci@github.com>",
+                                                internal_date=str(int(self.now.timestamp() * 1000)))
+                                   for i in range(5))
+
+        sync_all_emails(service, self.db)
+
+        self.assertEqual(PendingRuleMatch.select().count(), 0)
+        matched = {email_id for (email_id,) in RuleMatch.select(RuleMatch.email_id)
+                   .where(RuleMatch.rule_hash == self.program.rules[0].rule_hash).tuples()}
+        self.assertTrue({f"gh{i}" for i in range(5)} <= matched)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import itertools
+import tempfile
+import unittest
+from datetime import datetime
+from db_utils import get_or_initialize_db, emails_missing_bodies, insert_emails, Email
+from gmail_mail_fetch import sync_all_emails, load_missing_bodies, fetch_raw_messages
+from label_registry import LabelRegistry
+from message_cache import MessageCache
+from process_mail import apply_rules
+from rule_compiler import compile_rules
+from tests.fake_gmail import FakeGmailService, make_message
+
+
+class TestMessageCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.ticks = itertools.count()
+        self.cache = MessageCache(self.directory.name, max_bytes=250, clock=lambda: next(self.ticks))
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def test_identical_contents_are_stored_once(self):
+        first = self.cache.put("a", b"x" * 100)
+        second = self.cache.put("b", b"x" * 100)
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.cache.total_bytes, 100)
+        self.assertEqual(self.cache.get_many(["a", "b", "c"]), {"a": b"x" * 100, "b": b"x" * 100})
+
+    def test_least_recently_used_contents_are_evicted(self):
+        self.cache.put("a", b"a" * 100)
+        self.cache.put("b", b"b" * 100)
+        self.cache.get("a")
+
+        self.cache.put("c", b"c" * 100)
+
+        self.assertNotIn("b", self.cache)
+        self.assertEqual(set(self.cache.message_ids()), {"a", "c"})
+        self.assertLessEqual(self.cache.total_bytes, 250)
+
+    def test_index_survives_reopening(self):
+        self.cache.put("a", b"hello")
+        self.cache.close()
+
+        self.cache = MessageCache(self.directory.name)
+
+        self.assertEqual(self.cache.get("a"), b"hello")
+        self.assertEqual(self.cache.total_bytes, 5)
+
+
+class TestMetadataIngestion(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = MessageCache(self.directory.name)
+        self.service = FakeGmailService(
+            make_message(f"id{i}", sender="ci@github.com", body=f"build {i} failed") for i in range(6))
+
+    def tearDown(self):
+        Email.delete().execute()
+        self.cache.close()
+        self.directory.cleanup()
+        self.db.close()
+
+    def test_metadata_sync_stores_headers_without_bodies(self):
+        sync_all_emails(self.service, self.db, resume=False, message_format="metadata")
+
+        self.assertEqual(Email.select().count(), 6)
+        self.assertEqual(Email.get_by_id("id0").sender, "ci@github.com")
+        self.assertEqual(len(emails_missing_bodies()), 6)
+        formats = {kwargs.get("format") for method, kwargs in self.service.calls if method == "messages.get"}
+        self.assertEqual(formats, {"metadata"})
+
+    def test_bodies_are_loaded_once_and_then_served_from_the_cache(self):
+        sync_all_emails(self.service, self.db, resume=False, message_format="metadata")
+
+        self.assertEqual(load_missing_bodies(self.service, ["id0", "id1"], cache=self.cache), 2)
+        self.assertEqual(Email.get_by_id("id1").body, "build 1 failed")
+        self.assertEqual(sorted(emails_missing_bodies()), ["id2", "id3", "id4", "id5"])
+        self.assertEqual(load_missing_bodies(self.service, ["id0", "id1"], cache=self.cache), 0)
+
+        self.service.calls.clear()
+        self.assertEqual(set(fetch_raw_messages(self.service, ["id0", "id1"], cache=self.cache)), {"id0", "id1"})
+        self.assertEqual(self.service.calls, [])
+
+        Email.update(subject="changed").execute()
+        self.assertEqual(load_missing_bodies(None, cache=self.cache, refresh=True), 2)
+
+        # Without a service, messages missing from the cache are skipped
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(load_missing_bodies(None, ["id0", "id2"], cache=self.cache, refresh=True), 1)
+
+    def test_body_rules_load_missing_bodies_first(self):
+        sync_all_emails(self.service, self.db, resume=False, message_format="metadata")
+        program = compile_rules({"rules": [{"predicate": "All", "actions": ["mark_as_read"], "conditions": [
+            {"field": "body", "predicate": "contains", "value": "build 3"}]}]})
+
+        report = apply_rules(self.service, program, LabelRegistry(self.service), cache=self.cache, dry_run=True)
+
+        self.assertEqual(report.plan[0]["ids"], ["id3"])
+        self.assertEqual(emails_missing_bodies(), [])
+        self.assertEqual(len(self.cache), 6)
+
+    def test_rules_without_body_conditions_download_nothing(self):
+        insert_emails([{"id": "id0", "sender": "ci@github.com", "subject": "Build",
+                        "received_at": datetime(2025, 1, 1)}])
+        program = compile_rules({"rules": [{"predicate": "All", "actions": ["mark_as_read"], "conditions": [
+            {"field": "sender", "predicate": "contains", "value": "github"}]}]})
+
+        apply_rules(self.service, program, LabelRegistry(self.service), cache=self.cache, dry_run=True)
+
+        self.assertEqual(self.service.count("messages.get"), 0)
+        self.assertEqual(emails_missing_bodies(), ["id0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import pstats
+import tempfile
+import unittest
+from metrics import METRICS, Metrics, profiled
+from gmail_mail_fetch import sync_all_emails
+from rule_compiler import compile_rules
+from rule_engine import evaluate_rules
+from db_utils import get_or_initialize_db, ActiveRule, Email
+from tests.fake_gmail import FakeGmailService, make_message
+
+
+def samples(snapshot, kind, name):
+    return {tuple(sorted(sample["labels"].items())): sample for sample in snapshot[kind].get(name, [])}
+
+
+class TestMetrics(unittest.TestCase):
+    def test_prometheus_text_format(self):
+        ticks = iter([1.0, 1.5, 2.0, 2.25])
+        metrics = Metrics(clock=lambda: next(ticks))
+        metrics.increment("api_calls", method="messages.get")
+        metrics.increment("api_calls", 4, method="messages.get")
+        metrics.increment("api_calls", method='odd "name"')
+        metrics.set("memory_peak_bytes", 2048)
+        with metrics.timer("stage_seconds", stage="get"):
+            pass
+        with metrics.timer("stage_seconds", stage="get"):
+            pass
+
+        self.assertEqual(metrics.to_prometheus(prefix="p_").splitlines(), [
+            "# TYPE p_api_calls_total counter",
+            'p_api_calls_total{method="messages.get"} 5',
+            'p_api_calls_total{method="odd \\"name\\""} 1',
+            "# TYPE p_memory_peak_bytes gauge",
+            "p_memory_peak_bytes 2048",
+            "# TYPE p_stage_seconds summary",
+            'p_stage_seconds_sum{stage="get"} 0.750000',
+            'p_stage_seconds_count{stage="get"} 2',
+            "# TYPE p_stage_seconds_max gauge",
+            'p_stage_seconds_max{stage="get"} 0.500000',
+        ])
+
+    def test_cpu_profile_is_dumped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "run.prof")
+            with profiled("cpu", path):
+                sorted(range(1000), key=str)
+
+            self.assertTrue(pstats.Stats(path).total_calls > 0)
+
+
+class TestRunMetrics(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        ActiveRule.delete().execute()  # No precomputed matching during the fetch
+        METRICS.reset()
+
+    def tearDown(self):
+        Email.delete().execute()
+        self.db.close()
+        METRICS.reset()
+
+    def test_fetch_and_rule_runs_are_instrumented(self):
+        service = FakeGmailService(make_message(f"id{i:03}", sender="ci@github.com" if i % 3 else "me@example.com")
+                                   for i in range(120))
+        sync_all_emails(service, self.db, page_size=100, batch_size=50, chunk_size=40)
+        program = compile_rules({"rules": [
+            {"predicate": "All", "actions": ["mark_as_read"],
+             "conditions": [{"field": "sender", "predicate": "equals", "value": "ci@github.com"}]},
+            {"predicate": "All", "actions": ["mark_as_read"],
+             "conditions": [{"field": "subject", "predicate": "contains", "value": "invoice"}]},
+        ]})
+        evaluate_rules(program)
+
+        snapshot = METRICS.snapshot()
+        stages = samples(snapshot, "timers", "stage_seconds")
+        self.assertEqual(stages[(("stage", "list"),)]["count"], 2)
+        self.assertEqual(stages[(("stage", "get"),)]["count"], 3)
+        self.assertEqual(stages[(("stage", "insert"),)]["count"], 4)
+        self.assertIn((("stage", "parse"),), stages)
+        calls = samples(snapshot, "counters", "api_calls")
+        self.assertEqual(calls[(("method", "messages.list"),)]["value"], 2)
+        self.assertEqual(calls[(("method", "messages.get"),)]["value"], 120)
+        # The first rule is evaluated on every row, the second only where "invoice" occurs
+        scanned = samples(snapshot, "counters", "rule_rows_scanned")
+        self.assertEqual(scanned[(("rule", "rules[0]"),)]["value"], 120)
+        self.assertEqual(scanned[(("rule", "rules[1]"),)]["value"], 0)
+        self.assertEqual(samples(snapshot, "counters", "rows_scanned")[()]["value"], 120)
+
+
+if __name__ == "__main__":
+    unittest.main()
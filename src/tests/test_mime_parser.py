@@ -0,0 +1,68 @@
+import base64
+import glob
+import json
+import os
+import unittest
+from mime_parser import extract_body, strip_html, truncate_utf8
+from gmail_mail_fetch import parse_message
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "mime")
+
+
+def load_fixtures():
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "*.json"))):
+        with open(path, encoding="utf-8") as fixture:
+            yield os.path.basename(path), json.load(fixture)
+
+
+def text_part(text, mime_type="text/plain", charset="utf-8"):
+    return {"mimeType": mime_type, "headers": [{"name": "Content-Type", "value": f"{mime_type}; charset={charset}"}],
+            "body": {"data": base64.urlsafe_b64encode(text.encode(charset)).decode("ascii").rstrip("=")}}
+
+
+class TestExtractBody(unittest.TestCase):
+    def test_recorded_payloads(self):
+        for name, fixture in load_fixtures():
+            with self.subTest(fixture=name, description=fixture["description"]):
+                self.assertEqual(extract_body(fixture["message"]["payload"]), fixture["expected_body"])
+
+    def test_parse_message_uses_the_whole_tree(self):
+        fixtures = dict(load_fixtures())
+
+        row = parse_message(fixtures["nested_alternative.json"]["message"])
+
+        self.assertEqual(row["body"], fixtures["nested_alternative.json"]["expected_body"])
+        self.assertEqual(row["sender"], "sender@example.com")
+
+    def test_deeply_nested_trees_do_not_recurse(self):
+        part = text_part("deep")
+        for _ in range(5000):
+            part = {"mimeType": "multipart/mixed", "parts": [part]}
+
+        self.assertEqual(extract_body(part), "deep")
+
+    def test_body_cap_never_splits_a_character(self):
+        text = "é" * 1000  # Two bytes each in UTF-8
+
+        capped = extract_body(text_part(text), max_bytes=101)
+
+        self.assertEqual(capped, "é" * 50)
+        self.assertEqual(extract_body(text_part(text, "text/html"), max_bytes=10), "é" * 5)
+        self.assertEqual(truncate_utf8("short", 100), "short")
+
+    def test_unknown_charset_and_bad_data_do_not_raise(self):
+        part = text_part("hello")
+        part["headers"][0]["value"] = "text/plain; charset=x-unknown"
+
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(extract_body(part), "hello")
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(extract_body({"mimeType": "text/plain", "body": {"data": "abcde"}}), "")
+        self.assertEqual(extract_body({"mimeType": "multipart/mixed", "parts": []}), "")
+
+    def test_strip_html(self):
+        self.assertEqual(strip_html("<style>x{}</style><p>A&amp;B</p><p>C<br/>D</p>"), "A&B\nC\nD")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from multi_account import AccountConfigError, load_accounts, process_account, run_accounts, combine_results
+from tests.fake_gmail import FakeGmailService, make_message
+
+RULES = {"rules": [{"predicate": "All", "actions": ["mark_as_read"],
+                    "conditions": [{"field": "sender", "predicate": "contains", "value": "github"}]}]}
+
+
+def fake_worker(account, **options):
+    """Runs `process_account` in the worker process against a fake mailbox named after the account."""
+    service = FakeGmailService(
+        make_message(f"{account['name']}-{i}", sender="ci@github.com" if i % 2 else "me@example.com")
+        for i in range(4 if account["name"] == "work" else 2))
+    return process_account(account, service=service, **options)
+
+
+class TestMultiAccount(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config_path = self.path("accounts.json")
+        with open(self.path("rules.json"), "w") as rules_file:
+            json.dump(RULES, rules_file)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def write_config(self, config):
+        with open(self.config_path, "w") as config_file:
+            json.dump(config, config_file)
+
+    def stored_ids(self, database):
+        with sqlite3.connect(self.path(database)) as connection:
+            return sorted(email_id for (email_id,) in connection.execute("SELECT id FROM email"))
+
+    def test_accounts_run_isolated_in_worker_processes(self):
+        self.write_config({"defaults": {"rules": "rules.json"}, "accounts": [
+            {"name": "work", "token": "work.json", "database": "work.db"},
+            {"name": "home", "token": "home.json", "database": "home.db"},
+            {"name": "broken", "token": "broken.json", "database": "broken.db", "rules": "missing.json"},
+        ]})
+
+        results = run_accounts(load_accounts(self.config_path), max_processes=2, worker=fake_worker)
+
+        self.assertEqual([result["account"] for result in results], ["work", "home", "broken"])
+        self.assertEqual(self.stored_ids("work.db"), ["work-0", "work-1", "work-2", "work-3"])
+        self.assertEqual(self.stored_ids("home.db"), ["home-0", "home-1"])
+        self.assertEqual(results[0]["report"]["rules"], {"rules[0]": {"succeeded": 2, "failed": 0, "skipped": 0}})
+        self.assertIn("FileNotFoundError", results[2]["error"])
+
+        totals = combine_results(results)
+        self.assertEqual(totals["added"], 8)  # The broken account still synced
+        self.assertEqual(totals["calls"], 2)
+        self.assertEqual(totals["failed_accounts"], ["broken"])
+
+    def test_invalid_configs_list_every_problem(self):
+        self.write_config({"accounts": [
+            {"name": "a", "token": "t.json", "database": "a.db", "rules": "rules.json", "colour": "red"},
+            {"name": "a", "token": "t.json", "database": "b.db"},
+        ]})
+
+        with self.assertRaises(AccountConfigError) as raised:
+            load_accounts(self.config_path)
+
+        self.assertEqual(raised.exception.errors, [
+            "accounts[0]: unknown key 'colour'",
+            "accounts[1]: missing 'rules'",
+            "accounts: 'name' 'a' is used by several accounts",
+            f"accounts: 'token' {self.path('t.json')!r} is used by several accounts",
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
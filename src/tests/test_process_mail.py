@@ -3,13 +3,13 @@ import unittest
 from unittest.mock import patch, MagicMock
 from process_mail import process_emails_based_on_rules
 from db_utils import get_or_initialize_db, Email
+from tests.fake_gmail import FakeGmailClient
 
 
 class TestProcessEmails(unittest.TestCase):
 
-    @patch("process_mail.authenticate_gmail")
-    @patch("process_mail.build")
-    def test_process_emails_based_on_rules(self, mock_build, mock_authenticate):
+    @patch("process_mail.get_gmail_client")
+    def test_process_emails_based_on_rules(self, mock_get_client):
         db = get_or_initialize_db(testing=True)
 
         if db.is_closed():
@@ -18,10 +18,8 @@ class TestProcessEmails(unittest.TestCase):
 
         Email.delete().where(Email.id == "123").execute()
 
-        mock_credentials = MagicMock()
-        mock_authenticate.return_value = mock_credentials
         mock_service = MagicMock()
-        mock_build.return_value = mock_service
+        mock_get_client.return_value = FakeGmailClient(mock_service)
 
         test_email, created = Email.get_or_create(
             id="123",
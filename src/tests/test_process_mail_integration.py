@@ -4,13 +4,13 @@ import json
 from datetime import datetime
 from process_mail import process_emails_based_on_rules
 from db_utils import Email, get_or_initialize_db
+from tests.fake_gmail import FakeGmailClient
 
 
 class TestProcessEmailsIntegration(unittest.TestCase):
 
-    @patch("process_mail.authenticate_gmail")
-    @patch("process_mail.build")
-    def test_process_emails_based_on_rules_integration(self, mock_build, mock_authenticate):
+    @patch("process_mail.get_gmail_client")
+    def test_process_emails_based_on_rules_integration(self, mock_get_client):
         db = get_or_initialize_db(testing=True)
 
         if db.is_closed():
@@ -18,10 +18,8 @@ class TestProcessEmailsIntegration(unittest.TestCase):
         db.create_tables([Email], safe=True)
 
         # Mock authentication
-        mock_credentials = MagicMock()
-        mock_authenticate.return_value = mock_credentials
         mock_service = MagicMock()
-        mock_build.return_value = mock_service
+        mock_get_client.return_value = FakeGmailClient(mock_service)
 
         # Insert test email
         Email.create(
@@ -0,0 +1,112 @@
+import json
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch, mock_open
+from rule_compiler import compile_rules, load_rule_program, RuleValidationError
+from db_utils import get_or_initialize_db, Email
+
+
+RULES = {
+    "rules": [
+        {
+            "predicate": "All",
+            "conditions": [
+                {"field": "sender", "predicate": "contains", "value": "GitHub.com"},
+                {"field": "received_at", "predicate": "less_than", "value": "7", "unit": "days"}
+            ],
+            "actions": ["mark_as_unread", "move_to_Important"]
+        },
+        {
+            "predicate": "Any",
+            "conditions": [
+                {"field": "subject", "predicate": "equals", "value": "Invoice"},
+                {"field": "received_at", "predicate": "greater_than", "value": "1", "unit": "months"}
+            ],
+            "actions": ["flag_message"]
+        }
+    ]
+}
+
+
+class TestRuleCompiler(unittest.TestCase):
+    def test_compiles_into_immutable_program(self):
+        program = compile_rules(RULES)
+
+        self.assertEqual(len(program.rules), 2)
+        self.assertEqual(program.rules[1].conditions[1].value, 30)
+        self.assertEqual(program.rules[0].actions, ("mark_as_unread", "move_to_Important"))
+        with self.assertRaises(AttributeError):
+            program.rules[0].predicate = "Any"
+        self.assertNotEqual(program.rules[0].rule_hash, program.rules[1].rule_hash)
+
+    def test_reports_every_problem_with_its_location(self):
+        bad_rules = {"rules": [
+            {"predicate": "Some", "conditions": [
+                {"field": "received_at", "predicate": "lesser_than", "value": "5"},
+                {"field": "cc", "predicate": "contains", "value": "x"}],
+             "actions": ["delete"]},
+            {"predicate": "All", "conditions": [], "actions": ["flag_message"]},
+        ]}
+
+        with self.assertRaises(RuleValidationError) as error:
+            compile_rules(bad_rules)
+
+        self.assertEqual(len(error.exception.errors), 5)
+        self.assertIn("rules[0].predicate", error.exception.errors[0])
+        self.assertIn("rules[0].conditions[0].predicate: unknown predicate 'lesser_than'", str(error.exception))
+        self.assertIn("rules[0].conditions[1].field: unknown field 'cc'", str(error.exception))
+        self.assertIn("rules[0].actions[0]: unknown action 'delete'", str(error.exception))
+        self.assertIn("rules[1].conditions: expected a non-empty list", str(error.exception))
+
+    def test_in_memory_evaluation(self):
+        program = compile_rules(RULES)
+        now = datetime(2025, 3, 1)
+        recent = {"sender": "bot@github.com", "subject": "PR", "received_at": now - timedelta(days=2)}
+        old_invoice = Email(sender="billing@shop.com", subject="Invoice",
+                            received_at=now - timedelta(days=3))
+        old = {"sender": "news@site.com", "subject": "Hi", "received_at": "2025-01-01 00:00:00"}
+
+        self.assertEqual([rule.index for rule in program.match(recent, now)], [0])
+        self.assertEqual([rule.index for rule in program.match(old_invoice, now)], [1])
+        self.assertEqual([rule.index for rule in program.match(old, now)], [1])
+
+    def test_load_rule_program_caches_by_file_hash(self):
+        with patch("builtins.open", mock_open(read_data=json.dumps(RULES))):
+            first = load_rule_program("rules.json")
+        with patch("builtins.open", mock_open(read_data=json.dumps(RULES))), \
+                patch("rule_compiler.compile_rules") as mock_compile:
+            second = load_rule_program("other.json")
+        mock_compile.assert_not_called()
+        self.assertIs(first, second)
+
+        with patch("builtins.open", mock_open(read_data="{not json")):
+            with self.assertRaises(RuleValidationError):
+                load_rule_program("broken.json")
+
+    def test_in_memory_matches_agree_with_sql(self):
+        db = get_or_initialize_db(testing=True)
+        if db.is_closed():
+            db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        now = datetime.now()
+        rows = [
+            ("a", "bot@GITHUB.com", "PR", 1), ("b", "bot@github.com", "PR", 10),
+            ("c", "x@shop.com", "Invoice", 2), ("d", "x@shop.com", "invoice", 2),
+            ("e", "x@shop.com", "Hello", 40),
+        ]
+        for email_id, sender, subject, age in rows:
+            Email.create(id=email_id, sender=sender, subject=subject, body="",
+                         received_at=now - timedelta(days=age))
+
+        program = compile_rules(RULES)
+        for rule in program.rules:
+            from_sql = {email.id for email in Email.select().where(rule.to_expression(now))}
+            in_memory = {email.id for email in Email.select() if rule.matches(email, now)}
+            self.assertEqual(from_sql, in_memory)
+
+        Email.delete().execute()
+        db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
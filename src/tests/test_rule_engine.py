@@ -0,0 +1,80 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+from rule_engine import MultiPatternMatcher, evaluate_rules
+from rule_compiler import compile_rules
+from db_utils import get_or_initialize_db, insert_emails, Email
+
+
+class TestMultiPatternMatcher(unittest.TestCase):
+    def test_finds_overlapping_patterns_case_insensitively(self):
+        matcher = MultiPatternMatcher(["he", "she", "hers", "HIS", ""])
+
+        self.assertEqual(matcher.find("uSHErs"), {0, 1, 2, 4})
+        self.assertEqual(matcher.find("this"), {3, 4})
+        self.assertEqual(matcher.find(None), {4})
+
+    def test_agrees_with_naive_substring_search(self):
+        rng = random.Random(7)
+        for _ in range(500):
+            patterns = ["".join(rng.choice("abc") for _ in range(rng.randint(1, 4))) for _ in range(8)]
+            text = "".join(rng.choice("abcABC") for _ in range(rng.randint(0, 30)))
+            expected = {index for index, pattern in enumerate(patterns) if pattern in text.lower()}
+            self.assertEqual(MultiPatternMatcher(patterns).find(text), expected)
+
+
+class TestEvaluateRules(unittest.TestCase):
+    def setUp(self):
+        self.db = get_or_initialize_db(testing=True)
+        if self.db.is_closed():
+            self.db.connect(reuse_if_open=True)
+        Email.delete().execute()
+        self.now = datetime.now()
+        rng = random.Random(3)
+        senders = ["ci@github.com", "news@Medium.com", "billing@shop.com", "friend@mail.com"]
+        subjects = ["Invoice 42", "Build failed", "Weekly digest", "Gameplay tips", "hello"]
+        insert_emails([{
+            "id": f"id{i}", "sender": rng.choice(senders), "subject": rng.choice(subjects),
+            "body": rng.choice(["pay now", "see attached", ""]),
+            "received_at": self.now - timedelta(days=rng.randint(0, 60)),
+        } for i in range(300)])
+
+    def tearDown(self):
+        Email.delete().execute()
+        self.db.close()
+
+    def test_single_pass_matches_per_rule_sql_queries(self):
+        program = compile_rules({"rules": [
+            {"predicate": "All", "conditions": [
+                {"field": "sender", "predicate": "contains", "value": "github"},
+                {"field": "received_at", "predicate": "less_than", "value": "7"}], "actions": ["flag_message"]},
+            {"predicate": "Any", "conditions": [
+                {"field": "subject", "predicate": "contains", "value": "INVOICE"},
+                {"field": "body", "predicate": "contains", "value": "pay"}], "actions": ["flag_message"]},
+            {"predicate": "All", "conditions": [
+                {"field": "sender", "predicate": "not_contains", "value": "medium"},
+                {"field": "subject", "predicate": "not_equals", "value": "hello"},
+                {"field": "received_at", "predicate": "greater_than", "value": "1", "unit": "months"}],
+             "actions": ["mark_as_read"]},
+            {"predicate": "All", "conditions": [
+                {"field": "subject", "predicate": "equals", "value": "Gameplay tips"}], "actions": ["move_to_games"]},
+        ]})
+
+        matches = evaluate_rules(program, now=self.now)
+
+        for rule in program.rules:
+            expected = {email.id for email in Email.select(Email.id).where(rule.to_expression(self.now))}
+            self.assertTrue(expected)
+            self.assertEqual(matches[rule.index], expected)
+
+    def test_restricts_evaluation_to_a_subset(self):
+        program = compile_rules({"rules": [{"predicate": "All", "conditions": [
+            {"field": "sender", "predicate": "contains", "value": "@"}], "actions": ["flag_message"]}]})
+
+        matches = evaluate_rules(program, query=Email.id.in_(["id1", "id2", "missing"]))
+
+        self.assertEqual(matches, {0: {"id1", "id2"}})
+
+
+if __name__ == "__main__":
+    unittest.main()
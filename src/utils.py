@@ -1,22 +1,59 @@
 import os
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
 
-def authenticate_gmail():
+TOKEN_PATH = "token.json"
+CLIENT_SECRETS_PATH = "credentials.json"
+
+
+def authenticate_gmail(token_path=TOKEN_PATH, client_secrets_path=CLIENT_SECRETS_PATH, interactive=True):
+    """
+    Loads the OAuth credentials stored in `token_path`, refreshing or creating them as needed.
+
+    The token file is only written when the credentials changed. Prefer
+    `gmail_client.get_gmail_client`, which calls this once per process.
+
+    Args:
+        token_path (str): Token file of the mailbox, updated after a refresh or a new authorization.
+        client_secrets_path (str): OAuth client secrets used to authorize a new token.
+        interactive (bool): If False, raise instead of opening the browser authorization
+            flow (e.g. in worker processes, see `multi_account.py --authorize`).
+    """
     creds = None
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+    if os.path.exists(token_path):
+        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            # Imported here: `requests` is slow to import and only needed to refresh
+            from google.auth.transport.requests import Request
+
             creds.refresh(Request())
+        elif not interactive:
+            raise RuntimeError(f"No valid token in {token_path}, authorize the account first")
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
             flow = InstalledAppFlow.from_client_secrets_file(
-                "credentials.json", SCOPES)
+                client_secrets_path, SCOPES)
             creds = flow.run_local_server(port=0)
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
+        save_token(creds, token_path)
     return creds
+
+
+def save_token(creds, token_path=TOKEN_PATH):
+    """Writes credentials to `token_path` atomically, so concurrent readers never see a partial file."""
+    temporary = f"{token_path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as token:
+        token.write(creds.to_json())
+    os.replace(temporary, token_path)
+
+
+def get_http_status(error):
+    """
+    Returns the HTTP status code carried by a Gmail API error, or None for other exceptions.
+    """
+    resp = getattr(error, "resp", None)
+    status = getattr(resp, "status", None)
+    return int(status) if status is not None else None